@@ -0,0 +1,162 @@
+""" Microbenchmarks for the hot path of the "Jazz for the dead!" game.
+
+Time the protocol codecs, the draw functions, the enemy movement and the collision checks, each with a scaled number of
+enemies where it matters. Drawing happens on an offscreen surface, so no screen is needed. Results are given in
+microseconds per call, the best of several runs, and can be saved as JSON to compare later runs against.
+
+Usage:
+    python jazz_benchmark.py --output baseline.json             Run all benchmarks and save the results.
+    python jazz_benchmark.py --baseline baseline.json           Run all benchmarks and fail if any got slower.
+    python jazz_benchmark.py --filter slimes --repeat 3         Run only the benchmarks whose name contains 'slimes'.
+"""
+
+import os
+
+# Benchmarks must run the same on machines without a screen or speakers. Must be set before pygame is initialized.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import jazz_operations as jo
+from jazz_match import Match, enemy_vel
+import argparse
+import json
+import platform
+import timeit
+from random import Random
+import pygame
+
+SLIME_COUNTS = [0, 10, 100, 500]
+TOLERANCE = 0.25            # Allowed slowdown against the baseline, as a fraction, before reporting a regression.
+
+
+def make_slimes(count, seed=0):
+    """ Return enemies spread over the middle of the map, clear of the corners where the players are placed. """
+    rng = Random(seed)
+    return [[(rng.uniform(500, 1400), rng.uniform(250, 650)), rng.uniform(0, jo.slime_num_frames["walk"] - 1),
+             rng.random() < 0.5] for _ in range(count)]
+
+
+def make_top_teams(count):
+    """ Return leaderboard rows, as returned by the database. """
+    return [("team " + str(rank), 1000 - rank) for rank in range(count)]
+
+
+def codec_benchmarks():
+    """ Return the benchmarks of the network protocol. """
+    benchmarks = {}
+    for count in SLIME_COUNTS:
+        slimes = make_slimes(count)
+        frame_data = jo.encode_frame_data("walk", 3, True, (733.5, 800.25), jo.INIT_ATTACKS, jo.FULL_HP, slimes,
+                                          [0, 2], False)
+        benchmarks["encode_frame_data[slimes=" + str(count) + "]"] = (
+            lambda slimes=slimes: jo.encode_frame_data("walk", 3, True, (733.5, 800.25), jo.INIT_ATTACKS,
+                                                       jo.FULL_HP, slimes, [0, 2], False))
+        benchmarks["decode_frame_data[slimes=" + str(count) + "]"] = (
+            lambda frame_data=frame_data: jo.decode_frame_data(frame_data))
+    top_teams = make_top_teams(3)
+    db_data = jo.encode_db_data(top_teams, 7, "week")
+    benchmarks["encode_db_data"] = lambda: jo.encode_db_data(top_teams, 7, "week")
+    benchmarks["decode_db_data"] = lambda: jo.decode_db_data(db_data)
+    return benchmarks
+
+
+def draw_benchmarks():
+    """ Return the benchmarks of the draw functions, rendering on an offscreen surface. """
+    benchmarks = {}
+    screen = pygame.Surface((jo.SCREEN_WIDTH, jo.SCREEN_HEIGHT))
+    player = {"counts": (0, 0, 0), "flags": (False, True, False, True, True, False)}     # Walking.
+
+    def draw_player():
+        player["counts"], player["flags"] = jo.draw_player("s", (368, 800), screen, player["counts"],
+                                                           player["flags"])[3:5]
+
+    benchmarks["draw_player"] = draw_player
+    benchmarks["draw_teammate"] = lambda: jo.draw_teammate("walk", 3, "z", (733, 800), True, screen)
+    benchmarks["draw_teammate[immune]"] = lambda: jo.draw_teammate("walk", 3, "z", (733, 800), True, screen, True)
+    for count in SLIME_COUNTS:
+        slimes = make_slimes(count)
+        benchmarks["draw_slimes[slimes=" + str(count) + "]"] = lambda slimes=slimes: jo.draw_slimes(slimes, screen)
+    swords = list(range(jo.MAX_SWORDS))
+    benchmarks["draw_swords"] = lambda: jo.draw_swords(swords, 0, screen)
+    return benchmarks
+
+
+def simulation_benchmarks():
+    """ Return the benchmarks of the enemy movement and the collision checks of the dedicated server. """
+    benchmarks = {}
+    player_positions = [(40, 20), (1500, 700)]
+    for count in SLIME_COUNTS:
+        slimes = make_slimes(count)
+        benchmarks["move_slimes[slimes=" + str(count) + "]"] = (
+            lambda slimes=slimes: jo.move_slimes(slimes, player_positions, enemy_vel))
+    for count in SLIME_COUNTS:
+        # The players are clear of every enemy, so that all of them are checked and none is removed.
+        match = Match([None, None], "benchmark", None, seed=0)
+        match.slimes = make_slimes(count)
+        match.swords = list(range(jo.MAX_SWORDS))
+        for player, pos in zip(match.players, player_positions):
+            player.pos = pos
+        benchmarks["collisions[slimes=" + str(count) + "]"] = match.handle_collisions
+    return benchmarks
+
+
+def measure(function, repeat):
+    """ Return the best time (in microseconds) of a single call to the given function, over several runs. """
+    timer = timeit.Timer(function)
+    number = timer.autorange()[0]
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def compare(results, baseline, tolerance):
+    """ Print the results next to the baseline. Return the names of the benchmarks that got slower than allowed. """
+    regressions = []
+    for name, micros in results.items():
+        if name not in baseline:
+            print(name.ljust(36) + str(round(micros, 2)).rjust(12) + " us    (new)")
+            continue
+        ratio = micros / baseline[name]
+        line = name.ljust(36) + str(round(micros, 2)).rjust(12) + " us  " + format(ratio, ".2f").rjust(6) + "x"
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            line += "  REGRESSION"
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for Jazz for the dead!")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark, the best one is kept")
+    parser.add_argument("--filter", default="", help="only run the benchmarks whose name contains this text")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results with this JSON file and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="allowed slowdown against the baseline, as a fraction (default: " + str(TOLERANCE) + ")")
+    args = parser.parse_args()
+
+    benchmarks = {}
+    benchmarks.update(codec_benchmarks())
+    benchmarks.update(draw_benchmarks())
+    benchmarks.update(simulation_benchmarks())
+    results = {}
+    for name, function in benchmarks.items():
+        if args.filter in name:
+            results[name] = measure(function, args.repeat)
+            if args.baseline is None:
+                print(name.ljust(36) + str(round(results[name], 2)).rjust(12) + " us")
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump({"python": platform.python_version(), "pygame": pygame.version.ver,
+                       "machine": platform.platform(), "results": results}, file, indent=4)
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print(str(len(regressions)) + " benchmarks got slower than the baseline: " + ", ".join(regressions))
+            raise SystemExit(1)
+        print("No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
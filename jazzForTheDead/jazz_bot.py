@@ -0,0 +1,198 @@
+""" Scripted bot clients for the "Jazz for the dead!" dedicated server.
+
+A bot speaks the same protocol as jazz_client.py, from the lobby to the leaderboard, but plays on its own with a simple
+strategy: it picks up swords when it is running out of attacks, chases and attacks the nearest slime while it has
+attacks left and keeps away from the slimes otherwise. Bots run headless and keep statistics of their connection, for
+load testing (see jazz_loadgen).
+"""
+
+import jazz_operations as jo
+import jazz_lobby
+import jazz_lockstep as jls
+import jazz_transport
+import socket
+import time
+from json import decoder
+
+FPS_CAP = 60
+BOT_TIMEOUT = 30            # Time (in seconds) to wait for a message from the server, before giving up.
+WANTED_ATTACKS = 2          # Go for the swords on the map while having fewer attacks than this.
+ATTACK_REACH = 40           # Extra distance (in pixels) around the player, in which a slime is close enough to attack.
+STEP_MARGIN = 4             # Distance (in pixels) from a target, in which the bot stops moving towards it.
+
+
+class Bot:
+    def __init__(self, sock, fps=FPS_CAP):
+        """ Prepare a bot on a connection that already entered a room of the lobby.
+
+        Parameters:
+            sock (transport or stream socket): Connection with the server, right after the lobby replied with the
+                room code.
+            fps (int): Frames per second to play at, like the frame cap of jazz_client.py. Use 0 to reply as fast as
+                possible.
+        """
+
+        self.sock = jazz_transport.wrap(sock)
+        self.sock.settimeout(BOT_TIMEOUT)
+        self.frame_time = 1 / fps if fps > 0 else 0
+        self.last_tick = 0
+        self.team_name = None
+        self.role = None
+        self.level_index = 0
+        self.player = None
+        # Statistics.
+        self.frames = 0                 # Gameplay frames received, for all levels.
+        self.gameplay_time = 0          # Time (in seconds) spent in gameplay, for all levels.
+        self.rtts = []                  # Time (in seconds) from sending each frame to receiving the next one.
+        self.decode_errors = 0
+        self.final_score = None
+        self.team_rank = None
+        self.error = None               # Reason the bot stopped before the end of the match, if it did.
+
+    def receive(self):
+        """ Receive a single message from the server. """
+        data = self.sock.receive(2048)
+        if len(data) == 0:
+            raise ConnectionResetError("The server closed the connection.")
+        return data
+
+    def tick(self):
+        """ Wait until a whole frame has passed since the last call, the same way pygame.time.Clock.tick() does. """
+        delay = self.last_tick + self.frame_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.last_tick = time.perf_counter()
+
+    def play(self):
+        """ Play the whole match, from the team name to the leaderboard. Blocking. Return whether it reached the
+        end. """
+        try:
+            self.team_name = self.receive().decode()
+            self.role = self.receive().decode()
+            while True:
+                self.receive()          # Start signal.
+                if self.level_index == 0:
+                    attacks = jo.INIT_ATTACKS
+                else:
+                    attacks = jo.INIT_ATTACKS - 1
+                self.player = jls.PlayerState(self.role, jo.START_POS_CLIENT, attacks)
+                hp = self.play_level()
+                if hp <= 0 or self.level_index == len(jo.levels) - 1:
+                    break
+                self.receive()          # Score of the level.
+                self.level_index += 1
+            self.final_score = int(self.receive().decode())
+            top_teams, self.team_rank, window = jo.decode_db_data(self.receive())
+            return True
+        except (socket.error, ValueError) as e:
+            self.error = str(e) or type(e).__name__
+            return False
+        finally:
+            try:
+                self.sock.close()
+            except socket.error:
+                print("Error closing socket.")
+
+    def play_level(self):
+        """ Play the gameplay of the current level, until the server stops it. Return the health points left. """
+        hp = jo.FULL_HP
+        slimes = []
+        swords = []
+        stop = False
+        sent_time = None
+        start_time = time.perf_counter()
+        while not stop:
+            frame_data = self.receive()
+            if sent_time is not None:
+                self.rtts.append(time.perf_counter() - sent_time)
+            self.frames += 1
+            try:
+                hp, slimes, swords, stop = jo.decode_frame_data(frame_data)[5:9]
+            except (decoder.JSONDecodeError, UnicodeDecodeError):
+                self.decode_errors += 1
+            self.tick()
+            mask = choose_keys(self.player.rect(), self.player.attacks, slimes, swords, self.level_index)
+            self.player.handle_keys(mask, [], 0)
+            self.player.animate()
+            self.pick_sword(swords)
+            self.sock.send(jo.encode_frame_data(self.player.anim_key, self.player.anim_index,
+                                                not self.player.looking_left, (self.player.x, self.player.y),
+                                                self.player.attacks))
+            sent_time = time.perf_counter()
+        self.gameplay_time += time.perf_counter() - start_time
+        return hp
+
+    def pick_sword(self, swords):
+        """ Count the extra attack of a sword the player touches, the same way jazz_client.py does. """
+        rect = self.player.rect()
+        for sword_rect in jo.sword_rects(swords, self.level_index):
+            if rect.colliderect(sword_rect):
+                if self.player.attacks < jo.MAX_ATTACKS:
+                    self.player.attacks += 1
+                break
+
+
+def choose_keys(rect, attacks, slimes, swords, level_index):
+    """ Decide which keys a bot presses on the current frame.
+
+    Parameters:
+        rect (pygame.Rect): The rectangle of the current frame of the player.
+        attacks (int): The number of available hits left.
+        slimes (list of tuples): Data for each enemy currently in-game. Could be empty.
+        swords (list of ints): Indexes of sword spawns of swords currently in-game. Could be empty.
+        level_index (int): Index of the current level in the Levels[] list.
+
+    Returns:
+        mask (int): The pressed keys, as jazz_lockstep key bits.
+    """
+
+    target = None
+    mask = 0
+    sword_rects = jo.sword_rects(swords, level_index)
+    slime_rects = jo.slime_rects(slimes)
+    if len(sword_rects) > 0 and attacks < WANTED_ATTACKS:
+        target = min(sword_rects, key=lambda sword_rect: jo.get_distance(rect.center, sword_rect.center)).center
+    elif len(slime_rects) > 0:
+        nearest = min(slime_rects, key=lambda slime_rect: jo.get_distance(rect.center, slime_rect.center))
+        if attacks > 0:
+            target = nearest.center
+            if rect.inflate(ATTACK_REACH, ATTACK_REACH).colliderect(nearest):
+                mask |= jls.KEY_ATTACK
+        else:                   # Run the other way.
+            target = (2 * rect.centerx - nearest.centerx, 2 * rect.centery - nearest.centery)
+    if target is not None:
+        if target[0] < rect.centerx - STEP_MARGIN:
+            mask |= jls.KEY_LEFT
+        elif target[0] > rect.centerx + STEP_MARGIN:
+            mask |= jls.KEY_RIGHT
+        if target[1] < rect.centery - STEP_MARGIN:
+            mask |= jls.KEY_UP
+        elif target[1] > rect.centery + STEP_MARGIN:
+            mask |= jls.KEY_DOWN
+    return mask
+
+
+def join(host, port, command, fps=FPS_CAP):
+    """ Connect a new bot to the lobby of a dedicated server.
+
+    Parameters:
+        host (string): Address of the server.
+        port (int): Port of the lobby.
+        command (string): CREATE, JOIN or QUICK command to send to the lobby, as described in jazz_lobby.
+        fps (int): Frames per second to play at. Use 0 to reply as fast as possible.
+
+    Returns:
+        tuple of:
+            bot (Bot): Ready to play() once the room is full.
+            code (string): Code of the room the bot entered.
+
+    Raises socket.error if the server could not be reached and jazz_lobby.LobbyError if the command was refused.
+    """
+
+    sock = socket.create_connection((host, port), timeout=BOT_TIMEOUT)
+    try:
+        code = jazz_lobby.enter(sock, command)
+    except (socket.error, jazz_lobby.LobbyError):
+        sock.close()
+        raise
+    return Bot(sock, fps), code
@@ -0,0 +1,107 @@
+""" Spectator broadcasting for the "Jazz for the dead!" dedicated server.
+
+A match publishes one encoded snapshot per frame and a background thread fans it out to every spectator. Each spectator
+has a small bounded queue: when a spectator reads slower than the match plays, its oldest snapshots are dropped, so it
+skips ahead to the latest one instead of slowing down the players or the other spectators.
+"""
+
+import socket
+import threading
+from collections import deque
+
+SPECTATOR_QUEUE = 2         # Snapshots waiting to be sent, per spectator.
+
+
+class Spectator:
+    def __init__(self, conn):
+        self.conn = conn
+        self.queue = deque(maxlen=SPECTATOR_QUEUE)      # Appending to a full queue drops the oldest snapshot.
+        self.partial = None     # Rest of a snapshot that did not fit in the send buffer. Never dropped.
+
+    def flush(self):
+        """ Send as many queued snapshots as possible without blocking. Return 'False' if the spectator left. """
+        try:
+            while self.partial is not None or len(self.queue) > 0:
+                if self.partial is None:
+                    self.partial = memoryview(self.queue.popleft())
+                sent = self.conn.send(self.partial)
+                if sent < len(self.partial):
+                    self.partial = self.partial[sent:]
+                    return True
+                self.partial = None
+        except (BlockingIOError, InterruptedError):
+            return True
+        except socket.error:
+            return False
+        return True
+
+
+class Broadcaster:
+    def __init__(self):
+        self.spectators = []
+        self.snapshot = None        # Latest published snapshot, not yet queued for the spectators.
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def add(self, conn):
+        """ Start sending snapshots to a new spectator. """
+        conn.setblocking(False)
+        with self.condition:
+            if self.closed:
+                conn.close()
+                return
+            self.spectators.append(Spectator(conn))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def has_spectators(self):
+        """ Return whether anyone is watching, so that snapshots are only encoded when needed. """
+        return len(self.spectators) > 0
+
+    def publish(self, snapshot):
+        """ Hand over the snapshot of the current frame. Never blocks on the network.
+
+        Parameters:
+            snapshot (bytes): A complete message, as composed by jo.encode_spectator_data().
+        """
+
+        with self.condition:
+            self.snapshot = snapshot
+            self.condition.notify()
+
+    def close(self):
+        """ Stop broadcasting and disconnect all spectators. """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def run(self):
+        """ Fan out every published snapshot to all spectators, until closed. """
+        while True:
+            with self.condition:
+                while self.snapshot is None and not self.closed:
+                    self.condition.wait()
+                snapshot = self.snapshot
+                self.snapshot = None
+                closed = self.closed
+                spectators = list(self.spectators)
+            left = []
+            for spectator in spectators:
+                if snapshot is not None:
+                    spectator.queue.append(snapshot)
+                # Flush before dropping on close, so that spectators also get the final snapshot of the match.
+                if not spectator.flush() or closed:
+                    left.append(spectator)
+            if len(left) > 0:
+                with self.condition:
+                    for spectator in left:
+                        self.spectators.remove(spectator)
+                for spectator in left:
+                    try:
+                        spectator.conn.close()
+                    except socket.error:
+                        print("Error closing spectator connection.")
+            if closed:
+                return
@@ -1,9 +1,24 @@
 """ Client script for the "Jazz for the dead!" game.
 
-Connect to a server on the local network and play the game.
+Connect to a server on the local network and play the game. To play on a dedicated server instead, set the JAZZ_LOBBY
+environment variable to the lobby command to send after connecting, e.g. "QUICK" or "JOIN ABCD" (see jazz_lobby).
+Set the JAZZ_TRANSPORT environment variable to 'udp' to play over UDP, with a server that does the same (see
+jazz_transport).
+On the same host as the server, the gameplay frames go through shared memory instead of the network, unless the
+JAZZ_SHARED_MEMORY environment variable is set to 0 (see jazz_sharedmem).
+Lockstep mode (see jazz_lockstep) is used whenever the server asks for it.
 """
 
 import jazz_operations as jo
+import jazz_lobby
+import jazz_lockstep as jls
+import jazz_handshake
+import jazz_transport
+import jazz_sharedmem
+import jazz_timing
+import jazz_netstats
+import jazz_profiler
+import os
 import socket
 from ipaddress import IPv4Network
 from math import sqrt
@@ -16,6 +31,8 @@ IP_CHARS = [pygame.K_0, pygame.K_1, pygame.K_2, pygame.K_3, pygame.K_4, pygame.K
             pygame.K_8, pygame.K_9, pygame.K_KP0, pygame.K_KP1, pygame.K_KP2, pygame.K_KP3, pygame.K_KP4,
             pygame.K_KP5, pygame.K_KP6, pygame.K_KP7, pygame.K_KP8, pygame.K_KP9, pygame.K_PERIOD, pygame.K_KP_PERIOD]
 
+LOBBY_COMMAND = os.environ.get("JAZZ_LOBBY", "")    # Empty when connecting directly to a host.
+
 delta_time = 1 / FPS_CAP                            # Not actual delta time, expects a stable frame rate.
 immune_frames = jo.PLAYER_IMMUNE_DUR * FPS_CAP      # Number of frames that the player is immune to damage after a hit.
 
@@ -30,7 +47,10 @@ def is_ipv4(string):
 
 
 # Initialize connection with the server.
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+s = jazz_transport.new_socket()
+conn = None             # Transport connected to the server, once connected.
+handshake = jazz_handshake.Handshake()     # Waits for the server without blocking the menus.
+frames = None           # Frames shared with a server on the same host (see jazz_sharedmem), None over the network.
 
 
 # Pygame and variable initialization.
@@ -38,13 +58,16 @@ pygame.init()
 screen = pygame.display.set_mode((jo.SCREEN_WIDTH, jo.SCREEN_HEIGHT), vsync=1)
 pygame.display.set_caption("Jazz for the dead! - client")
 clock = pygame.time.Clock()
+frame_timer = jazz_timing.from_environment()     # Toggled with F3.
+net_stats = jazz_netstats.from_environment("client")
+profiler = jazz_profiler.from_environment("client")     # Triggered with F4.
 # menu_screen ranges from '1' to '3' for the starting menu, '4' in-between levels and '5' for the leaderboard.
 # Negative values indicate that the current screen is NOT a menu.
 menu_screen = 1
 level_index = 0
-menu_bg = pygame.image.load(jo.GRAPHICS_DIR + "menu_bg.png")
-level1_bg = pygame.image.load(jo.GRAPHICS_DIR + "level1.png")
-level2_bg = pygame.image.load(jo.GRAPHICS_DIR + "level2.png")
+menu_bg = pygame.image.load(jo.GRAPHICS_DIR + "menu_bg.png").convert()
+level1_bg = pygame.image.load(jo.GRAPHICS_DIR + "level1.png").convert()
+level2_bg = pygame.image.load(jo.GRAPHICS_DIR + "level2.png").convert()
 menu_window = pygame.image.load(jo.GRAPHICS_DIR + "ui_window.png").convert_alpha()
 menu_title = pygame.image.load(jo.GRAPHICS_DIR + "game_title.png").convert_alpha()
 insert_ip_text = jo.dosis_font.render("Insert the host's IP to join:", 1, jo.PINK)
@@ -53,13 +76,16 @@ host_ip = ""
 input_active = True
 show_ip_error = False
 ip_error_text = jo.dosis_font.render("Error", 1, jo.PINK)
+connect_step = None    # Either 'connect' or 'lobby' while connecting to the host, None otherwise.
+connecting_text = jo.dosis_font.render("Connecting... (Backspace to cancel)", 1, jo.PINK)
+connecting_text_rect = connecting_text.get_rect(center=(jo.width_center, 780))
 wait_name_text = jo.dosis_font.render("The host is picking a team name...", 1, jo.PINK)
 wait_name_text_rect = wait_name_text.get_rect(center=(jo.width_center, 640))
 team_name = ""
 client_role = ""       # Can either be 's' for skeleton or 'z' for zombie.
 server_role = ""       # Can either be 's' for skeleton or 'z' for zombie.
 hourglass = pygame.image.load(jo.GRAPHICS_DIR + "hourglass.png")
-countdown_active = False
+countdown = None       # Countdown to the next level, None when not counting down.
 hp = jo.FULL_HP        # Shared health for the team.
 server_attacks = jo.INIT_ATTACKS
 client_attacks = jo.INIT_ATTACKS
@@ -94,8 +120,12 @@ stop_gameplay = False
 victorious = False
 partial_score = None
 final_score = None
+db_data = None
 top_teams = []
 team_rank = None
+leaderboard_window = "all"
+lockstep_seed = None    # Sent by the server in lockstep mode.
+world = None            # The simulation of lockstep mode.
 
 # Start playing menu music.
 pygame.mixer.music.set_volume(jo.MENU_MUSIC_VOL)
@@ -107,9 +137,14 @@ pygame.mixer.music.play(-1)
 run = True
 while run:
     clock.tick(FPS_CAP)
+    frame_timer.start()
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
             run = False
+        if event.type == pygame.KEYDOWN and event.key == jazz_timing.TOGGLE_KEY:
+            frame_timer.toggle()
+        if event.type == pygame.KEYDOWN and event.key == jazz_profiler.TRIGGER_KEY:
+            profiler.start()
 
         # Handle user input for the host IP.
         if event.type == pygame.KEYDOWN and input_active:
@@ -117,14 +152,7 @@ while run:
                 input_active = False
                 show_ip_error = False
                 if is_ipv4(host_ip):
-                    try:
-                        s.connect((host_ip, jo.PORT))
-                        # print("Connection established.")
-                        menu_screen += 1
-                    except socket.error:
-                        ip_error_text = jo.dosis_font.render("Error: Host not found", 1, jo.PINK)
-                        show_ip_error = True
-                        input_active = True
+                    connect_step = "connect"
                 else:
                     ip_error_text = jo.dosis_font.render("Error: Invalid IP address", 1, jo.PINK)
                     show_ip_error = True
@@ -135,6 +163,13 @@ while run:
             elif len(host_ip) < 15 and event.key in IP_CHARS:
                 show_ip_error = False
                 host_ip += event.unicode
+        # Cancel connecting to the host.
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_BACKSPACE and connect_step is not None:
+            handshake.cancel()
+            s.close()               # Start over with a new connection.
+            s = jazz_transport.new_socket()
+            connect_step = None
+            input_active = True
 
     # Exit game when pressing escape.
     keys = pygame.key.get_pressed()
@@ -192,6 +227,8 @@ while run:
         walk_count = 0
         walking = False
 
+    frame_timer.mark("input")
+
     # Render the background.
     if menu_screen > 0:
         bg = menu_bg
@@ -200,6 +237,7 @@ while run:
     else:
         bg = level2_bg
     screen.blit(bg, (0, 0))
+    frame_timer.mark("render")
 
     # Render the elements of the current screen.
     if menu_screen > 0:         # Any menu.
@@ -214,83 +252,139 @@ while run:
         if show_ip_error:
             ip_error_text_rect = ip_error_text.get_rect(center=(jo.width_center, 780))
             screen.blit(ip_error_text, ip_error_text_rect)
+        if connect_step is not None:
+            screen.blit(connecting_text, connecting_text_rect)
+            frame_timer.mark("render")
+            # Connect to the host and enter the lobby of a dedicated server, one step per frame.
+            try:
+                if connect_step == "connect" and handshake.connected(s, (host_ip, jo.PORT)):
+                    # print("Connection established.")
+                    conn = jazz_transport.open_connected(s)
+                    if len(LOBBY_COMMAND) > 0:
+                        conn.send((LOBBY_COMMAND + "\n").encode())
+                        connect_step = "lobby"
+                    else:
+                        frames = jazz_sharedmem.offer(conn)
+                        connect_step = None
+                        menu_screen += 1
+                if connect_step == "lobby":
+                    reply = handshake.message(conn, jazz_handshake.REPLY_TIMEOUT, line=True)
+                    if reply is not None:
+                        room_code = jazz_lobby.room_code(reply.decode().strip())
+                        wait_name_text = jo.dosis_font.render("Waiting for a teammate in room " + room_code + "...",
+                                                              1, jo.PINK)
+                        wait_name_text_rect = wait_name_text.get_rect(center=(jo.width_center, 640))
+                        connect_step = None
+                        menu_screen += 1
+            except (socket.error, jazz_lobby.LobbyError) as e:
+                s.close()           # Start over with a new connection.
+                s = jazz_transport.new_socket()
+                conn = None
+                if isinstance(e, jazz_lobby.LobbyError):
+                    ip_error_text = jo.dosis_font.render("Error: " + str(e), 1, jo.PINK)
+                else:
+                    ip_error_text = jo.dosis_font.render("Error: Host not found", 1, jo.PINK)
+                show_ip_error = True
+                input_active = True
+                connect_step = None
+            frame_timer.mark("network")
     elif menu_screen == 2:      # Team name screen.
         screen.blit(wait_name_text, wait_name_text_rect)
-        pygame.display.update()         # Show the updated screen before the blocking operation.
+        frame_timer.mark("render")
         try:
-            team_name = s.recv(1024).decode()
-            if len(team_name) > 0:      # If the server closes, the client might receive empty data.
+            message = handshake.message(conn)
+            if message is not None:
+                team_name = message.decode()
                 menu_screen += 1
         except socket.error:
             print("Failed to receive team name from server.")
             run = False
+        frame_timer.mark("network")
     elif menu_screen == 3:      # Start screen.
         if len(client_role) == 0:
             try:
-                client_role = s.recv(1024).decode()
+                message = handshake.message(conn)
+                if message is not None:
+                    client_role = message.decode()
             except socket.error:
                 print("Failed to receive client role from server.")
                 run = False
-        if len(client_role) > 0:        # If the server closes, the client might receive empty data.
+        if len(client_role) == 0:
+            screen.blit(hourglass, (jo.width_center - hourglass.get_width() / 2, 780))
+        else:
             if client_role == "s":
                 server_role = "z"
             else:
                 server_role = "s"
             jo.draw_start_menu(team_name, screen, client_role)
-            if not countdown_active:
+            if countdown is None:
                 screen.blit(hourglass, (jo.width_center - hourglass.get_width() / 2, 780))
-                pygame.display.update()
+                frame_timer.mark("render")
                 try:
-                    start_signal = s.recv(1024).decode()
-                    if start_signal == "start":
-                        countdown_active = True
-                except socket.error:
+                    message = handshake.message(conn)
+                    start = jo.decode_start_data(message) if message is not None else None
+                    if start is not None:
+                        lockstep_seed = start[0]
+                        countdown = jo.Countdown(jo.COUNTDOWN_SEC, start[1])
+                        if frames is not None and not frames.taken():
+                            frames.close()      # Declined by the server. The frames go through the network.
+                            frames = None
+                        pygame.mixer.music.fadeout(1200)
+                except (socket.error, ValueError):
                     print("Failed to receive start signal from server.")
                     run = False
-            else:
-                pygame.mixer.music.fadeout(1200)
-                jo.countdown_from(jo.COUNTDOWN_SEC, screen)
+                frame_timer.mark("network")
+            elif countdown.draw(screen):
                 pygame.mixer.music.set_volume(jo.GAME_MUSIC_VOL)
                 pygame.mixer.music.load(jo.SOUNDS_DIR + "level1_music.mp3")
-                countdown_active = False
+                countdown = None
                 menu_screen = -1
-                movement_active = True
-                attack_active = True
+                if lockstep_seed is not None:
+                    world = jls.World(lockstep_seed, server_role, client_role)
+                movement_active = world is None         # In lockstep mode, the world moves the players.
+                attack_active = world is None
     elif menu_screen == 4:      # Next level screen.
         # Receive the level score from the server.
         if partial_score is None:
-            countdown_active = False
-            jo.victory_sound.play()
             try:
-                partial_score = int(s.recv(1024).decode())
-            except socket.error:
+                message = handshake.message(conn, jazz_handshake.REPLY_TIMEOUT)
+                if message is not None:
+                    partial_score = int(message.decode())
+            except (socket.error, ValueError):
                 print("Failed to receive level score from server.")
                 run = False
         # Render UI elements.
         screen.blit(jo.level_cleared_text, jo.level_cleared_text_rect)
-        partial_score_text = jo.dosis_font.render("Score: " + str(partial_score), 1, jo.PINK)
-        partial_score_text_rect = partial_score_text.get_rect(center=(jo.width_center, 640))
-        screen.blit(partial_score_text, partial_score_text_rect)
-        if not countdown_active:
+        if partial_score is not None:
+            partial_score_text = jo.dosis_font.render("Score: " + str(partial_score), 1, jo.PINK)
+            partial_score_text_rect = partial_score_text.get_rect(center=(jo.width_center, 640))
+            screen.blit(partial_score_text, partial_score_text_rect)
+        if countdown is None:
             screen.blit(hourglass, (jo.width_center - hourglass.get_width() / 2, 780))
-            pygame.display.update()
+            frame_timer.mark("render")
             # Wait for the signal to start the next level.
             try:
-                start_signal = s.recv(1024).decode()
-                if start_signal == "start":
-                    countdown_active = True
-            except socket.error:
+                message = handshake.message(conn) if partial_score is not None else None
+                start = jo.decode_start_data(message) if message is not None else None
+                if start is not None:
+                    if start[0] is not None:
+                        lockstep_seed = start[0]
+                    countdown = jo.Countdown(jo.COUNTDOWN_SEC, start[1])
+            except (socket.error, ValueError):
                 print("Failed to receive start signal from server.")
                 run = False
-        # Begin countdown to the next level.
-        else:
-            jo.countdown_from(jo.COUNTDOWN_SEC, screen)
-            pygame.mixer.music.load(jo.SOUNDS_DIR + "level2_music.mp3")
-            pygame.mixer.music.play(-1)
-            countdown_active = False
+            frame_timer.mark("network")
+        # Count down to the next level.
+        elif countdown.draw(screen):
+            try:
+                pygame.mixer.music.load(jo.SOUNDS_DIR + "level2_music.mp3")
+                pygame.mixer.music.play(-1)
+            except pygame.error:                # The music file of level 2 is missing.
+                print("Failed to load level 2 music.")
+            countdown = None
             menu_screen = -1
-            movement_active = True
-            attack_active = True
+            movement_active = world is None
+            attack_active = world is None
             # Reset gameplay and prepare the next level.
             hp = jo.FULL_HP
             server_attacks = jo.INIT_ATTACKS - 1
@@ -318,30 +412,59 @@ while run:
             client_can_kill = False
             client_immune_frame = 0
             level_index += 1
+            if world is not None:
+                world.reset_level(level_index)
     elif menu_screen == 5:      # Leaderboard.
         # Show cursor.
         pygame.mouse.set_visible(True)
-        if final_score is None:                         # Run once.
+        if final_score is None:
             # Receive the total score from the server.
             try:
-                final_score = int(s.recv(1024).decode())
-            except socket.error:
+                message = handshake.message(conn, jazz_handshake.REPLY_TIMEOUT)
+                if message is not None:
+                    final_score = int(message.decode())
+                    # Play the appropriate sound.
+                    if victorious:
+                        jo.victory_sound.play()
+                    else:
+                        jo.defeat_sound.play()
+            except (socket.error, ValueError):
                 print("Failed to receive total score from server.")
                 run = False
-            # Play the appropriate sound.
-            if victorious:
-                jo.victory_sound.play()
-            else:
-                jo.defeat_sound.play()
+        elif db_data is None:
             # Receive data derived from the database from the server.
             try:
-                db_data = s.recv(2048)
-                (top_teams, team_rank) = jo.decode_db_data(db_data)
+                db_data = handshake.message(conn, jazz_handshake.REPLY_TIMEOUT)
+                if db_data is not None:
+                    (top_teams, team_rank, leaderboard_window) = jo.decode_db_data(db_data)
             except socket.error:
                 print("Failed to receive database data from server.")
                 run = False
         # Render UI elements.
-        jo.draw_leaderboard(top_teams, (team_rank, team_name, final_score), victorious, screen)
+        if db_data is None:
+            screen.blit(hourglass, (jo.width_center - hourglass.get_width() / 2, 780))
+        else:
+            jo.draw_leaderboard(top_teams, (team_rank, team_name, final_score), victorious, screen,
+                                leaderboard_window)
+    elif menu_screen < 0 and world is not None:     # Actual gameplay, in lockstep mode.
+        # Hide cursor.
+        pygame.mouse.set_visible(False)
+        # Exchange keys with the server and simulate the frame on both sides.
+        client_mask = jls.read_keys(keys)
+        try:
+            server_mask, desynced = jls.exchange_keys(conn, world, client_mask)
+            frame_timer.mark("network")
+            if desynced:
+                print("Lockstep desync detected at frame " + str(world.tick + 1) + ".")
+            stop_gameplay, events = world.step([server_mask, client_mask])
+            jls.play_sounds(events, 1)
+            frame_timer.mark("simulation")
+        except (socket.error, ValueError):
+            print("Failed to exchange keys with server.")
+            run = False
+        jls.draw_world(world, 1, screen)
+        if stop_gameplay:
+            hp = world.hp
     elif menu_screen < 0:       # Actual gameplay.
         # Hide cursor.
         pygame.mouse.set_visible(False)
@@ -387,31 +510,47 @@ while run:
     else:
         print("menu_screen value not recognized.")
 
+    frame_timer.draw(screen)
+    frame_timer.mark("render")
     pygame.display.update()
+    frame_timer.mark("display")
 
     # Exchange information for the current game frame with the server.
-    if menu_screen < 0 and client_anim_key is not None:     # Actual gameplay.
+    if menu_screen < 0 and client_anim_key is not None and world is None:     # Actual gameplay.
+        if frames is not None and not frames.taken():
+            frames.close()                  # Released by the server. The frames go through the network again.
+            frames = None
         try:
-            frame_data = s.recv(2048)
-            (server_anim_key, server_anim_index, server_flipped, (server_x, server_y), server_attacks, hp, slimes,
-             new_swords, stop_gameplay) = jo.decode_frame_data(frame_data)
-            if len(new_swords) > len(swords):
-                jo.ding_sound.play()
-            swords = new_swords
+            # Over shared memory, the latest frame of the server if there is a new one, without waiting for it.
+            frame_data = frames.latest() if frames is not None else net_stats.recv(conn, 2048)
+            if frame_data is not None:
+                (server_anim_key, server_anim_index, server_flipped, (server_x, server_y), server_attacks, hp, slimes,
+                 new_swords, stop_gameplay, stamp, echo) = jo.decode_frame_data(frame_data)
+                net_stats.decoded(stamp, echo)
+                if len(new_swords) > len(swords):
+                    jo.ding_sound.play()
+                swords = new_swords
         except socket.error:                 # Will occur if the server shuts down mid-play.
             print("Failed to receive frame update information from server.")
         except decoder.JSONDecodeError:      # Will occur with an empty message.
             print("Failed to decode frame update information from server.")
+            net_stats.decode_error()
+        stamp, echo = net_stats.stamps()
         frame_data = jo.encode_frame_data(client_anim_key, client_anim_index, client_flipped,
-                                          (client_x, client_y), client_attacks)
+                                          (client_x, client_y), client_attacks, stamp=stamp, echo=echo)
         try:
-            s.sendall(frame_data)
+            if frames is not None:
+                frames.publish(frame_data)
+            else:
+                net_stats.send(conn, frame_data)
         except socket.error:
             print("Failed to send frame update information to server.")
+    frame_timer.mark("network")
 
     # Handle transition from gameplay to next level screen or to end game screen.
     if stop_gameplay:
         stop_gameplay = False
+        net_stats.pause()
         movement_active = False
         attack_active = False
         pygame.mixer.music.stop()
@@ -420,13 +559,14 @@ while run:
             victorious = False
         elif level_index == 0:          # Level cleared.
             menu_screen = 4
+            jo.victory_sound.play()
         else:                           # Victory.
             menu_screen = 5
             victorious = True
 
     # Handle collisions with swords and enemies.
     # Must run after the frame data exchange with the server, otherwise it will trigger twice.
-    if menu_screen < 0:     # Actual gameplay.
+    if menu_screen < 0 and world is None:     # Actual gameplay.
         # Check if a sword was picked.
         sword_rects = jo.draw_swords(swords, level_index, screen)   # Redraw to get the updated rectangles.
         for sword_rect in sword_rects:
@@ -454,11 +594,22 @@ while run:
             client_immune_frame += 1
             if client_immune_frame >= immune_frames:
                 client_immune = False
+        frame_timer.mark("collisions")
+    frame_timer.end()
+    profiler.update(menu_screen, level_index, len(world.slimes) if world is not None else len(slimes))
 
 
 # Clean-up and shut down.
+handshake.close()
+if frames is not None:
+    frames.close()
 try:
+    if conn is not None:
+        conn.close()
     s.close()
 except socket.error:
     print("Error closing socket.")
+frame_timer.save()
+profiler.stop()
+net_stats.log(force=True)
 pygame.quit()
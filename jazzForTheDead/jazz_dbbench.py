@@ -0,0 +1,200 @@
+""" Bulk import and query benchmark of the "Jazz for the dead!" highscore database.
+
+Merge the scores of several event machines into one database, or fill one with millions of synthetic scores, then time
+the queries the servers run at the end of a game (see jazz_leaderboard) against it.
+
+Scores are imported in large batches, each in a single transaction, and merged the same way the game records them: the
+best score of every team is kept and scores with a time also go into the history and the daily and weekly leaderboards.
+Input files are either CSV, with a name, score and optional time column (seconds since the epoch) and an optional
+header, or JSON Lines, with one {"name": ..., "score": ..., "time": ...} object per line.
+
+The benchmark works on a copy of the database, unless told otherwise, and times every query on its own:
+    record      Add a score to the history and the best scores of every window, in its own transaction.
+    top         Read the best teams of a window.
+    rank        Count the teams of a window with a score equal to or higher than a given one.
+    submit      All of the above in a single transaction, as submit_score() does.
+    memory      Submit a score to a Leaderboard loaded in memory, as the servers do.
+
+Usage:
+    python jazz_dbbench.py import event1.csv event2.jsonl --db merged.sqlite
+    python jazz_dbbench.py import --synthetic 1000000 --teams 200000 --db big.sqlite
+    python jazz_dbbench.py bench --db big.sqlite --queries 2000
+"""
+
+import jazz_leaderboard as jl
+from jazz_dbstress import percentile
+import argparse
+import csv
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from random import Random
+
+BATCH_ROWS = 50000          # Scores imported per transaction.
+SYNTHETIC_DAYS = 28         # Synthetic scores are spread over this many days before now.
+SYNTHETIC_MEAN = 150        # Mean synthetic score, close to the scores of real games.
+
+
+def parse_score(value):
+    """ Return a score of an imported file as an int. Raise ValueError if it is not one the leaderboard accepts. """
+    score = int(value)
+    if not jl.is_valid_score(score):
+        raise ValueError("Score out of range: " + str(score))
+    return score
+
+
+def read_rows(path):
+    """ Yield the team names (strings), scores (ints) and times (floats, None if not given) in a CSV or JSON Lines
+    file. Rows that cannot be read, or with a score out of range (see jazz_leaderboard.MAX_SCORE), are skipped with a
+    message. """
+    with open(path, newline="", encoding="utf-8") as file:
+        if path.endswith(".jsonl") or path.endswith(".json"):
+            for line_num, line in enumerate(file, 1):
+                if line.strip() == "":
+                    continue
+                try:
+                    entry = json.loads(line)
+                    timestamp = entry.get("time")
+                    timestamp = None if timestamp is None else float(timestamp)
+                    yield str(entry["name"]), parse_score(entry["score"]), timestamp
+                except (ValueError, OverflowError, KeyError, TypeError, AttributeError):
+                    print("Skipped line " + str(line_num) + " of " + path + ".")
+        else:
+            for line_num, row in enumerate(csv.reader(file), 1):
+                try:
+                    timestamp = float(row[2]) if len(row) > 2 and row[2] != "" else None
+                    yield row[0], parse_score(row[1]), timestamp
+                except (ValueError, IndexError):
+                    if line_num > 1:        # Not the header.
+                        print("Skipped line " + str(line_num) + " of " + path + ".")
+
+
+def synthetic_rows(count, teams, seed=0):
+    """ Yield random team names, scores and times, spread over the last SYNTHETIC_DAYS days. """
+    rng = Random(seed)
+    now = time.time()
+    for _ in range(count):
+        yield ("team " + str(rng.randrange(teams)), int(rng.expovariate(1 / SYNTHETIC_MEAN)),
+               now - rng.uniform(0, SYNTHETIC_DAYS * 86400))
+
+
+def run_import(connection, rows):
+    """ Merge a batch of scores into the database, in a single transaction. Errors are raised. """
+    with connection:
+        jl.run_record(connection, [row for row in rows if row[2] is not None])
+        connection.executemany(jl.SQL_UPSERT_SCORE, [row[:2] for row in rows if row[2] is None])
+
+
+def ingest(connection, rows, batch=BATCH_ROWS):
+    """ Merge scores into the database in batches. Return the number of scores merged. """
+    count = 0
+    start = time.perf_counter()
+    pending = []
+    for row in rows:
+        pending.append(row)
+        if len(pending) == batch:
+            jl.retry_busy(run_import, connection, pending)
+            count += len(pending)
+            pending = []
+            print("Imported " + str(count) + " scores, " + str(round(count / (time.perf_counter() - start))) +
+                  " per second.")
+    jl.retry_busy(run_import, connection, pending)
+    return count + len(pending)
+
+
+def timed(function, *args):
+    """ Call a function and return the time it took, in milliseconds. """
+    start = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def print_latencies(name, latencies):
+    """ Print the percentiles of the latencies (in milliseconds) of a query. """
+    latencies = sorted(latencies)
+    print(name.ljust(14) + "p50 " + format(percentile(latencies, 0.5), ".3f").rjust(8) + "   p90 " +
+          format(percentile(latencies, 0.9), ".3f").rjust(8) + "   p99 " +
+          format(percentile(latencies, 0.99), ".3f").rjust(8) + "   max " + format(latencies[-1], ".3f").rjust(8) +
+          " ms")
+
+
+def bench(db_path, queries, seed=0):
+    """ Time the queries run at the end of a game against a database, for every window. """
+    rng = Random(seed)
+    connection = jl.init_database(db_path)
+    teams = connection.execute("SELECT COUNT(*) FROM teams;").fetchone()[0]
+    history = connection.execute("SELECT COUNT(*) FROM score_history;").fetchone()[0]
+    print("Database: " + str(teams) + " teams, " + str(history) + " scores in the history.")
+    scores = [int(rng.expovariate(1 / SYNTHETIC_MEAN)) for _ in range(queries)]
+    names = ["bench " + str(rng.randrange(queries)) for _ in range(queries)]
+    print_latencies("record", [timed(jl.run_batch, connection, [(name, score, time.time())])
+                               for name, score in zip(names, scores)])
+    for window in jl.WINDOWS:
+        print_latencies("top " + window, [timed(jl.run_top, connection, window) for _ in range(queries)])
+        print_latencies("rank " + window, [timed(jl.run_rank, connection, window, score) for score in scores])
+        print_latencies("submit " + window, [timed(jl.run_submit, connection, name, score, window)
+                                             for name, score in zip(names, scores)])
+    connection.close()
+    for window in jl.WINDOWS:
+        start = time.perf_counter()
+        leaderboard = jl.Leaderboard(db_path, window)
+        print("Loaded the " + window + " leaderboard in " + format(time.perf_counter() - start, ".2f") + " seconds.")
+        print_latencies("memory " + window, [timed(leaderboard.submit_score, name, score)
+                                             for name, score in zip(names, scores)])
+        leaderboard.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import and query benchmark of the Jazz for the dead! database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="merge scores from files or synthetic ones into a database")
+    import_parser.add_argument("files", nargs="*", help="CSV or JSON Lines (.jsonl) files of scores")
+    import_parser.add_argument("--synthetic", type=int, default=0, metavar="COUNT", help="also import random scores")
+    import_parser.add_argument("--teams", type=int, help="distinct teams of the random scores (default: COUNT)")
+    import_parser.add_argument("--batch", type=int, default=BATCH_ROWS, help="scores per transaction")
+    import_parser.add_argument("--seed", type=int, default=0)
+    bench_parser = subparsers.add_parser("bench", help="time the end of game queries")
+    bench_parser.add_argument("--queries", type=int, default=1000, help="runs of every query")
+    bench_parser.add_argument("--in-place", action="store_true", help="write to the database instead of a copy")
+    bench_parser.add_argument("--seed", type=int, default=0)
+    for subparser in (import_parser, bench_parser):
+        subparser.add_argument("--db", required=True, help="path of the database")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        connection = jl.init_database(args.db)
+        start = time.perf_counter()
+        count = 0
+        for path in args.files:
+            try:
+                count += ingest(connection, read_rows(path), args.batch)
+            except OSError:
+                print("Failed to read " + path + ".")
+        if args.synthetic > 0:
+            count += ingest(connection, synthetic_rows(args.synthetic, args.teams or args.synthetic, args.seed),
+                            args.batch)
+        connection.close()
+        print("Imported " + str(count) + " scores in " + format(time.perf_counter() - start, ".1f") + " seconds.")
+        return
+
+    if args.in_place:
+        bench(args.db, args.queries, args.seed)
+        return
+    copy_dir = tempfile.mkdtemp()
+    try:
+        copy_path = os.path.join(copy_dir, "bench.sqlite")
+        source = sqlite3.connect(args.db)
+        target = sqlite3.connect(copy_path)
+        source.backup(target)       # Consistent, even while a server writes to the database.
+        source.close()
+        target.close()
+        bench(copy_path, args.queries, args.seed)
+    finally:
+        shutil.rmtree(copy_dir)
+
+
+if __name__ == "__main__":
+    main()
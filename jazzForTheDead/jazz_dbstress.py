@@ -0,0 +1,137 @@
+""" Concurrency stress test of the "Jazz for the dead!" highscore database.
+
+Hammer a LeaderboardStore (see jazz_leaderboard) from many threads, optionally in several processes, each with its own
+store, the way many matches finishing at once would. Every thread keeps submitting random scores for a fixed set of team
+names and reading the top teams and ranks, for a fixed time. Then report:
+    throughput      Operations per second, for writes and reads.
+    latency         Percentiles of the time of each operation, retries included.
+    busy retries    Queries retried because another process held the database locked, and operations that failed.
+    consistency     Whether the database holds the best score submitted for every team, and nothing else.
+
+Usage:
+    python jazz_dbstress.py --threads 16 --seconds 10                  Stress a throwaway database.
+    python jazz_dbstress.py --processes 4 --threads 8 --db stress.sqlite
+"""
+
+import jazz_leaderboard as jl
+import jazz_metrics
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from random import Random
+
+
+def hammer(store, seed, teams, read_ratio, deadline, results):
+    """ Submit scores and read the leaderboard until the deadline. Blocking. Append the statistics to results. """
+    rng = Random(seed)
+    best = {}                   # Best score submitted by this thread, by team name.
+    latencies = {"write": [], "top": [], "rank": []}
+    errors = 0
+    while time.perf_counter() < deadline:
+        roll = rng.random()
+        start = time.perf_counter()
+        try:
+            if roll >= read_ratio:
+                team_name = "team " + str(rng.randrange(teams))
+                score = rng.randrange(100000)
+                store.submit_score(team_name, score)
+                best[team_name] = max(score, best.get(team_name, -1))
+                kind = "write"
+            elif roll < read_ratio / 2:
+                store.top_teams()
+                kind = "top"
+            else:
+                store.rank(rng.randrange(100000))
+                kind = "rank"
+        except sqlite3.Error as e:
+            print("Operation failed: " + e.sqlite_errorname)
+            errors += 1
+            continue
+        latencies[kind].append(time.perf_counter() - start)
+    results.append({"best": best, "latencies": latencies, "errors": errors})
+
+
+def run_process(db_path, threads, seed, teams, read_ratio, seconds):
+    """ Hammer the database from several threads sharing a single store. Return the statistics of all threads and the
+    busy retries of this process. """
+    store = jl.LeaderboardStore(db_path)
+    results = []
+    deadline = time.perf_counter() + seconds
+    workers = [threading.Thread(target=hammer, args=(store, seed + index, teams, read_ratio, deadline, results))
+               for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    store.close()
+    retries = sum(jazz_metrics.DB_BUSY_RETRIES.snapshot()[4].values())
+    return results, retries
+
+
+def percentile(values, fraction):
+    """ Return the value below which the given fraction of the sorted values falls. """
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def report(results, retries, seconds, db_path, initial):
+    """ Print the statistics of a stress test and check the database. Return whether it is consistent. """
+    for kind in ("write", "top", "rank"):
+        latencies = sorted(latency * 1000 for result in results for latency in result["latencies"][kind])
+        if len(latencies) == 0:
+            continue
+        print(kind.ljust(6) + str(round(len(latencies) / seconds)).rjust(8) + " ops/s   p50 " +
+              format(percentile(latencies, 0.5), ".2f") + " ms, p99 " + format(percentile(latencies, 0.99), ".2f") +
+              " ms, max " + format(latencies[-1], ".2f") + " ms")
+    print("Busy retries: " + str(retries) + ", failed operations: " + str(sum(result["errors"] for result in results)))
+    expected = dict(initial)
+    for result in results:
+        for team_name, score in result["best"].items():
+            expected[team_name] = max(score, expected.get(team_name, -1))
+    connection = jl.db_connect(db_path)
+    stored = dict(jl.run_read(connection, jl.SQL_SELECT_ALL))
+    connection.close()
+    if stored != expected:
+        wrong = [team_name for team_name in expected if stored.get(team_name) != expected[team_name]]
+        print("Inconsistent database: " + str(len(wrong)) + " teams with a wrong best score, " +
+              str(len(stored) - len(expected)) + " unexpected teams.")
+        return False
+    print("Database consistent: " + str(len(stored)) + " teams.")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrency stress test of the Jazz for the dead! database")
+    parser.add_argument("--db", help="database to stress (default: a throwaway one)")
+    parser.add_argument("--processes", type=int, default=1, help="processes, each with its own connections")
+    parser.add_argument("--threads", type=int, default=16, help="threads per process")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--teams", type=int, default=10000, help="number of distinct team names")
+    parser.add_argument("--read-ratio", type=float, default=0.8, help="fraction of operations that only read")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), "stress.sqlite")
+    connection = jl.init_database(db_path)
+    initial = jl.run_read(connection, jl.SQL_SELECT_ALL)
+    connection.close()
+    print("Stressing " + db_path + " with " + str(args.processes) + " x " + str(args.threads) + " threads for " +
+          str(args.seconds) + " seconds.")
+
+    jobs = [(db_path, args.threads, args.seed + index * args.threads, args.teams, args.read_ratio, args.seconds)
+            for index in range(args.processes)]
+    if args.processes == 1:
+        batches = [run_process(*jobs[0])]
+    else:
+        with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+            batches = pool.starmap(run_process, jobs)
+    results = [result for batch in batches for result in batch[0]]
+    if not report(results, sum(batch[1] for batch in batches), args.seconds, db_path, initial):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+""" Dedicated server script for the "Jazz for the dead!" game.
+
+Accept clients from the network into a lobby, where they are paired into matches (see jazz_lobby). Hand each match to
+the least loaded of a pool of worker processes, so that the simulation scales with the number of CPU cores. Every
+worker runs its matches headless, each on its own thread. Final scores are funnelled back to this process, which is the
+only one writing to the database.
+"""
+
+import os
+
+# Dedicated servers have neither a screen nor speakers. Must be set before pygame is initialized.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+# SDL would turn SIGTERM into a quit event that nobody reads, so that only SIGKILL could stop the server.
+os.environ.setdefault("SDL_NO_SIGNAL_HANDLERS", "1")
+
+import jazz_operations as jo
+import jazz_leaderboard as jl
+import jazz_metrics
+from jazz_lobby import Lobby
+from jazz_match import Match
+from jazz_replay import ReplayWriter
+import jazz_telemetry
+import argparse
+import multiprocessing
+from multiprocessing import reduction
+import queue
+import signal
+import socket
+import threading
+import time
+
+HOST = "0.0.0.0"                                    # Address used to listen to all possible connections on LAN.
+METRICS_INTERVAL = 1                                # Time (in seconds) between two metrics reports of a worker.
+LEADERBOARD_TIMEOUT = 5                             # Time (in seconds) a match waits for the leaderboard data.
+
+
+def new_recorder(replays_dir, code):
+    """ Return a writer for the replay of a new match, or None if matches are not recorded. """
+    if replays_dir is None:
+        return None
+    os.makedirs(replays_dir, exist_ok=True)
+    return ReplayWriter(os.path.join(replays_dir, time.strftime("%Y%m%d-%H%M%S") + "-" + code + ".jftd"))
+
+
+def worker_main(worker_id, pipe, results, replays_dir, report_metrics=False, telemetry_dir=None):
+    """ Run the matches handed off by the acceptor, until told to stop.
+
+    Parameters:
+        worker_id (int): Index of this worker in the pool.
+        pipe (multiprocessing.connection.Connection): Receives matches, their sockets and leaderboard replies.
+        results (multiprocessing.Queue): Shared with all workers. Carries scores, finished matches and metrics to the
+            acceptor.
+        replays_dir (string): Directory where the replays of the matches are saved. None to not record them.
+        report_metrics (boolean): Whether to send a snapshot of the metrics every METRICS_INTERVAL seconds.
+        telemetry_dir (string): Directory where the telemetry of the matches is saved. None to not record it.
+    """
+
+    pending = {}        # Queues of the matches waiting for leaderboard data, by match id.
+    matches = {}        # Running matches, by match id.
+    telemetry = jazz_telemetry.new_log(telemetry_dir, "worker" + str(worker_id))
+
+    def leaderboard_for(match_id):
+        def submit(team_name, final_score):
+            reply = queue.Queue(1)
+            pending[match_id] = reply
+            results.put(("score", worker_id, match_id, team_name, final_score))
+            try:
+                return reply.get(timeout=LEADERBOARD_TIMEOUT)
+            except queue.Empty:
+                pending.pop(match_id, None)
+                print("No leaderboard data for match " + str(match_id) + ".")
+                return [], None, "all"
+        return submit
+
+    def run_match(match_id, match):
+        try:
+            match.run()
+        finally:                    # Even if the match failed, so that the acceptor does not count it forever.
+            matches.pop(match_id, None)
+            results.put(("done", worker_id, match_id))
+
+    last_report = time.perf_counter()
+    while True:
+        if report_metrics:
+            now = time.perf_counter()
+            if now - last_report >= METRICS_INTERVAL:
+                last_report = now
+                results.put(("metrics", worker_id, jazz_metrics.REGISTRY.snapshot()))
+            if not pipe.poll(last_report + METRICS_INTERVAL - now):
+                continue
+        message = pipe.recv()
+        if message[0] == "match":
+            match_id, code, team_name = message[1:]
+            conns = [socket.socket(fileno=reduction.recv_handle(pipe)) for _ in range(2)]
+            match = Match(conns, team_name, leaderboard_for(match_id), recorder=new_recorder(replays_dir, code),
+                          name=code, telemetry=telemetry.match() if telemetry is not None else None)
+            matches[match_id] = match
+            threading.Thread(target=run_match, args=(match_id, match), daemon=True).start()
+        elif message[0] == "spectator":
+            conn = socket.socket(fileno=reduction.recv_handle(pipe))
+            match = matches.get(message[1])
+            if match is None:       # Ended in the meantime.
+                conn.close()
+            else:
+                match.broadcaster.add(conn)
+        elif message[0] == "leaderboard":
+            reply = pending.pop(message[1], None)
+            if reply is not None:           # Unless the match gave up waiting.
+                reply.put(message[2:])
+        elif message[0] == "stop":
+            break
+    if telemetry is not None:
+        telemetry.close()
+
+
+def greet_spectator(conn, code):
+    """ Confirm to a spectator that the lobby found the match, as described in jazz_lobby. Close the connection and
+    return 'False' if it failed. """
+    try:
+        conn.sendall(("WATCHING " + code + "\n").encode())
+        return True
+    except socket.error:
+        conn.close()
+        return False
+
+
+class WorkerPool:
+    def __init__(self, workers_num, replays_dir=None, report_metrics=False, telemetry_dir=None):
+        """ Start the worker processes. """
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue()
+        self.pipes = []
+        self.pipe_locks = []            # The acceptor and the database writer both send on the pipes.
+        self.processes = []
+        self.loads = [0] * workers_num  # Number of active matches, per worker.
+        self.loads_lock = threading.Lock()     # Also guards the running matches.
+        self.match_id = 0
+        self.live = {}                  # Worker and match id of the running matches, by room code.
+        self.codes = {}                 # Room codes of the running matches, by match id.
+        self.worker_metrics = {}        # Latest metrics snapshot, by worker id.
+        self.dead = set()               # Ids of the workers whose process ended.
+        for worker_id in range(workers_num):
+            parent_end, child_end = context.Pipe()
+            process = context.Process(target=worker_main, args=(worker_id, child_end, self.results, replays_dir,
+                                                                report_metrics, telemetry_dir), daemon=True)
+            process.start()
+            self.pipes.append(parent_end)
+            self.pipe_locks.append(threading.Lock())
+            self.processes.append(process)
+
+    def hand_off(self, code, team_name, conns):
+        """ Pass a new match and the sockets of its clients to the least loaded worker. """
+        self.match_id += 1
+        match_id = self.match_id
+        with self.loads_lock:
+            workers = self.alive_workers()
+            if len(workers) == 0:
+                print("No worker left to run match " + code + ".")
+                for conn in conns:
+                    conn.close()
+                return
+            worker_id = min(workers, key=lambda i: self.loads[i])
+            self.loads[worker_id] += 1
+            self.live[code] = (worker_id, match_id)
+            self.codes[match_id] = code
+        try:
+            with self.pipe_locks[worker_id]:
+                self.pipes[worker_id].send(("match", match_id, code, team_name))
+                for conn in conns:
+                    reduction.send_handle(self.pipes[worker_id], conn.fileno(), self.processes[worker_id].pid)
+        except OSError:
+            print("Failed to hand match " + code + " to worker " + str(worker_id) + ".")
+            with self.loads_lock:
+                self.end_match(match_id)
+        finally:
+            for conn in conns:
+                conn.close()        # The worker holds its own duplicates.
+
+    def alive_workers(self):
+        """ Return the ids of the workers still running, dropping those that ended and their matches. Must be called
+        with loads_lock held. """
+        for worker_id, process in enumerate(self.processes):
+            if worker_id not in self.dead and not process.is_alive():
+                print("Worker " + str(worker_id) + " stopped unexpectedly.")
+                self.dead.add(worker_id)
+                for match_id in [match_id for match_id, code in self.codes.items()
+                                 if self.live[code][0] == worker_id]:
+                    self.end_match(match_id)
+        return [worker_id for worker_id in range(len(self.processes)) if worker_id not in self.dead]
+
+    def end_match(self, match_id):
+        """ Forget a match that ended, if it was not forgotten already. Must be called with loads_lock held. """
+        code = self.codes.pop(match_id, None)
+        if code is not None:
+            self.loads[self.live.pop(code)[0]] -= 1
+
+    def add_spectator(self, code, conn):
+        """ Pass a spectator to the worker running the match of the given room. Return 'False' if there is none. """
+        with self.loads_lock:
+            self.alive_workers()
+            if code not in self.live:
+                return False
+            worker_id, match_id = self.live[code]
+        if greet_spectator(conn, code):
+            try:
+                with self.pipe_locks[worker_id]:
+                    self.pipes[worker_id].send(("spectator", match_id))
+                    reduction.send_handle(self.pipes[worker_id], conn.fileno(), self.processes[worker_id].pid)
+            except OSError:
+                print("Failed to hand a spectator to worker " + str(worker_id) + ".")
+        conn.close()
+        return True
+
+    def write_results(self, leaderboard):
+        """ Serve the scores of finished matches from all workers, as the single writer of the leaderboard.
+        Blocking. """
+        while True:
+            message = self.results.get()
+            try:
+                self.handle_result(leaderboard, message)
+            except Exception as e:      # Any error: the other matches still need their leaderboard data.
+                print("Failed to handle a " + str(message[0]) + " message of a worker: " + repr(e))
+
+    def handle_result(self, leaderboard, message):
+        """ Serve a single message of a worker. Errors are raised. """
+        if message[0] == "score":
+            worker_id, match_id, team_name, final_score = message[1:]
+            top_teams, team_rank = leaderboard.submit_score(team_name, final_score)
+            with self.pipe_locks[worker_id]:
+                self.pipes[worker_id].send(("leaderboard", match_id, top_teams, team_rank, leaderboard.window))
+        elif message[0] == "done":
+            with self.loads_lock:
+                self.end_match(message[2])
+        elif message[0] == "metrics":
+            self.worker_metrics[message[1]] = message[2]
+
+    def metrics_sources(self):
+        """ Return the metrics of this process and the latest ones of every worker, as expected by
+        jazz_metrics.render(). """
+        sources = [(jazz_metrics.REGISTRY.snapshot(), ())]
+        for worker_id, snapshot in sorted(self.worker_metrics.items()):
+            sources.append((snapshot, (("worker", worker_id),)))
+        return sources
+
+    def stop(self):
+        """ Ask all workers to stop. Matches still running are dropped. """
+        for pipe, lock in zip(self.pipes, self.pipe_locks):
+            try:
+                with lock:
+                    pipe.send(("stop",))
+            except OSError:
+                pass                    # Stopped already.
+
+
+class LocalPool:
+    def __init__(self, replays_dir=None, telemetry_dir=None):
+        """ Stand-in for WorkerPool that runs every match on a thread of this process, e.g. for tests. """
+        self.replays_dir = replays_dir
+        self.telemetry = jazz_telemetry.new_log(telemetry_dir, "local")
+        self.requests = queue.Queue()
+        self.live = {}                  # Running matches, by room code.
+
+    def hand_off(self, code, team_name, conns):
+        """ Start a new match on its own thread. """
+        self.live[code] = Match(conns, team_name, self.submit, recorder=new_recorder(self.replays_dir, code),
+                                name=code, telemetry=self.telemetry.match() if self.telemetry is not None else None)
+        threading.Thread(target=self.run_match, args=(code,), daemon=True).start()
+
+    def run_match(self, code):
+        """ Run a match until it ends. Blocking. """
+        try:
+            self.live[code].run()
+        finally:
+            del self.live[code]
+
+    def add_spectator(self, code, conn):
+        """ Add a spectator to the match of the given room. Return 'False' if there is none. """
+        match = self.live.get(code)
+        if match is None:
+            return False
+        if greet_spectator(conn, code):
+            match.broadcaster.add(conn)
+        return True
+
+    def submit(self, team_name, final_score):
+        """ Pass a score to the database writer and wait for the leaderboard data. """
+        reply = queue.Queue(1)
+        self.requests.put((team_name, final_score, reply))
+        try:
+            return reply.get(timeout=LEADERBOARD_TIMEOUT)
+        except queue.Empty:
+            print("No leaderboard data for team '" + team_name + "'.")
+            return [], None, "all"
+
+    def write_results(self, leaderboard):
+        """ Serve the scores of finished matches, as the single writer of the leaderboard. Blocking. """
+        while True:
+            team_name, final_score, reply = self.requests.get()
+            try:
+                top_teams, team_rank = leaderboard.submit_score(team_name, final_score)
+            except Exception as e:      # Any error: the other matches still need their leaderboard data.
+                print("Failed to submit the score of team '" + team_name + "': " + repr(e))
+                top_teams, team_rank = [], None
+            reply.put((top_teams, team_rank, leaderboard.window))
+
+    def metrics_sources(self):
+        """ Return the metrics of this process, which runs every match, as expected by jazz_metrics.render(). """
+        return [(jazz_metrics.REGISTRY.snapshot(), ())]
+
+    def stop(self):
+        """ Write the telemetry still buffered. Match threads end with the process. """
+        if self.telemetry is not None:
+            self.telemetry.close()
+
+
+def stop_on_signal(signum, frame):
+    """ Shut down cleanly on SIGTERM, e.g. from systemd or docker, as on Ctrl+C. """
+    raise KeyboardInterrupt
+
+
+def raise_file_limit():
+    """ Allow as many open connections as the system permits, for lobbies with thousands of idle clients. """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        print("Could not raise the limit of open connections.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dedicated server for Jazz for the dead!")
+    parser.add_argument("--port", type=int, default=jo.PORT)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument("--db", default=jo.DATABASE_DIR + "highscore_db.sqlite", help="path of the database")
+    parser.add_argument("--local", action="store_true", help="run matches on threads instead of worker processes")
+    parser.add_argument("--record", nargs="?", const=jo.REPLAYS_DIR, metavar="DIR",
+                        help="save a replay of every match (default directory: " + jo.REPLAYS_DIR + ")")
+    parser.add_argument("--telemetry", nargs="?", const=jo.TELEMETRY_DIR, metavar="DIR",
+                        help="save the gameplay telemetry of every match (default directory: " + jo.TELEMETRY_DIR + ")")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics at 127.0.0.1:PORT/metrics")
+    parser.add_argument("--window", choices=jl.WINDOWS, default="all",
+                        help="leaderboard shown after every match: all-time, of the week or of the day")
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    if args.local:
+        pool = LocalPool(args.record, args.telemetry)
+    else:
+        pool = WorkerPool(args.workers, args.record, args.metrics_port is not None, args.telemetry)
+    leaderboard = jl.Leaderboard(args.db, args.window)
+    threading.Thread(target=pool.write_results, args=(leaderboard,), daemon=True).start()
+    if args.metrics_port is not None:
+        metrics_server = jazz_metrics.MetricsServer(args.metrics_port, pool.metrics_sources)
+        threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+        print("Metrics served on port " + str(args.metrics_port) + ".")
+
+    # Set-up network connection.
+    raise_file_limit()
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((HOST, args.port))
+    s.listen(socket.SOMAXCONN)
+    print("Lobby listening on port " + str(args.port) + ".")
+
+    lobby = Lobby(pool.hand_off, pool.add_spectator, s)
+    try:
+        lobby.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down.")
+    finally:
+        pool.stop()
+        s.close()
+        leaderboard.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+""" End-to-end frame budget check for the "Jazz for the dead!" game.
+
+Play a complete game between jazz_server.py and jazz_client.py, headless and on a local port, from a recorded input
+script: through every menu screen, both levels and the leaderboard write. The scripts run unmodified, in their own
+processes, with pygame input replaced by the script and their clocks timed. Each frame is timed from the end of one
+frame cap wait to the start of the next, minus the time spent blocked on the network or in deliberate delays, since
+those wait on the other side or on the player rather than on rendering and simulation.
+
+The input script holds the seed of the random events and the keys pressed by each side on every gameplay frame, so the
+game plays the same on every run. The check fails if the 99th percentile of any phase of the game takes longer than a
+frame at FPS_CAP, or if the game did not reach the leaderboard after both levels. Both sides run on the same machine,
+so it needs at least two CPU cores for the frame times to reflect a real game.
+
+Usage:
+    python jazz_framebudget.py run [--inputs FILE]                  Replay the input script and check the frame times.
+    python jazz_framebudget.py record [--inputs FILE] [--seed N]    Play a new game with bots and save its inputs.
+"""
+
+import os
+
+# Runs on machines without a screen or speakers. Must be set before pygame is initialized.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import jazz_operations as jo
+import jazz_bot
+import jazz_lockstep as jls
+import argparse
+import json
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import pygame
+
+FPS_CAP = 60
+FRAME_BUDGET = 1000 / FPS_CAP       # Time (in milliseconds) available for each frame.
+INPUTS_PATH = "benchmarks/frame_budget_inputs.json"
+TEST_PORT = 2010                    # Different from the default port, to not interfere with a real game.
+MASK_CHARS = "0123456789abcdefghijklmnopqrstuv"     # One character per frame, for every key mask of jazz_lockstep.
+HOST_IP = "127.0.0.1"
+START_BUTTON_POS = (960, 800)       # Within the start button of the server.
+CLICK_DELAY = 0.5                   # Time (in seconds) on a menu screen before the server clicks start, like a player.
+LEADERBOARD_FRAMES = 60             # Frames to show the leaderboard for, before quitting.
+READY_TIMEOUT = 10                  # Time (in seconds) to wait for the server to start listening.
+PHASES = ["menu 1", "menu 2", "menu 3", "level 1", "menu 4", "level 2", "menu 5"]
+KEY_BITS = [(jls.KEY_LEFT, pygame.K_LEFT), (jls.KEY_RIGHT, pygame.K_RIGHT), (jls.KEY_UP, pygame.K_UP),
+            (jls.KEY_DOWN, pygame.K_DOWN), (jls.KEY_ATTACK, pygame.K_SPACE)]
+
+
+class PressedKeys:
+    def __init__(self, mask):
+        self.keys = [key for bit, key in KEY_BITS if mask & bit]
+
+    def __getitem__(self, key):
+        return key in self.keys
+
+
+class Driver:
+    def __init__(self, role, inputs, record, fps):
+        """ Prepare to play one side of the game.
+
+        Parameters:
+            role (string): Either 'server' or 'client'.
+            inputs (dict): The input script, as saved by record.
+            record (boolean): Whether to pick the keys with the bot strategy of jazz_bot, instead of the input script.
+            fps (int): Frame cap to use instead of the one of the script. None to keep it, 0 to run uncapped.
+        """
+
+        self.role = role
+        self.inputs = inputs
+        self.masks = "" if record else inputs["masks"][role]
+        self.record = record
+        self.fps = fps
+        self.game = {"__name__": "__main__", "__file__": "jazz_" + role + ".py"}   # Globals of the script.
+        self.frames = []            # Phase, work and blocked time (in milliseconds) of every frame.
+        self.frame_start = None
+        self.blocked = 0            # Time (in seconds) blocked on the network or in delays, in the current frame.
+        self.phase = None
+        self.typed = 0              # Characters of the text input typed so far.
+        self.menu_start = None      # Time the current menu screen was entered.
+        self.menu = None
+        self.mask = 0               # Keys pressed on the current frame.
+        self.gameplay_frames = 0
+        self.leaderboard_frames = 0
+
+    def current_phase(self):
+        """ Return the name of the phase the script is in. """
+        menu_screen = self.game["menu_screen"]
+        if menu_screen > 0:
+            return "menu " + str(menu_screen)
+        return "level " + str(self.game["level_index"] + 1)
+
+    def start_frame(self):
+        self.frame_start = time.perf_counter()
+        self.blocked = 0
+        self.phase = self.current_phase()
+
+    def end_frame(self):
+        if self.frame_start is not None:
+            duration = time.perf_counter() - self.frame_start
+            self.frames.append((self.phase, (duration - self.blocked) * 1000, self.blocked * 1000))
+
+    def timed(self, function):
+        """ Wrap a blocking function, so that the time spent in it is not counted as frame work. """
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.blocked += time.perf_counter() - start
+        return wrapper
+
+    def type_text(self, text):
+        """ Return the key event for the next character of the text, or Enter once it is complete. """
+        if self.typed < len(text):
+            char = text[self.typed]
+            key = pygame.K_PERIOD if char == "." else ord(char)
+        else:
+            char = "\r"
+            key = pygame.K_RETURN
+        self.typed += 1
+        return pygame.event.Event(pygame.KEYDOWN, key=key, unicode=char)
+
+    def choose_keys(self):
+        """ Pick the keys of the current gameplay frame with the bot strategy. """
+        prefix = self.role + "_"
+        pos = (self.game[prefix + "x"], self.game[prefix + "y"])
+        rect = jo.teammate_rect("idle", 0, self.game[prefix + "role"], pos, False)
+        return jazz_bot.choose_keys(rect, self.game[prefix + "attacks"], self.game["slimes"], self.game["swords"],
+                                    self.game["level_index"])
+
+    def get_events(self, get_events):
+        """ Return the events of the current frame, with the input of the script added. Replaces pygame.event.get. """
+        events = list(get_events())
+        menu_screen = self.game.get("menu_screen")
+        input_active = self.game.get("input_active")
+        if menu_screen != self.menu:
+            self.menu = menu_screen
+            self.menu_start = time.perf_counter()
+        self.mask = 0
+        if self.role == "server" and menu_screen == 2 and input_active:
+            events.append(self.type_text(self.inputs["team_name"]))
+        elif self.role == "client" and menu_screen == 1 and input_active:
+            events.append(self.type_text(HOST_IP))
+        elif (self.role == "server" and menu_screen in (3, 4) and self.game.get("start_active") and
+              time.perf_counter() - self.menu_start >= CLICK_DELAY):
+            events.append(pygame.event.Event(pygame.MOUSEBUTTONUP, button=1, pos=START_BUTTON_POS))
+        elif menu_screen is not None and menu_screen < 0:
+            if self.record:
+                self.mask = self.choose_keys()
+                self.masks += MASK_CHARS[self.mask]
+            elif self.gameplay_frames < len(self.masks):
+                self.mask = MASK_CHARS.index(self.masks[self.gameplay_frames])
+            self.gameplay_frames += 1
+        elif menu_screen == 5:
+            self.leaderboard_frames += 1
+            if self.leaderboard_frames > LEADERBOARD_FRAMES:
+                events.append(pygame.event.Event(pygame.QUIT))
+        return events
+
+    def play(self, port, db_dir, ready_path):
+        """ Run the script until it quits. Return the error that stopped it, or None if it quit normally. """
+        driver = self
+        real_clock = pygame.time.Clock
+        real_get_events = pygame.event.get
+        real_listen = socket.socket.listen
+
+        class TimedClock:
+            def __init__(self):
+                self.clock = real_clock()
+
+            def tick(self, framerate=0):
+                driver.end_frame()
+                self.clock.tick(framerate if driver.fps is None else driver.fps)
+                driver.start_frame()
+                return self.clock.get_time()
+
+        def listen(sock, *args):
+            real_listen(sock, *args)
+            open(ready_path, "w").close()       # Let the client connect.
+
+        jo.PORT = port
+        jo.DATABASE_DIR = db_dir
+        random.seed(self.inputs["seed"])
+        pygame.time.Clock = TimedClock
+        pygame.time.delay = self.timed(pygame.time.delay)
+        pygame.event.get = lambda *args, **kwargs: self.get_events(real_get_events)
+        pygame.key.get_pressed = lambda: PressedKeys(self.mask)
+        pygame.mouse.get_pos = lambda: START_BUTTON_POS
+        socket.socket.listen = listen
+        for name in ("recv", "accept", "connect"):
+            setattr(socket.socket, name, self.timed(getattr(socket.socket, name)))
+        try:
+            with open(self.game["__file__"]) as file:
+                exec(compile(file.read(), self.game["__file__"], "exec"), self.game)
+        except BaseException:
+            traceback.print_exc()
+            return traceback.format_exc().splitlines()[-1]
+        return None
+
+
+def drive(role, inputs_path, record, fps, port, db_dir, output_path):
+    """ Play one side of the game and save its frame times. Runs in a process of its own. """
+    with open(inputs_path) as file:
+        inputs = json.load(file)
+    driver = Driver(role, inputs, record, fps)
+    error = driver.play(port, db_dir, output_path + ".ready")
+    with open(output_path, "w") as file:
+        json.dump({"frames": driver.frames, "masks": driver.masks, "error": error}, file)
+
+
+def play_game(inputs_path, record, fps, port, timeout):
+    """ Play a whole game in two processes. Return the results of the server and the client, or None on failure. """
+    work_dir = tempfile.mkdtemp()
+    db_dir = os.path.join(work_dir, "")
+    database = os.path.join(os.path.dirname(os.path.abspath(__file__)), jo.DATABASE_DIR, "highscore_db.sqlite")
+    if os.path.exists(database):
+        shutil.copy(database, db_dir)       # Write to a copy of the real leaderboard.
+    processes = {}
+    logs = {}
+    try:
+        for role in ("server", "client"):
+            command = [sys.executable, os.path.abspath(__file__), "drive", role, inputs_path, "--port", str(port),
+                       "--db-dir", db_dir, "--output", os.path.join(work_dir, role + ".json")]
+            if record:
+                command.append("--record")
+            if fps is not None:
+                command += ["--fps", str(fps)]
+            logs[role] = os.path.join(work_dir, role + ".log")
+            with open(logs[role], "w") as log:
+                processes[role] = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT,
+                                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+            if role == "server":
+                deadline = time.perf_counter() + READY_TIMEOUT
+                while not os.path.exists(os.path.join(work_dir, "server.json.ready")):
+                    if processes[role].poll() is not None or time.perf_counter() > deadline:
+                        print("The server failed to start. See " + logs[role])
+                        return None
+                    time.sleep(0.1)
+        deadline = time.perf_counter() + timeout
+        for role, process in processes.items():
+            process.wait(max(0, deadline - time.perf_counter()))
+    except subprocess.TimeoutExpired:
+        print("The game did not end within " + str(timeout) + " seconds. See the logs in " + work_dir)
+        return None
+    finally:
+        for process in processes.values():
+            if process.poll() is None:
+                process.kill()
+    results = {}
+    for role in ("server", "client"):
+        try:
+            with open(os.path.join(work_dir, role + ".json")) as file:
+                results[role] = json.load(file)
+        except (OSError, ValueError):
+            print("The " + role + " stopped unexpectedly. See " + logs[role])
+            return None
+        if results[role]["error"] is not None:
+            print("The " + role + " failed with " + results[role]["error"] + " See " + logs[role])
+            return None
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def percentile(values, fraction):
+    """ Return the value below which the given fraction of the sorted values falls. """
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def is_complete(results):
+    """ Return whether both sides played both levels and reached the leaderboard. """
+    return all(phase in [frame[0] for frame in results[role]["frames"]] for role in results
+               for phase in ("level 2", "menu 5"))
+
+
+def report(results):
+    """ Print the frame times of both sides by phase. Return whether every phase fit the budget. """
+    passed = True
+    for role in ("server", "client"):
+        print(role.capitalize() + ":")
+        print("    " + "phase".ljust(10) + "frames".rjust(8) + "p50 ms".rjust(10) + "p99 ms".rjust(10) +
+              "max ms".rjust(10) + "blocked ms".rjust(12))
+        for phase in PHASES:
+            frames = [frame for frame in results[role]["frames"] if frame[0] == phase]
+            if len(frames) == 0:        # E.g. the client leaves menu 2 on the frame it enters it.
+                continue
+            work = sorted(frame[1] for frame in frames)
+            p99 = percentile(work, 0.99)
+            line = ("    " + phase.ljust(10) + str(len(frames)).rjust(8) +
+                    format(percentile(work, 0.5), ".2f").rjust(10) + format(p99, ".2f").rjust(10) +
+                    format(work[-1], ".2f").rjust(10) + format(sum(frame[2] for frame in frames), ".0f").rjust(12))
+            if p99 > FRAME_BUDGET:
+                line += "  OVER BUDGET"
+                passed = False
+            print(line)
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end frame budget check for Jazz for the dead!")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="replay the input script and check the frame times")
+    record_parser = subparsers.add_parser("record", help="play a new game with bots and save its inputs")
+    record_parser.add_argument("--seed", type=int, default=0, help="seed of the random events of the game")
+    record_parser.add_argument("--team", default="frame budget", help="team name, in lowercase letters and spaces")
+    for subparser in (run_parser, record_parser):
+        subparser.add_argument("--inputs", default=INPUTS_PATH, help="input script (default: " + INPUTS_PATH + ")")
+        subparser.add_argument("--fps", type=int, help="frame cap of both sides instead of FPS_CAP, 0 for none")
+        subparser.add_argument("--port", type=int, default=TEST_PORT)
+        subparser.add_argument("--timeout", type=float, default=900, help="time (in seconds) to give up after")
+    drive_parser = subparsers.add_parser("drive")      # Internal, one side of the game.
+    drive_parser.add_argument("role", choices=["server", "client"])
+    drive_parser.add_argument("inputs")
+    drive_parser.add_argument("--record", action="store_true")
+    drive_parser.add_argument("--fps", type=int)
+    drive_parser.add_argument("--port", type=int, required=True)
+    drive_parser.add_argument("--db-dir", required=True)
+    drive_parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    if args.command == "drive":
+        drive(args.role, args.inputs, args.record, args.fps, args.port, args.db_dir, args.output)
+        return
+    if (os.cpu_count() or 1) < 2:
+        print("Warning: both sides share a single CPU core, so their frame times include each other's.")
+    inputs_path = os.path.abspath(args.inputs)
+    if args.command == "record":
+        inputs_path = os.path.join(tempfile.mkdtemp(), "inputs.json")
+        with open(inputs_path, "w") as file:
+            json.dump({"seed": args.seed, "team_name": args.team}, file)
+    results = play_game(inputs_path, args.command == "record", args.fps, args.port, args.timeout)
+    if results is None:
+        raise SystemExit(1)
+    passed = report(results)
+    print("Frame budget: " + format(FRAME_BUDGET, ".1f") + " ms at the 99th percentile of each phase.")
+    if not is_complete(results):
+        if args.command == "record":
+            print("The game ended before both levels were played, so the inputs were not saved. Try another seed.")
+        else:
+            print("The game ended before both levels were played. Record the inputs again if the game changed.")
+        raise SystemExit(1)
+    if args.command == "record":
+        os.makedirs(os.path.dirname(args.inputs) or ".", exist_ok=True)
+        with open(args.inputs, "w") as file:
+            json.dump({"seed": args.seed, "team_name": args.team,
+                       "masks": {role: results[role]["masks"] for role in results}}, file)
+        print("Saved the inputs to " + args.inputs)
+    elif not passed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
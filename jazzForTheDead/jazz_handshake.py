@@ -0,0 +1,168 @@
+""" Non-blocking menu handshake for the "Jazz for the dead!" game.
+
+Before every level, the server and the client exchange a few short messages: the server accepts the client, which
+connects (and enters a room, on a dedicated server), then waits for the team name, its role, the start signal and the
+scores. Waiting for them on a blocking socket froze the waiting side, with no rendering and no way to quit.
+
+A Handshake runs one step of the exchange at a time, as a small state machine over a selector for the sockets and over
+the transports (see jazz_transport) for the messages, and the main loop polls it once per frame, so the menus keep
+running at the full frame rate and Escape always works. Each step goes from IDLE to WAITING, then to DONE with its
+result, or to FAILED if the connection broke, was closed or took longer than the timeout of the step. cancel() drops the
+step in progress, e.g. when the player quits. Sockets are only non-blocking while a step is in progress, so the gameplay
+code keeps using them as before.
+
+Menu messages are not delimited, so a side polling once per frame would get two messages sent in a row as one. Senders
+leave MESSAGE_GAP seconds between them, without blocking their own menus.
+"""
+
+import jazz_transport
+import errno
+import os
+import selectors
+import socket
+import time
+
+IDLE = "idle"
+WAITING = "waiting"
+DONE = "done"
+FAILED = "failed"
+CONNECT_TIMEOUT = 5         # Time (in seconds) to wait for the host to accept the connection.
+REPLY_TIMEOUT = 10          # Time (in seconds) to wait for a message that the other side sends on its own, e.g. scores.
+MESSAGE_GAP = 0.2           # Pause (in seconds) between menu messages, to prevent merging on the client.
+
+
+class Handshake:
+    def __init__(self):
+        """ Prepare a handshake with no step in progress. """
+        self.selector = selectors.DefaultSelector()
+        self.state = IDLE
+        self.step = None            # Either 'connect', 'accept' or 'receive'.
+        self.sock = None            # Socket of the connect or accept step in progress.
+        self.transport = None       # Transport of the receive step in progress (see jazz_transport).
+        self.deadline = None        # Time (as returned by time.perf_counter()) the step fails, None for no timeout.
+        self.line = False           # Whether the step receives a single line, without consuming what follows it.
+        self.data = b""             # Data received so far.
+        self.result = None          # Connection accepted or message received, once done.
+        self.error = None           # Reason of the failure, once failed.
+
+    def start(self, step, timeout, sock=None, events=None, transport=None):
+        """ Start waiting for a step on a socket or a transport, dropping the one in progress. """
+        self.cancel()
+        if sock is not None:
+            sock.setblocking(False)
+            self.selector.register(sock, events)
+        self.state = WAITING
+        self.step = step
+        self.sock = sock
+        self.transport = transport
+        self.deadline = time.perf_counter() + timeout if timeout is not None else None
+        self.data = b""
+
+    def poll(self):
+        """ Advance the step in progress as far as possible, without blocking. Return the state of the handshake. """
+        if self.state != WAITING:
+            return self.state
+        if self.transport is not None:
+            while self.state == WAITING and self.transport.poll():
+                self.advance()
+        else:
+            while self.state == WAITING and len(self.selector.select(0)) > 0:
+                self.advance()
+        if self.state == WAITING and self.deadline is not None and time.perf_counter() > self.deadline:
+            self.finish(FAILED, error="Timed out waiting to " + self.step + ".")
+        return self.state
+
+    def advance(self):
+        """ Handle the socket or transport of the step in progress once it is ready. """
+        try:
+            if self.step == "connect":
+                error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error != 0:
+                    raise OSError(error, os.strerror(error))
+                self.finish(DONE)
+            elif self.step == "accept":
+                conn = jazz_transport.accept(self.sock)
+                if conn is not None:
+                    self.finish(DONE, conn)
+            else:
+                data = self.transport.receive(1 if self.line else 2048)
+                if len(data) == 0:
+                    raise ConnectionResetError("The other side closed the connection.")
+                self.data += data
+                if not self.line or self.data.endswith(b"\n"):
+                    self.finish(DONE, self.data)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error as e:
+            self.finish(FAILED, error=str(e))
+
+    def finish(self, state, result=None, error=None):
+        """ End the step in progress with the given state, and make its socket blocking again. """
+        if self.sock is not None:
+            self.selector.unregister(self.sock)
+            try:
+                self.sock.setblocking(True)
+            except socket.error:
+                pass                # Closed in the meantime.
+        self.sock = None
+        self.transport = None
+        self.state = state
+        self.result = result
+        self.error = error
+
+    def take(self):
+        """ Return the result of the finished step, or raise the reason it failed as a socket error, and get ready
+        for the next step. Return None while the step is in progress. """
+        state = self.poll()
+        if state == WAITING:
+            return None
+        self.state = IDLE
+        if state == FAILED:
+            raise ConnectionError(self.error)
+        return self.result
+
+    def connected(self, sock, address, timeout=CONNECT_TIMEOUT):
+        """ Connect a socket to the given address, starting on the first call. Return 'True' once connected, 'False'
+        while connecting. Raise a socket error if it failed. """
+        if self.state == IDLE:
+            self.start("connect", timeout, sock, selectors.EVENT_WRITE)
+            error = sock.connect_ex(address)
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                self.finish(FAILED, error=os.strerror(error))
+        if self.poll() == WAITING:
+            return False
+        self.take()
+        return True
+
+    def accepted(self, listener, timeout=None):
+        """ Accept a client on a listening socket (see jazz_transport.listen()), starting on the first call. Return
+        the transport of the client, or None while waiting. Raise a socket error if it failed. """
+        if self.state == IDLE:
+            self.start("accept", timeout, listener, selectors.EVENT_READ)
+        return self.take()
+
+    def message(self, transport, timeout=None, line=False):
+        """ Receive the next message of the other side, starting on the first call. Return the message (bytes), or
+        None while waiting. Raise a socket error if the connection broke, was closed or timed out.
+
+        Parameters:
+            transport (jazz_transport.StreamTransport): Connection to the other side.
+            timeout (float): Time (in seconds) the message may take. None to wait as long as the player wants.
+            line (boolean): Whether to receive a single line, without consuming the data that follows it.
+        """
+
+        if self.state == IDLE:
+            self.start("receive", timeout, transport=transport)
+            self.line = line
+        return self.take()
+
+    def cancel(self):
+        """ Drop the step in progress, if any. """
+        if self.state == WAITING:
+            self.finish(IDLE)
+        self.state = IDLE
+
+    def close(self):
+        """ Drop the step in progress and release the selector. """
+        self.cancel()
+        self.selector.close()
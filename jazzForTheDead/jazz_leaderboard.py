@@ -0,0 +1,569 @@
+""" Highscore database access for the "Jazz for the dead!" game.
+
+Shared by every script that records scores, so that the leaderboard logic lives in one place. Every query is a constant
+with parameters, so that sqlite3 prepares it once per connection and reuses it from its statement cache. Team names are
+unique and scores are indexed, so recording a score is a single upsert and the rank is counted on the score index.
+
+Long running servers keep the leaderboard in memory instead (see Leaderboard), with ranks in logarithmic time, and
+write the new scores to the database in the background. Game loops reach it through a LeaderboardWorker, which answers
+with futures and never blocks them.
+
+Databases are kept in WAL mode, so readers never wait for the writer. Several threads share a LeaderboardStore: a small
+pool of read connections plus a single write connection, with queries retried with backoff while another process holds
+the database locked. See jazz_dbstress to put it under load.
+
+Every score is also kept in a history, with the time it was achieved, for leaderboards of the current day or week (see
+WINDOWS). The best score of every team per day and per week is kept up to date on every insert, just like the all-time
+best in the teams table, so windowed leaderboards are read from an index instead of scanning the history. Scores
+recorded before the history existed only count towards the all-time leaderboard.
+"""
+
+import jazz_metrics
+import queue
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from random import uniform
+
+TOP_TEAMS_NUM = 3       # Number of teams shown on the leaderboard.
+FLUSH_INTERVAL = 1      # Time (in seconds) between two writes of pending scores to the database.
+FLUSH_BATCH = 256       # Pending scores that trigger a write right away.
+MAX_PENDING = 100000    # Pending scores kept while the database fails. The oldest ones are dropped beyond that.
+QUERY_TIMEOUT = 2       # Time (in seconds) a game loop waits for the leaderboard, before showing the latest one known.
+BUSY_TIMEOUT = 0.05     # Time (in seconds) SQLite itself waits on a locked database, before a retry.
+BUSY_RETRIES = 8        # Attempts of a query on a locked database, before giving up.
+BUSY_BACKOFF = 0.01     # Pause (in seconds) before the first retry, doubled for every next one.
+CACHE_KIB = 16384       # Page cache per connection.
+READ_CONNECTIONS = 4    # Read connections of a LeaderboardStore.
+WINDOWS = ("all", "week", "day")    # Leaderboards: all-time, of the current week (from Monday) and of the current day.
+MAX_SCORE = 1000000     # Far above any score the game gives. Higher or negative scores are rejected.
+
+SQL_CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS teams (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        score INTEGER NOT NULL
+    );
+"""
+# Databases created before the name index might hold several entries per team. Keep only the best one: SQLite takes the
+# id of a group from the row with the highest score. A single sort, instead of a scan per entry.
+SQL_DROP_DUPLICATES = """
+    DELETE FROM teams WHERE id NOT IN (SELECT id FROM (SELECT id, MAX(score) FROM teams GROUP BY name));
+"""
+SQL_CREATE_NAME_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS teams_name ON teams (name);"
+SQL_CREATE_SCORE_INDEX = "CREATE INDEX IF NOT EXISTS teams_score ON teams (score);"
+SQL_HAS_NAME_INDEX = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND name = 'teams_name';"
+SQL_UPSERT_SCORE = """
+    INSERT INTO teams (name, score) VALUES (?, ?)
+        ON CONFLICT (name) DO UPDATE SET score = excluded.score WHERE excluded.score > score;
+"""
+SQL_SELECT_TOP = "SELECT name, score FROM teams ORDER BY score DESC LIMIT ?;"
+SQL_CALCULATE_RANK = "SELECT COUNT(*) FROM teams WHERE score >= ?;"
+SQL_SELECT_ALL = "SELECT name, score FROM teams;"
+SQL_CREATE_HISTORY_TABLE = """
+    CREATE TABLE IF NOT EXISTS score_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        score INTEGER NOT NULL,
+        time REAL NOT NULL
+    );
+"""
+SQL_CREATE_HISTORY_INDEX = "CREATE INDEX IF NOT EXISTS score_history_time ON score_history (time);"
+SQL_INSERT_HISTORY = "INSERT INTO score_history (name, score, time) VALUES (?, ?, ?);"
+# Best score of every team per period (number of the day or week) of each window, other than all-time.
+SQL_CREATE_PERIOD_TABLE = """
+    CREATE TABLE IF NOT EXISTS period_teams (
+        span TEXT NOT NULL,
+        period INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        score INTEGER NOT NULL,
+        PRIMARY KEY (span, period, name)
+    ) WITHOUT ROWID;
+"""
+SQL_CREATE_PERIOD_INDEX = "CREATE INDEX IF NOT EXISTS period_teams_score ON period_teams (span, period, score);"
+SQL_UPSERT_PERIOD_SCORE = """
+    INSERT INTO period_teams (span, period, name, score) VALUES (?, ?, ?, ?)
+        ON CONFLICT (span, period, name) DO UPDATE SET score = excluded.score WHERE excluded.score > score;
+"""
+SQL_SELECT_PERIOD_TOP = """
+    SELECT name, score FROM period_teams WHERE span = ? AND period = ? ORDER BY score DESC LIMIT ?;
+"""
+SQL_CALCULATE_PERIOD_RANK = "SELECT COUNT(*) FROM period_teams WHERE span = ? AND period = ? AND score >= ?;"
+SQL_SELECT_PERIOD = "SELECT name, score FROM period_teams WHERE span = ? AND period = ?;"
+
+
+def db_connect(db_path):
+    """ Open a connection with a new database, in WAL mode. The connection may be used by any thread, one at a
+    time. """
+    try:
+        connection = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        retry_busy(tune_connection, connection)
+    except sqlite3.Error as e:
+        print("Creating connection error: " + e.sqlite_errorname)
+        raise SystemExit
+    return connection
+
+
+def tune_connection(connection):
+    """ Switch the database to WAL mode, with syncs to disk only at checkpoints, and enlarge the page cache. In WAL
+    mode a crash can lose the latest commits, but never corrupts the database. """
+    connection.execute("PRAGMA journal_mode = WAL;")
+    connection.execute("PRAGMA synchronous = NORMAL;")
+    connection.execute("PRAGMA cache_size = -" + str(CACHE_KIB) + ";")
+
+
+def is_busy(error):
+    """ Return whether an error means that another connection holds the database locked. """
+    return (isinstance(error, sqlite3.OperationalError) and
+            error.sqlite_errorcode & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED))
+
+
+def retry_busy(function, *args):
+    """ Call a function that runs queries and return its result, retrying with backoff (and some randomness, so that
+    competing connections spread out) while the database is locked. Other errors are raised at once. """
+    delay = BUSY_BACKOFF
+    for attempt in range(BUSY_RETRIES):
+        try:
+            return function(*args)
+        except sqlite3.OperationalError as e:
+            if not is_busy(e) or attempt == BUSY_RETRIES - 1:
+                raise
+            jazz_metrics.DB_BUSY_RETRIES.inc()
+            time.sleep(delay * uniform(0.5, 1.5))
+            delay *= 2
+
+
+def execute_write_query(connection, query, parameters=()):
+    """ Send an SQL-style query, with the values of its placeholders, to a connected database. """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(query, parameters)
+        connection.commit()
+    except sqlite3.Error as e:
+        print("Query execution error: " + e.sqlite_errorname)
+
+
+def execute_read_query(connection, query, parameters=()):
+    """ Send an SQL-style query that expects results, with the values of its placeholders, to a connected database and
+    return the response. """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(query, parameters)
+        result = cursor.fetchall()
+    except sqlite3.Error as e:
+        result = None
+        print("Read query execution error: " + e.sqlite_errorname)
+    return result
+
+
+def init_database(db_path):
+    """ Connect to the highscore database, creating it if it does not exist, and return the connection. """
+    connection = db_connect(db_path)
+    execute_write_query(connection, SQL_CREATE_TABLE)
+    has_name_index = execute_read_query(connection, SQL_HAS_NAME_INDEX)
+    if has_name_index is not None and has_name_index[0][0] == 0:
+        execute_write_query(connection, SQL_DROP_DUPLICATES)
+        execute_write_query(connection, SQL_CREATE_NAME_INDEX)
+    execute_write_query(connection, SQL_CREATE_SCORE_INDEX)
+    execute_write_query(connection, SQL_CREATE_HISTORY_TABLE)
+    execute_write_query(connection, SQL_CREATE_HISTORY_INDEX)
+    execute_write_query(connection, SQL_CREATE_PERIOD_TABLE)
+    execute_write_query(connection, SQL_CREATE_PERIOD_INDEX)
+    return connection
+
+
+def period_of(window, timestamp=None):
+    """ Return the period of a window that a moment falls in: the number of the local day or week (from Monday) for
+    'day' or 'week', always 0 for 'all'.
+
+    Parameters:
+        window (string): One of WINDOWS.
+        timestamp (float): Seconds since the epoch, as returned by time.time(). Leave empty for now.
+    """
+
+    if window == "all":
+        return 0
+    day = date.fromtimestamp(time.time() if timestamp is None else timestamp).toordinal()
+    if window == "day":
+        return day
+    return (day - 1) // 7       # Day 1 was a Monday.
+
+
+def submit_score(connection, team_name, final_score, window="all"):
+    """ Record the final score of a team in the history and, if it is the team's best, in the leaderboards, then look
+    up the leaderboard of a window, in a single transaction.
+
+    Parameters:
+        connection (sqlite3.Connection): Connection to the highscore database.
+        team_name (string): The user-defined name of the team.
+        final_score (int): Total score of the team for this run, from 0 to MAX_SCORE. Other scores are not recorded.
+        window (string): Leaderboard to look up, one of WINDOWS.
+
+    Returns:
+        tuple of:
+            top_teams (list of tuples): Names (strings) and scores (ints) of the best teams, sorted by rank.
+            team_rank (int): Rank for this run's score, not the best score of the team. None if it was rejected or
+                the database failed.
+    """
+
+    start = time.perf_counter()
+    top_teams = []
+    team_rank = None
+    if not is_valid_score(final_score):
+        print("Rejected out of range score: " + str(final_score))
+        return top_teams, None
+    try:
+        top_teams, team_rank = retry_busy(run_submit, connection, team_name, final_score, window)
+    except sqlite3.Error as e:
+        print("Leaderboard query error: " + e.sqlite_errorname)
+    jazz_metrics.LEADERBOARD_SECONDS.observe(time.perf_counter() - start)
+    return top_teams, team_rank
+
+
+def is_valid_score(score):
+    """ Return 'True' if the given score could have been given by the game, or 'False' otherwise. """
+    return isinstance(score, int) and 0 <= score <= MAX_SCORE
+
+
+def run_submit(connection, team_name, final_score, window="all"):
+    """ Run the queries of submit_score() in a single transaction. Errors are raised. """
+    timestamp = time.time()
+    with connection:            # Commits once at the end, or rolls back on error.
+        run_record(connection, [(team_name, final_score, timestamp)])
+        top_teams = run_top(connection, window, TOP_TEAMS_NUM, timestamp)
+        team_rank = run_rank(connection, window, final_score, timestamp)
+    return top_teams, team_rank
+
+
+def run_record(connection, entries):
+    """ Add several scores to the history and to the best scores of every window they fall in. Runs in the
+    transaction of the caller, which commits it or rolls it back (see run_batch()). Errors are raised.
+
+    Parameters:
+        connection (sqlite3.Connection): Connection to the highscore database.
+        entries (list of tuples): Team names (strings), scores (ints) and times they were achieved (floats, seconds
+            since the epoch).
+    """
+
+    connection.executemany(SQL_INSERT_HISTORY, entries)
+    connection.executemany(SQL_UPSERT_SCORE, [(team_name, score) for team_name, score, timestamp in entries])
+    connection.executemany(SQL_UPSERT_PERIOD_SCORE, [(window, period_of(window, timestamp), team_name, score)
+                                                     for team_name, score, timestamp in entries
+                                                     for window in WINDOWS[1:]])
+
+
+def run_batch(connection, entries):
+    """ Same as run_record(), in a transaction of its own. Errors are raised. """
+    with connection:            # Commits once at the end, or rolls back on error.
+        run_record(connection, entries)
+
+
+def run_top(connection, window, count=TOP_TEAMS_NUM, timestamp=None):
+    """ Return the names and scores of the best teams of a window, sorted by rank. Errors are raised. """
+    if window == "all":
+        return run_read(connection, SQL_SELECT_TOP, (count,))
+    return run_read(connection, SQL_SELECT_PERIOD_TOP, (window, period_of(window, timestamp), count))
+
+
+def run_rank(connection, window, score, timestamp=None):
+    """ Return the number of teams of a window with a score equal to or higher than the given one. Errors are
+    raised. """
+    if window == "all":
+        return run_read(connection, SQL_CALCULATE_RANK, (score,))[0][0]
+    return run_read(connection, SQL_CALCULATE_PERIOD_RANK, (window, period_of(window, timestamp), score))[0][0]
+
+
+def run_window_scores(connection, window, timestamp=None):
+    """ Return the name and best score of every team of a window. Errors are raised. """
+    if window == "all":
+        return run_read(connection, SQL_SELECT_ALL)
+    return run_read(connection, SQL_SELECT_PERIOD, (window, period_of(window, timestamp)))
+
+
+def run_read(connection, query, parameters=()):
+    """ Run a query and return all its rows. Errors are raised. """
+    return connection.execute(query, parameters).fetchall()
+
+
+class LeaderboardStore:
+    def __init__(self, db_path, readers=READ_CONNECTIONS):
+        """ Open the highscore database for many threads at once, creating it if it does not exist.
+
+        Parameters:
+            db_path (string): Path of the highscore database.
+            readers (int): Number of read connections. Threads wait for a free one.
+        """
+
+        self.writer = init_database(db_path)
+        self.writer_lock = threading.Lock()
+        self.readers = queue.Queue()
+        for _ in range(readers):
+            self.readers.put(db_connect(db_path))
+
+    def write(self, function, *args):
+        """ Call a function with the write connection and the given arguments and return its result. Retried while
+        the database is locked, errors are raised. """
+        with self.writer_lock:
+            return retry_busy(function, self.writer, *args)
+
+    def read(self, function, *args):
+        """ Call a function with a free read connection and the given arguments and return its result. Retried while
+        the database is locked, errors are raised. """
+        connection = self.readers.get()
+        try:
+            return retry_busy(function, connection, *args)
+        finally:
+            self.readers.put(connection)
+
+    def submit_score(self, team_name, final_score, window="all"):
+        """ Same as submit_score(), on the write connection. Errors are raised. """
+        if not is_valid_score(final_score):
+            print("Rejected out of range score: " + str(final_score))
+            return [], None
+        return self.write(run_submit, team_name, final_score, window)
+
+    def top_teams(self, count=TOP_TEAMS_NUM, window="all"):
+        """ Return the names and scores of the best teams of a window, sorted by rank. """
+        return self.read(run_top, window, count)
+
+    def rank(self, score, window="all"):
+        """ Return the number of teams of a window with a score equal to or higher than the given one. """
+        return self.read(run_rank, window, score)
+
+    def all_scores(self, window="all"):
+        """ Return the name and best score of every team of a window. """
+        return self.read(run_window_scores, window)
+
+    def close(self):
+        """ Close all connections. Queries still running must end first. """
+        with self.writer_lock:
+            self.writer.close()
+        while not self.readers.empty():
+            self.readers.get().close()
+
+
+class ScoreTree:
+    def __init__(self, scores=()):
+        """ Prepare a Fenwick tree counting the teams with each score, for ranks in logarithmic time.
+
+        The tree is indexed by the place of a score among the distinct scores known, not by the score itself, so its
+        size follows the number of distinct scores, however large they are. A score never seen before rebuilds the
+        tree, in linear time of the distinct scores.
+
+        Parameters:
+            scores (list of ints): Best score of every team known so far.
+        """
+
+        scores = list(scores)
+        self.values = sorted(set(scores))       # Distinct scores, in the order of the tree.
+        counts = [0] * len(self.values)
+        for score in scores:
+            counts[bisect_left(self.values, score)] += 1
+        self.tree = [0]
+        self.total = len(scores)
+        self.build(counts)
+
+    def build(self, counts):
+        """ Fill the tree from scratch in linear time, from the number of teams with each score. """
+        self.tree = [0] + counts
+        for index in range(1, len(self.tree)):
+            parent = index + (index & -index)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[index]
+
+    def counts(self):
+        """ Return the number of teams with each distinct score, in linear time. """
+        counts = list(self.tree)
+        for index in range(len(counts) - 1, 0, -1):
+            parent = index + (index & -index)
+            if parent < len(counts):
+                counts[parent] -= counts[index]
+        return counts[1:]
+
+    def add(self, score, count=1):
+        """ Count (or, with a negative count, forget) teams with the given score. """
+        index = bisect_left(self.values, score)
+        if index == len(self.values) or self.values[index] != score:     # New distinct score.
+            counts = self.counts()
+            counts.insert(index, 0)
+            self.values.insert(index, score)
+            self.build(counts)
+        self.total += count
+        index += 1
+        while index < len(self.tree):
+            self.tree[index] += count
+            index += index & -index
+
+    def count_below(self, score):
+        """ Return the number of teams with a score lower than the given one. """
+        index = bisect_left(self.values, score)
+        result = 0
+        while index > 0:
+            result += self.tree[index]
+            index -= index & -index
+        return result
+
+    def rank(self, score):
+        """ Return the number of teams with a score equal to or higher than the given one. """
+        return self.total - self.count_below(score)
+
+
+class Leaderboard:
+    def __init__(self, db_path, window="all"):
+        """ Load the best score of every team in a window from the highscore database into memory, and start writing
+        new scores back to it in the background.
+
+        Scores are submitted and ranked in memory, so the leaderboard of a finished match is ready at once, however
+        many matches finish together. New scores are written to the database in batches, every FLUSH_INTERVAL seconds
+        or as soon as FLUSH_BATCH are pending, with the history and the best scores of every window.
+
+        Parameters:
+            db_path (string): Path of the highscore database, created if it does not exist.
+            window (string): Leaderboard to keep in memory and look up, one of WINDOWS. Day and week leaderboards
+                start over empty when a new day or week begins.
+        """
+
+        self.store = LeaderboardStore(db_path, 1)
+        self.window = window
+        self.start_period(period_of(window), self.store.all_scores(window))
+        self.pending = []           # Scores not yet written to the database: team names, scores and times.
+        self.closed = False
+        self.condition = threading.Condition()
+        self.writer = threading.Thread(target=self.write_behind, daemon=True)
+        self.writer.start()
+
+    def start_period(self, period, scores=()):
+        """ Start over the leaderboard for a period of the window, with the given names and best scores. """
+        self.period = period
+        self.scores = dict(scores)      # Best score, by team name.
+        self.tree = ScoreTree(self.scores.values())
+        # Names and scores of the best teams, sorted by rank.
+        self.top_teams = sorted(self.scores.items(), key=lambda entry: entry[1], reverse=True)[:TOP_TEAMS_NUM]
+
+    def submit_score(self, team_name, final_score):
+        """ Record the final score of a team and look up the leaderboard of the window. Does not wait for the
+        database. Takes the same parameters and returns the same results as submit_score(). """
+        start = time.perf_counter()
+        if not is_valid_score(final_score):
+            print("Rejected out of range score: " + str(final_score))
+            return list(self.top_teams), None
+        timestamp = time.time()
+        period = period_of(self.window, timestamp)
+        with self.condition:
+            if period != self.period:
+                self.start_period(period)
+            self.pending.append((team_name, final_score, timestamp))
+            if len(self.pending) >= FLUSH_BATCH:
+                self.condition.notify()
+            best = self.scores.get(team_name)
+            if best is None or final_score > best:
+                if best is not None:
+                    self.tree.add(best, -1)
+                self.tree.add(final_score)
+                self.scores[team_name] = final_score
+                self.update_top(team_name, final_score)
+            top_teams = list(self.top_teams)
+            team_rank = self.tree.rank(final_score)
+        jazz_metrics.LEADERBOARD_SECONDS.observe(time.perf_counter() - start)
+        return top_teams, team_rank
+
+    def update_top(self, team_name, score):
+        """ Place a team with a new best score among the best teams. Best scores never drop, so a team that leaves
+        the top only comes back with a new best score. """
+        entries = [entry for entry in self.top_teams if entry[0] != team_name]
+        index = 0
+        while index < len(entries) and entries[index][1] >= score:
+            index += 1
+        entries.insert(index, (team_name, score))
+        self.top_teams = entries[:TOP_TEAMS_NUM]
+
+    def write_behind(self):
+        """ Write the pending scores to the database in batches, until closed. Runs on a thread of its own. After a
+        failed write, the next one waits FLUSH_INTERVAL seconds however many scores are pending. """
+        failed = False
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or (not failed and len(self.pending) >= FLUSH_BATCH),
+                                        FLUSH_INTERVAL)
+                batch = self.pending
+                self.pending = []
+                closed = self.closed
+            if len(batch) > 0:
+                try:
+                    self.store.write(run_batch, batch)
+                    failed = False
+                except sqlite3.Error as e:
+                    print("Failed to write scores to the database: " + e.sqlite_errorname)
+                    failed = True
+                    if closed:
+                        print("Lost " + str(len(batch)) + " scores that could not be written to the database.")
+                    else:
+                        self.keep_pending(batch)
+            if closed:
+                self.store.close()
+                return
+
+    def keep_pending(self, batch):
+        """ Put back a batch that failed to be written, before the scores that arrived meanwhile, to retry it with
+        them. Beyond MAX_PENDING scores, the oldest ones are dropped with a message. """
+        with self.condition:
+            self.pending = batch + self.pending
+            lost = len(self.pending) - MAX_PENDING
+            if lost > 0:
+                self.pending = self.pending[lost:]
+                print("Lost " + str(lost) + " scores that could not be written to the database.")
+
+    def close(self):
+        """ Write the scores still pending and stop the background writer. Blocking. """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.writer.join()
+
+
+class LeaderboardWorker:
+    def __init__(self, db_path, window="all"):
+        """ Run a Leaderboard on a thread of its own, so that database I/O never blocks the game loop.
+
+        Requests are queued and served in order by a single thread, each answered through a
+        concurrent.futures.Future that the game loop can poll while it keeps rendering. Loading the database is the
+        first request, so a large database does not delay the start of the game either.
+
+        Parameters:
+            db_path (string): Path of the highscore database, created if it does not exist.
+            window (string): Leaderboard to look up, one of WINDOWS.
+        """
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="leaderboard")
+        self.leaderboard = None
+        self.window = window
+        self.top_teams = []         # Latest top teams known, to show when the worker is late.
+        self.executor.submit(self.load, db_path)
+
+    def load(self, db_path):
+        """ Load the leaderboard. Runs on the worker thread. """
+        self.leaderboard = Leaderboard(db_path, self.window)
+        self.top_teams = list(self.leaderboard.top_teams)
+
+    def submit_score(self, team_name, final_score):
+        """ Queue a score to submit, as submit_score() does. Return a future for the top teams and the rank. """
+        return self.executor.submit(self.serve, team_name, final_score)
+
+    def serve(self, team_name, final_score):
+        """ Submit a score and keep the top teams for later. Runs on the worker thread. """
+        top_teams, team_rank = self.leaderboard.submit_score(team_name, final_score)
+        self.top_teams = top_teams
+        return top_teams, team_rank
+
+    def close(self):
+        """ Serve the requests still queued, write the pending scores and stop the worker. Blocking. """
+        self.executor.submit(self.unload)
+        self.executor.shutdown(wait=True)
+
+    def unload(self):
+        """ Close the leaderboard, if it was loaded. Runs on the worker thread. """
+        if self.leaderboard is not None:
+            self.leaderboard.close()
@@ -0,0 +1,216 @@
+""" Load generator for the "Jazz for the dead!" dedicated server.
+
+Launch pairs of bots (see jazz_bot) against a dedicated server and report, once all their matches end:
+    tick rate       Gameplay frames per second of each match. Bots play at the frame cap of the client, so anything
+                    below it means the server could not keep up.
+    round trip      Time from a bot sending its frame to receiving the next one, as percentiles over all frames.
+    server CPU      CPU time used by the server process and its workers while the bots played, per match. Only
+                    available on Linux, for a server started with --launch or given with --server-pid.
+
+Usage:
+    python jazz_loadgen.py --pairs 50 --launch          Start a server on a throwaway database and load it.
+    python jazz_loadgen.py --pairs 50 --server-pid PID  Load a server already running on localhost.
+"""
+
+import os
+
+# Bots have neither a screen nor speakers. Must be set before pygame is initialized.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+# SDL would turn SIGTERM into a quit event that nobody reads, so that only SIGKILL could stop the bots.
+os.environ.setdefault("SDL_NO_SIGNAL_HANDLERS", "1")
+
+import jazz_operations as jo
+import jazz_bot
+import jazz_lobby
+import argparse
+import multiprocessing
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+LAUNCH_TIMEOUT = 10         # Time (in seconds) to wait for a launched server to start listening.
+
+
+def run_pair(host, port, team_name, fps, results):
+    """ Pair two bots in a new room and play their match. Blocking. Append the statistics of both to results. """
+    try:
+        host_bot, code = jazz_bot.join(host, port, "CREATE " + team_name, fps)
+    except (socket.error, jazz_lobby.LobbyError) as e:
+        print("Failed to create a room: " + str(e))
+        return
+    try:
+        mate_bot, code = jazz_bot.join(host, port, "JOIN " + code, fps)
+    except (socket.error, jazz_lobby.LobbyError) as e:
+        print("Failed to join room " + code + ": " + str(e))
+        host_bot.sock.close()
+        return
+    mate_thread = threading.Thread(target=mate_bot.play)
+    mate_thread.start()
+    host_bot.play()
+    mate_thread.join()
+    for bot in (host_bot, mate_bot):
+        if bot.error is not None:
+            print("Bot of room " + code + " stopped early: " + bot.error)
+        results.append({"room": code, "completed": bot.error is None, "frames": bot.frames,
+                        "gameplay_time": bot.gameplay_time, "rtts": bot.rtts, "decode_errors": bot.decode_errors,
+                        "final_score": bot.final_score})
+
+
+def run_pairs(host, port, team_name, fps, pairs, ramp):
+    """ Play several matches at the same time, one thread per pair. Return the statistics of all bots. """
+    results = []
+    threads = []
+    for _ in range(pairs):
+        thread = threading.Thread(target=run_pair, args=(host, port, team_name, fps, results))
+        thread.start()
+        threads.append(thread)
+        time.sleep(ramp)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def cpu_seconds(pid):
+    """ Return the CPU time (in seconds) used so far by a process and all its descendants, or None if unknown. Only
+    works on Linux. """
+    parents = {}
+    times = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return None
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/" + entry + "/stat") as file:
+                fields = file.read().rpartition(")")[2].split()
+        except OSError:         # Ended in the meantime.
+            continue
+        parents[int(entry)] = int(fields[1])
+        # Own user and system time, plus those of children that already ended.
+        times[int(entry)] = sum(int(field) for field in fields[11:15])
+    if pid not in times:
+        return None
+    total = 0
+    family = [pid]
+    while len(family) > 0:
+        current = family.pop()
+        total += times[current]
+        family += [child for child, parent in parents.items() if parent == current]
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values, fraction):
+    """ Return the value below which the given fraction of the sorted values falls. """
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def launch_server(port, workers):
+    """ Start a dedicated server on a throwaway database and wait until it listens. Return its process. """
+    db_path = os.path.join(tempfile.mkdtemp(), "loadgen.sqlite")
+    command = [sys.executable, "jazz_dedicated.py", "--port", str(port), "--db", db_path]
+    if workers is not None:
+        command += ["--workers", str(workers)]
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+    deadline = time.perf_counter() + LAUNCH_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return server
+        except socket.error:
+            if server.poll() is not None or time.perf_counter() > deadline:
+                server.kill()
+                print("Failed to launch the server.")
+                raise SystemExit(1)
+            time.sleep(0.1)
+
+
+def report(results, pairs, duration, cpu):
+    """ Print the statistics of a load test. """
+    rooms = {}
+    for result in results:
+        rooms.setdefault(result["room"], []).append(result)
+    completed = [room for room in rooms.values() if all(result["completed"] for result in room)]
+    print("Matches: " + str(len(completed)) + " completed, " + str(pairs - len(completed)) + " failed, in " +
+          str(round(duration, 1)) + " seconds.")
+    scores = [room[0]["final_score"] for room in completed]
+    if len(scores) > 0:
+        print("Final scores: mean " + str(round(sum(scores) / len(scores), 1)) + ", min " + str(min(scores)) +
+              ", max " + str(max(scores)))
+    tick_rates = [result["frames"] / result["gameplay_time"] for result in results if result["gameplay_time"] > 0]
+    if len(tick_rates) > 0:
+        print("Tick rate (frames per second): mean " + str(round(sum(tick_rates) / len(tick_rates), 1)) + ", min " +
+              str(round(min(tick_rates), 1)) + ", max " + str(round(max(tick_rates), 1)))
+    rtts = sorted(rtt * 1000 for result in results for rtt in result["rtts"])
+    if len(rtts) > 0:
+        print("Round trip (ms): p50 " + str(round(percentile(rtts, 0.5), 2)) + ", p90 " +
+              str(round(percentile(rtts, 0.9), 2)) + ", p99 " + str(round(percentile(rtts, 0.99), 2)) + ", max " +
+              str(round(rtts[-1], 2)) + ", over " + str(len(rtts)) + " frames")
+    decode_errors = sum(result["decode_errors"] for result in results)
+    if decode_errors > 0:
+        print("Frames that failed to decode: " + str(decode_errors))
+    if cpu is not None and len(rooms) > 0:
+        print("Server CPU: " + str(round(cpu, 2)) + " seconds, " + str(round(cpu / len(rooms), 3)) +
+              " seconds per match, " + str(round(100 * cpu / duration / len(rooms), 1)) + "% of a core per match")
+    elif cpu is None:
+        print("Server CPU: not available.")
+
+
+def stop_on_signal(signum, frame):
+    """ Stop on SIGTERM as on Ctrl+C, stopping a launched server too. """
+    raise KeyboardInterrupt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the Jazz for the dead! dedicated server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=jo.PORT)
+    parser.add_argument("--pairs", type=int, default=10, help="number of matches to play at the same time")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="number of processes to spread the bots over")
+    parser.add_argument("--fps", type=int, default=jazz_bot.FPS_CAP, help="frame cap of the bots, 0 for none")
+    parser.add_argument("--ramp", type=float, default=0.05, help="delay (in seconds) between starting two matches")
+    parser.add_argument("--team", default="load test", help="team name of the bots")
+    parser.add_argument("--launch", action="store_true", help="start a dedicated server with a throwaway database")
+    parser.add_argument("--workers", type=int, help="number of worker processes of the launched server")
+    parser.add_argument("--server-pid", type=int, help="process of a running server, to measure its CPU time")
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    server = None
+    server_pid = args.server_pid
+    if args.launch:
+        server = launch_server(args.port, args.workers)
+        server_pid = server.pid
+    cpu_start = cpu_seconds(server_pid) if server_pid is not None else None
+    start = time.perf_counter()
+
+    # Spread the pairs over the processes, so that the bots are not limited by a single core.
+    processes = max(1, min(args.processes, args.pairs))
+    shares = [args.pairs // processes + (1 if i < args.pairs % processes else 0) for i in range(processes)]
+    context = multiprocessing.get_context("spawn")
+    try:
+        with context.Pool(processes) as pool:
+            batches = pool.starmap(run_pairs, [(args.host, args.port, args.team, args.fps, share,
+                                                args.ramp * processes) for share in shares])
+    finally:
+        duration = time.perf_counter() - start
+        cpu = None
+        if cpu_start is not None:
+            cpu_end = cpu_seconds(server_pid)
+            if cpu_end is not None:
+                cpu = cpu_end - cpu_start
+        if server is not None:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+    report([result for batch in batches for result in batch], args.pairs, duration, cpu)
+
+
+if __name__ == "__main__":
+    main()
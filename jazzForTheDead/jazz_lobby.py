@@ -0,0 +1,247 @@
+""" Lobby and matchmaking for the "Jazz for the dead!" dedicated server.
+
+Clients connect to the lobby and send a single line command, before the match protocol begins:
+    LIST                List the open rooms. Reply: ROOMS followed by a JSON list of [code, team name] pairs.
+    CREATE <team name>  Open a new room and wait for a teammate. Reply: ROOM <code>
+    JOIN <code>         Join the room with the given code. Reply: ROOM <code>
+    QUICK [team name]   Join the oldest open room, or open a new one if there is none. Reply: ROOM <code>
+    WATCH <code>        Spectate the match that started in the room with the given code. Reply: WATCHING <code>
+Refused commands are answered with ERROR <reason>. As soon as a room has two players, both connections leave the lobby
+and the match starts, with the name of the room as the team name. Spectators leave the lobby too and receive a game
+snapshot per frame, as composed by jo.encode_spectator_data(), until the match ends.
+"""
+
+import json
+import selectors
+import socket
+from random import choice
+from string import ascii_uppercase
+
+CODE_LENGTH = 4
+MAX_LINE = 256          # Connections sending longer lines without a newline are dropped.
+MAX_NAME = 25           # Same limit as the team name input of the host.
+
+
+class LobbyError(Exception):
+    """ The lobby refused a command. """
+
+
+class Room:
+    def __init__(self, code, team_name, conn):
+        self.code = code                # Short code shared with the teammate to join the room.
+        self.team_name = team_name
+        self.conn = conn                # Connection of the player waiting in the room.
+
+
+class Lobby:
+    def __init__(self, on_match, on_watch=None, listener=None):
+        """ Prepare a lobby that hands every full room over to on_match.
+
+        Parameters:
+            on_match (function): Called with the room code, the team name and the two connections (blocking sockets)
+                of each new match. Must take ownership of the connections.
+            on_watch (function): Called with a room code and the connection (blocking socket) of a spectator. Must
+                return 'False' if there is no running match for that code. Otherwise must take ownership of the
+                connection and reply with WATCHING <code> before the first snapshot. Leave empty to refuse all
+                spectators.
+            listener (socket): Listening socket to accept clients from. Leave empty to only serve connections passed
+                to add(), e.g. one end of socket.socketpair(), as a local stand-in for tests.
+        """
+
+        self.on_match = on_match
+        self.on_watch = on_watch
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}       # Partial command lines, by connection.
+        self.rooms = {}         # Open rooms by code, oldest first.
+        self.room_codes = {}    # Codes of the rooms, by the connection waiting in them.
+        self.listener = listener
+        if listener is not None:
+            listener.setblocking(False)
+            self.selector.register(listener, selectors.EVENT_READ)
+
+    def add(self, conn):
+        """ Start serving a connected client. """
+        conn.setblocking(False)
+        self.buffers[conn] = b""
+        self.selector.register(conn, selectors.EVENT_READ)
+
+    def leave(self, conn):
+        """ Stop serving a client, without closing the connection. """
+        self.selector.unregister(conn)
+        del self.buffers[conn]
+        conn.setblocking(True)
+
+    def drop(self, conn):
+        """ Stop serving a client and close the connection. """
+        self.selector.unregister(conn)
+        del self.buffers[conn]
+        code = self.room_codes.pop(conn, None)
+        if code is not None:
+            del self.rooms[code]
+        try:
+            conn.close()
+        except socket.error:
+            print("Error closing connection.")
+
+    def poll(self, timeout=None):
+        """ Serve every client that is ready, waiting up to timeout seconds (forever if None) for one to be. """
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.listener:
+                self.accept()
+            elif key.fileobj in self.buffers:   # Might have left the lobby earlier in this loop.
+                self.read(key.fileobj)
+
+    def serve_forever(self):
+        """ Serve clients until interrupted. Blocking. """
+        while True:
+            self.poll()
+
+    def accept(self):
+        """ Accept all pending connections. """
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error:
+                print("Failed to accept a connection.")
+                return
+            self.add(conn)
+
+    def read(self, conn):
+        """ Receive data from a client and run the commands that are complete. """
+        try:
+            data = conn.recv(1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b""
+        if len(data) == 0:              # Disconnected.
+            self.drop(conn)
+            return
+        buffer = self.buffers[conn] + data
+        while conn in self.buffers and b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            self.handle(conn, line.decode(errors="replace").strip())
+        if conn in self.buffers:
+            if len(buffer) > MAX_LINE:
+                self.drop(conn)
+            else:
+                self.buffers[conn] = buffer
+
+    def reply(self, conn, text):
+        """ Send a single line reply to a client. """
+        try:
+            conn.sendall((text + "\n").encode())
+        except socket.error:
+            self.drop(conn)
+
+    def handle(self, conn, line):
+        """ Run a single command of a client. """
+        command, _, argument = line.partition(" ")
+        command = command.upper()
+        argument = argument.strip()
+        if conn in self.room_codes:
+            self.reply(conn, "ERROR Already waiting in a room")
+        elif command == "LIST":
+            self.reply(conn, "ROOMS " + json.dumps([[room.code, room.team_name] for room in self.rooms.values()]))
+        elif command == "CREATE":
+            if self.is_valid_name(argument):
+                self.create_room(conn, argument)
+            else:
+                self.reply(conn, "ERROR Invalid team name")
+        elif command == "JOIN":
+            room = self.rooms.get(argument.upper())
+            if room is None:
+                self.reply(conn, "ERROR Room not found")
+            else:
+                self.join_room(conn, room)
+        elif command == "QUICK":
+            if len(argument) > 0 and not self.is_valid_name(argument):
+                self.reply(conn, "ERROR Invalid team name")
+            elif len(self.rooms) > 0:
+                self.join_room(conn, next(iter(self.rooms.values())))
+            else:
+                self.create_room(conn, argument)
+        elif command == "WATCH":
+            self.watch(conn, argument.upper())
+        else:
+            self.reply(conn, "ERROR Unknown command")
+
+    @staticmethod
+    def is_valid_name(team_name):
+        """ Return 'True' if the given team name could have been typed on the host, or 'False' otherwise. """
+        return 0 < len(team_name) <= MAX_NAME and all(char.isalpha() or char == " " for char in team_name)
+
+    def create_room(self, conn, team_name):
+        """ Open a new room with the client waiting in it. """
+        code = "".join(choice(ascii_uppercase) for _ in range(CODE_LENGTH))
+        while code in self.rooms:
+            code = "".join(choice(ascii_uppercase) for _ in range(CODE_LENGTH))
+        if len(team_name) == 0:
+            team_name = "team " + code.lower()
+        self.rooms[code] = Room(code, team_name, conn)
+        self.room_codes[conn] = code
+        self.reply(conn, "ROOM " + code)
+
+    def join_room(self, conn, room):
+        """ Fill a room with a second client and start the match. """
+        self.reply(conn, "ROOM " + room.code)
+        if conn not in self.buffers:    # Disconnected while replying.
+            return
+        del self.rooms[room.code]
+        del self.room_codes[room.conn]
+        self.leave(room.conn)
+        self.leave(conn)
+        self.on_match(room.code, room.team_name, [room.conn, conn])
+
+    def watch(self, conn, code):
+        """ Hand a spectator over to a running match. """
+        if self.on_watch is None:
+            self.reply(conn, "ERROR Spectators are not allowed")
+            return
+        self.leave(conn)
+        if not self.on_watch(code, conn):
+            self.add(conn)
+            self.reply(conn, "ERROR Match not found")
+
+
+def read_line(sock):
+    """ Receive a single line from the lobby, without consuming any data that follows it. """
+    line = b""
+    while not line.endswith(b"\n"):
+        char = sock.recv(1)
+        if len(char) == 0:
+            raise ConnectionResetError("The lobby closed the connection.")
+        line += char
+    return line.decode().strip()
+
+
+def enter(sock, command):
+    """ Send a CREATE, JOIN or QUICK command to the lobby and return the code of the room. Raise LobbyError if the
+    command was refused. """
+    sock.sendall((command + "\n").encode())
+    return room_code(read_line(sock))
+
+
+def room_code(reply):
+    """ Return the code of the room from the reply of the lobby to a CREATE, JOIN or QUICK command. Raise LobbyError
+    if the command was refused. """
+    if not reply.startswith("ROOM "):
+        raise LobbyError(reply.partition(" ")[2])
+    return reply[len("ROOM "):]
+
+
+def watch(sock, code):
+    """ Ask the lobby to spectate the match of the given room. Raise LobbyError if the request was refused. """
+    sock.sendall(("WATCH " + code + "\n").encode())
+    reply = read_line(sock)
+    if not reply.startswith("WATCHING "):
+        raise LobbyError(reply.partition(" ")[2])
+
+
+def list_rooms(sock):
+    """ Return the codes and team names of the open rooms of the lobby, as a list of pairs. """
+    sock.sendall("LIST\n".encode())
+    reply = read_line(sock)
+    return json.loads(reply[len("ROOMS "):])
@@ -0,0 +1,345 @@
+""" Deterministic lockstep simulation for the "Jazz for the dead!" game.
+
+In lockstep mode, the server and the client run the identical simulation of both players, the enemies and the swords,
+from a shared seed. Only the keys pressed by each player cross the network, as one small fixed-size message per frame,
+so the traffic does not grow with the number of enemies. Every HASH_INTERVAL frames, each side also sends a hash of its
+state, to detect if the two simulations drifted apart.
+
+The server opts in by setting the JAZZ_LOCKSTEP environment variable to 1. It then sends "lockstep <seed> <time>"
+instead of the usual start signal, and the client follows along.
+"""
+
+import jazz_operations as jo
+import pygame
+import struct
+import zlib
+from random import Random
+from math import sqrt, floor
+
+FPS_CAP = 60
+HASH_INTERVAL = 30                  # Frames between state hashes.
+INPUT_FORMAT = struct.Struct("<IBI")    # Frame number, pressed keys and state hash (0 when not hashed).
+
+# Bits of the pressed keys mask.
+KEY_LEFT = 1
+KEY_RIGHT = 2
+KEY_UP = 4
+KEY_DOWN = 8
+KEY_ATTACK = 16
+
+delta_time = 1 / FPS_CAP                            # Not actual delta time, expects a stable frame rate.
+immune_frames = jo.PLAYER_IMMUNE_DUR * FPS_CAP      # Number of frames that the player is immune to damage after a hit.
+simple_vel = jo.VEL_CONST * delta_time
+diagonal_vel = sqrt(simple_vel * simple_vel / 2)    # Velocity for each axis when moving on both, to avoid speeding up.
+enemy_vel = diagonal_vel * jo.ENEMY_VEL_MULT
+
+
+def read_keys(keys):
+    """ Return the mask of the gameplay keys pressed, from the state returned by pygame.key.get_pressed(). """
+    mask = 0
+    if keys[pygame.K_LEFT] or keys[pygame.K_a]:
+        mask |= KEY_LEFT
+    if keys[pygame.K_RIGHT] or keys[pygame.K_d]:
+        mask |= KEY_RIGHT
+    if keys[pygame.K_UP] or keys[pygame.K_w]:
+        mask |= KEY_UP
+    if keys[pygame.K_DOWN] or keys[pygame.K_s]:
+        mask |= KEY_DOWN
+    if keys[pygame.K_SPACE]:
+        mask |= KEY_ATTACK
+    return mask
+
+
+class PlayerState:
+    def __init__(self, role, pos, attacks):
+        self.role = role                # Either 's' for skeleton or 'z' for zombie.
+        self.x, self.y = pos
+        self.attacks = attacks
+        self.looking_left = False
+        self.walking = False
+        self.attacking = False
+        self.movement_active = True
+        self.attack_active = True
+        self.can_kill = False
+        self.immune = False
+        self.immune_frame = 0
+        self.walk_count = 0
+        self.idle_count = 0
+        self.attack_count = 0
+        self.anim_key = "idle"
+        self.anim_index = 0
+
+    def handle_keys(self, mask, events, index):
+        """ Apply the pressed keys of the current frame, the same way the scripts handle the local player. """
+        if mask & KEY_ATTACK and self.attack_active and self.attacks > 0:
+            self.movement_active = False
+            self.attack_active = False
+            self.attacking = True
+            self.can_kill = True
+            self.walking = False
+            self.attacks -= 1
+            events.append(("attack", index))
+        walking_horiz = False
+        walking_vertic = False
+        if mask & KEY_LEFT and self.x > 40 and self.movement_active:
+            self.looking_left = True
+            walking_horiz = -1
+        elif mask & KEY_RIGHT and self.x < jo.SCREEN_WIDTH - (220 * jo.PLAYER_SCALE) - 40 and self.movement_active:
+            self.looking_left = False
+            walking_horiz = 1
+        if mask & KEY_UP and self.y > 20 and self.movement_active:
+            walking_vertic = -1
+        elif mask & KEY_DOWN and self.y < jo.SCREEN_HEIGHT - (350 * jo.PLAYER_SCALE) - 55 and self.movement_active:
+            walking_vertic = 1
+        if walking_horiz and walking_vertic:
+            velocity = diagonal_vel
+        else:
+            velocity = simple_vel
+        if walking_horiz:
+            self.x += walking_horiz * velocity
+        if walking_vertic:
+            self.y += walking_vertic * velocity
+        if walking_horiz or walking_vertic:
+            self.walking = True
+        else:
+            self.walk_count = 0
+            self.walking = False
+
+    def animate(self):
+        """ Advance the animation counters and pick the current frame, the same way jo.draw_player() does. """
+        if self.role == "s":
+            num_frames = jo.skeleton_num_frames
+        else:
+            num_frames = jo.zombie_num_frames
+        if self.walk_count + jo.PLAYER_ANIM_STEP > num_frames["walk"]:
+            self.walk_count = 0
+        if self.idle_count + jo.PLAYER_ANIM_STEP > num_frames["idle"]:
+            self.idle_count = 0
+        if self.attack_count + jo.PLAYER_ANIM_STEP > num_frames["attack"]:
+            self.attack_count = 0
+            self.movement_active = True
+            self.attack_active = True
+            self.attacking = False
+        if self.walking:
+            self.anim_key = "walk"
+            self.anim_index = floor(self.walk_count % (num_frames["walk"] - 1))
+            self.walk_count += jo.PLAYER_ANIM_STEP
+            self.idle_count = 0
+            self.attack_count = 0
+        elif self.attacking:
+            self.anim_key = "attack"
+            self.anim_index = floor(self.attack_count % (num_frames["attack"] - 1))
+            self.attack_count += jo.PLAYER_ANIM_STEP
+            self.idle_count = 0
+            self.walk_count = 0
+        else:
+            self.anim_key = "idle"
+            self.anim_index = floor(self.idle_count % (num_frames["idle"] - 1))
+            self.idle_count += jo.PLAYER_ANIM_STEP
+            self.walk_count = 0
+            self.attack_count = 0
+
+    def rect(self):
+        """ Return the rectangle of the current frame of the player. """
+        return jo.teammate_rect(self.anim_key, self.anim_index, self.role, (self.x, self.y), not self.looking_left)
+
+    def state(self):
+        """ Return the complete state of the player, as a tuple. """
+        return (self.role, self.x, self.y, self.attacks, self.looking_left, self.walking, self.attacking,
+                self.movement_active, self.attack_active, self.can_kill, self.immune, self.immune_frame,
+                self.walk_count, self.idle_count, self.attack_count, self.anim_key, self.anim_index)
+
+
+class World:
+    def __init__(self, seed, server_role, client_role):
+        """ Prepare the first level of a lockstep game. Both sides must use the same arguments. """
+        self.rng = Random(seed)
+        self.roles = (server_role, client_role)
+        self.level_index = 0
+        self.reset_level(0)
+
+    def reset_level(self, level_index):
+        """ Prepare the gameplay state for the given level. """
+        if level_index == 0:
+            attacks = jo.INIT_ATTACKS
+        else:
+            attacks = jo.INIT_ATTACKS - 1
+        self.level_index = level_index
+        self.tick = 0
+        self.hp = jo.FULL_HP
+        self.enemies_killed = 0
+        self.slimes = []
+        self.swords = []
+        self.slimes_to_spawn = jo.levels[level_index].enemies_num
+        # The server's player comes first, the client's second.
+        self.players = [PlayerState(self.roles[0], jo.START_POS_SERVER, attacks),
+                        PlayerState(self.roles[1], jo.START_POS_CLIENT, attacks)]
+
+    def state_hash(self):
+        """ Return a hash of the complete state, to compare with the other side. Never 0. """
+        state = (self.level_index, self.tick, self.hp, self.enemies_killed, self.slimes, self.swords,
+                 self.slimes_to_spawn, [player.state() for player in self.players])
+        return zlib.crc32(repr(state).encode()) or 1
+
+    def step(self, masks):
+        """ Simulate one frame of gameplay.
+
+        Parameters:
+            masks (list of ints): Keys pressed on the server and on the client, for this frame.
+
+        Returns:
+            tuple of:
+                stop (boolean): Whether the level or the game has ended.
+                events (list of tuples): Name of each event that happened and the index of the player involved,
+                    or None. Useful for sound effects.
+        """
+
+        self.tick += 1
+        events = []
+        for index, player in enumerate(self.players):
+            player.handle_keys(masks[index], events, index)
+        # Take a chance at spawning enemies and swords.
+        if self.slimes_to_spawn > 0 and self.rng.random() < 0.25 * delta_time:
+            jo.spawn_slime(self.slimes, self.level_index, self.rng.random)
+            self.slimes_to_spawn -= 1
+        if len(self.swords) < jo.MAX_SWORDS and self.rng.random() < 0.07 * delta_time:
+            jo.spawn_sword(self.swords, self.rng.random)
+            events.append(("sword_spawn", None))
+        # Update the slimes regarding NPC movement and animation.
+        jo.move_slimes(self.slimes, [(player.x, player.y) for player in self.players], enemy_vel)
+        for player in self.players:
+            player.animate()
+        slime_rects = jo.slime_rects(self.slimes)
+        sword_rects = jo.sword_rects(self.swords, self.level_index)
+        # The client's player is checked first, like on the server.
+        for index in (1, 0):
+            player = self.players[index]
+            rect = player.rect()
+            # Check if a sword was picked.
+            for sword_rect in sword_rects:
+                if rect.colliderect(sword_rect):
+                    if player.attacks < jo.MAX_ATTACKS:
+                        player.attacks += 1
+                    events.append(("sword", index))
+                    self.swords.pop(sword_rects.index(sword_rect))
+                    sword_rects.remove(sword_rect)      # In case both players touch the same sword at the same frame.
+                    break
+            # Check if there is conflict with an enemy.
+            for slime_rect in slime_rects:
+                if rect.colliderect(slime_rect):
+                    if player.attacking and player.can_kill:                # Kill an enemy.
+                        player.can_kill = False
+                        self.enemies_killed += 1
+                        self.slimes.pop(slime_rects.index(slime_rect))
+                        slime_rects.remove(slime_rect)  # In case both players kill the same enemy at the same frame.
+                        events.append(("kill", index))
+                    elif not player.attacking and not player.immune:        # Take damage.
+                        player.immune = True
+                        player.immune_frame = 0
+                        self.hp -= 1
+                        events.append(("damage", index))
+                    break
+        # Track immunity duration.
+        for player in self.players:
+            if player.immune:
+                player.immune_frame += 1
+                if player.immune_frame >= immune_frames:
+                    player.immune = False
+        stop = self.hp <= 0 or self.enemies_killed >= jo.levels[self.level_index].enemies_num
+        return stop, events
+
+
+def recv_exactly(transport, size):
+    """ Receive exactly the given number of bytes from a transport (see jazz_transport). """
+    data = b""
+    while len(data) < size:
+        chunk = transport.receive(size - len(data))
+        if len(chunk) == 0:
+            raise ConnectionResetError("The teammate closed the connection.")
+        data += chunk
+    return data
+
+
+def exchange_keys(transport, world, mask):
+    """ Send the keys pressed locally for the next frame and wait for the keys of the teammate.
+
+    Parameters:
+        transport (jazz_transport.StreamTransport): Connection with the teammate.
+        world (World): The local simulation, not yet stepped for the next frame.
+        mask (int): Keys pressed locally.
+
+    Returns:
+        tuple of:
+            mask (int): Keys pressed by the teammate.
+            desynced (boolean): Whether the teammate's state hash differs from the local one.
+    """
+
+    tick = world.tick + 1
+    if tick % HASH_INTERVAL == 0:
+        state_hash = world.state_hash()
+    else:
+        state_hash = 0
+    transport.send(INPUT_FORMAT.pack(tick, mask, state_hash))
+    mate_tick, mate_mask, mate_hash = INPUT_FORMAT.unpack(recv_exactly(transport, INPUT_FORMAT.size))
+    if mate_tick != tick:
+        raise ValueError("Lockstep frames out of order: " + str(mate_tick) + " instead of " + str(tick) + ".")
+    return mate_mask, mate_hash != state_hash
+
+
+def draw_world(world, local_index, screen):
+    """ Render the gameplay screen of a lockstep game, as seen by the given player.
+
+    Parameters:
+        world (World): The simulation to render.
+        local_index (int): 0 on the server, 1 on the client.
+        screen (pygame.Surface): Surface where the frame will be rendered.
+    """
+
+    you = world.players[local_index]
+    mate = world.players[1 - local_index]
+    # Render UI elements.
+    you_portrait_pos = (12, 4)
+    mate_portrait_pos = (jo.SCREEN_WIDTH - jo.skeleton_portrait.get_width() - 12, 4)
+    if you.role == "s":
+        screen.blit(jo.skeleton_portrait, you_portrait_pos)
+        screen.blit(jo.zombie_portrait, mate_portrait_pos)
+    else:
+        screen.blit(jo.zombie_portrait, you_portrait_pos)
+        screen.blit(jo.skeleton_portrait, mate_portrait_pos)
+    for i in range(jo.FULL_HP):
+        if i + 1 <= world.hp:
+            heart = jo.full_heart
+        else:
+            heart = jo.broken_heart
+        screen.blit(heart, (((jo.broken_heart.get_width() + 3) * i) + 676, 18))
+    screen.blit(jo.sword_small, (180, 43))
+    sword_text = jo.dosis_font_large.render(str(you.attacks), 1, jo.BLACK)
+    screen.blit(sword_text, (146, 38))
+    screen.blit(jo.sword_small, (1716, 43))
+    teammate_sword_text = jo.dosis_font_large.render(str(mate.attacks), 1, jo.BLACK)
+    screen.blit(teammate_sword_text, (1683, 38))
+    # Render sprites, the player further down the screen goes on top.
+    for player in sorted(world.players, key=lambda player_state: player_state.y):
+        jo.draw_teammate(player.anim_key, player.anim_index, player.role, (player.x, player.y),
+                         not player.looking_left, screen, player.immune)
+    jo.draw_slimes(world.slimes, screen)
+    jo.draw_swords(world.swords, world.level_index, screen)
+    # Render low health effect, when appropriate.
+    if world.hp == 1:
+        screen.blit(jo.low_hp_fx, (0, 0))
+
+
+def play_sounds(events, local_index):
+    """ Play the sound effects of the events of a frame that the given player should hear. """
+    for name, index in events:
+        if name == "sword_spawn":
+            jo.ding_sound.play()
+        elif name == "damage":
+            jo.damage_sound.play()
+        elif index == local_index:
+            if name == "attack":
+                jo.hit_miss_sound.play()
+            elif name == "kill":
+                jo.hit_kill_sound.play()
+            elif name == "sword":
+                jo.sword_sound.play()
@@ -0,0 +1,139 @@
+""" Single process sessions of the "Jazz for the dead!" game.
+
+Play whole matches, from the team name to the leaderboard, between a match host (see jazz_match) and two bot clients
+(see jazz_bot) on threads of this process, connected by transports of any kind (see jazz_transport). No server has to be
+started and nothing is written to a database, so it also runs on machines without a network.
+
+The cost of each transport is measured on its own first: two threads send a message the size of a gameplay frame back
+and forth over a transport pair, without the game, and the time per round trip is that of two messages sent, received
+and handed over to the other thread. The local transport makes no system call, but hands messages over through queue
+locks, which may well cost more than a socket.
+
+Then every match is played from the same seed over every transport, with bots that reply as fast as they can, as an
+end-to-end check that a whole game works over each of them. The time per frame of a match is mostly the simulation and
+the bots, so it tells little about the transport: differences of a few percent between transports are noise.
+
+Usage:
+    python jazz_loopback.py                                 Compare all transports.
+    python jazz_loopback.py --transports local tcp --matches 3
+"""
+
+import os
+
+# Runs headless. Must be set before pygame is initialized.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import jazz_bot
+import jazz_transport
+from jazz_match import Match
+import argparse
+import socket
+import threading
+import time
+
+TRANSPORTS = ["local", "socketpair", "tcp", "udp"]
+MESSAGE_BYTES = 300         # Size of the messages sent back and forth, about that of a gameplay frame.
+ROUND_TRIPS = 20000         # Round trips timed for every transport.
+WARMUP_ROUND_TRIPS = 1000   # Round trips before the timing starts.
+ROUND_TRIP_TIMEOUT = 5      # Time (in seconds) to wait for a message, which UDP may lose, before giving up.
+
+
+def receive_message(transport, size=MESSAGE_BYTES):
+    """ Receive a whole message of the given size, which a stream may deliver in parts. Blocking. """
+    data = b""
+    while len(data) < size:
+        chunk = transport.receive(size - len(data))
+        if len(chunk) == 0:
+            raise ConnectionResetError("The other side closed the transport.")
+        data += chunk
+    return data
+
+
+def echo(transport, round_trips):
+    """ Send back every message received, for the given number of round trips. Runs on a thread of its own. """
+    try:
+        for _ in range(round_trips):
+            transport.send(receive_message(transport))
+    except socket.error:
+        pass                        # The other side gave up.
+
+
+def time_round_trips(kind, round_trips):
+    """ Send messages back and forth between two threads over transports of the given kind. Return the time per
+    round trip (in microseconds), or None if a message was lost. """
+    here, there = jazz_transport.transport_pair(kind)
+    here.settimeout(ROUND_TRIP_TIMEOUT)
+    there.settimeout(ROUND_TRIP_TIMEOUT)
+    thread = threading.Thread(target=echo, args=(there, WARMUP_ROUND_TRIPS + round_trips), daemon=True)
+    thread.start()
+    message = bytes(MESSAGE_BYTES)
+    try:
+        for _ in range(WARMUP_ROUND_TRIPS):
+            here.send(message)
+            receive_message(here)
+        start = time.perf_counter()
+        for _ in range(round_trips):
+            here.send(message)
+            receive_message(here)
+        return 1000000 * (time.perf_counter() - start) / round_trips
+    except socket.error:
+        return None
+    finally:
+        thread.join()
+        here.close()
+        there.close()
+
+
+def play_match(kind, seed, team_name="loopback"):
+    """ Play a whole match over transports of the given kind. Return the gameplay frames per second of the bots, or
+    None if the match did not reach the end. """
+    pairs = [jazz_transport.transport_pair(kind) for _ in range(2)]
+    bots = [jazz_bot.Bot(client_end, fps=0) for server_end, client_end in pairs]
+    threads = [threading.Thread(target=bot.play, daemon=True) for bot in bots]
+    for thread in threads:
+        thread.start()
+    match = Match([server_end for server_end, client_end in pairs], team_name,
+                  lambda name, score: ([(name, score)], 1, "all"), seed)
+    score = match.run()
+    for thread in threads:
+        thread.join()
+    if score is None or any(bot.error is not None for bot in bots):
+        return None
+    return sum(bot.frames for bot in bots) / sum(bot.gameplay_time for bot in bots)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play Jazz for the dead! matches in a single process")
+    parser.add_argument("--transports", nargs="+", default=TRANSPORTS, choices=TRANSPORTS)
+    parser.add_argument("--matches", type=int, default=1, help="matches per transport")
+    parser.add_argument("--round-trips", type=int, default=ROUND_TRIPS, help="round trips timed per transport")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("Round trips of " + str(MESSAGE_BYTES) + " byte messages:")
+    for kind in args.transports:
+        round_trip_us = time_round_trips(kind, args.round_trips)
+        if round_trip_us is None:
+            print("The round trips over " + kind + " lost a message.")
+        else:
+            print(kind.ljust(12) + format(round_trip_us, ".1f").rjust(10) + " us per round trip")
+
+    print("Whole matches:")
+    for kind in args.transports:
+        rates = []
+        for match_num in range(args.matches):
+            rate = play_match(kind, args.seed + match_num)
+            if rate is None:
+                print("The match over " + kind + " did not reach the end.")
+            else:
+                rates.append(rate)
+        if len(rates) == 0:
+            continue
+        frame_us = 1000000 * len(rates) / sum(rates)
+        print(kind.ljust(12) + format(sum(rates) / len(rates), ".0f").rjust(8) + " frames per second" +
+              format(frame_us, ".1f").rjust(10) + " us per frame")
+
+
+if __name__ == "__main__":
+    main()
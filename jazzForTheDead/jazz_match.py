@@ -0,0 +1,338 @@
+""" Headless match host for the "Jazz for the dead!" game.
+
+Run the server side of a match between two remote clients, without rendering or user input. Each client is shown the
+other one as the host's player, so unmodified clients can play on a dedicated server.
+"""
+
+import jazz_operations as jo
+from jazz_broadcast import Broadcaster
+import jazz_metrics
+import jazz_handshake
+import jazz_transport
+import socket
+import time
+from random import Random
+from math import sqrt
+from json import decoder
+
+FPS_CAP = 60
+INTERMISSION_SEC = 5            # Time (in seconds) on the next level screen, before starting the next level.
+ANIM_KEYS = ["idle", "walk", "attack"]      # Animations a client may report, in the order replays number them.
+MAX_FIELD = 255                 # Largest animation index or number of attacks a client may report, as replays store.
+
+delta_time = 1 / FPS_CAP                            # Not actual delta time, expects a stable frame rate.
+immune_frames = jo.PLAYER_IMMUNE_DUR * FPS_CAP      # Number of frames that the player is immune to damage after a hit.
+simple_vel = jo.VEL_CONST * delta_time
+enemy_vel = sqrt(simple_vel * simple_vel / 2) * jo.ENEMY_VEL_MULT
+
+
+def is_count(value):
+    """ Return 'True' if the given value is an int from 0 to MAX_FIELD, or 'False' otherwise. """
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= MAX_FIELD
+
+
+def is_on_screen(pos):
+    """ Return 'True' if the given value is a position (two numbers) on the screen, or 'False' otherwise. Infinity
+    and NaN, which JSON accepts, are not. """
+    return (len(pos) == 2 and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in pos) and
+            0 <= pos[0] <= jo.SCREEN_WIDTH and 0 <= pos[1] <= jo.SCREEN_HEIGHT)
+
+
+class Player:
+    def __init__(self, conn, role):
+        self.conn = conn                # Transport connected to the client of the player (see jazz_transport).
+        self.role = role                # Either 's' for skeleton or 'z' for zombie.
+        self.attacks = jo.INIT_ATTACKS
+        self.reset()
+
+    def reset(self):
+        """ Restore the state tracked for a new level. """
+        self.anim_key = "idle"
+        self.anim_index = 0
+        self.flipped = False
+        self.pos = jo.START_POS_CLIENT
+        self.immune = False
+        self.immune_frame = 0
+        self.can_kill = False
+        self.attack_started = False     # Whether an attack started since the last frame, for the telemetry.
+
+    def update(self, frame_data):
+        """ Apply the frame data received from the client of the player. Raise ValueError, KeyError or TypeError if
+        it is not a frame of the game. """
+        anim_key, anim_index, flipped, pos, attacks = jo.decode_frame_data(frame_data)[0:5]
+        if anim_key not in ANIM_KEYS or not is_count(anim_index) or not is_count(attacks) or not is_on_screen(pos):
+            raise ValueError("Invalid frame data.")
+        self.apply(anim_key, anim_index, flipped, pos, attacks)
+
+    def apply(self, anim_key, anim_index, flipped, pos, attacks):
+        """ Apply the state reported by the client of the player for the latest frame. """
+        if anim_key == "attack" and self.anim_key != "attack":         # First frame of attack sequence.
+            self.can_kill = True
+            self.attack_started = True
+        self.anim_key = anim_key
+        self.anim_index = anim_index
+        self.flipped = flipped
+        self.pos = pos
+        self.attacks = attacks
+
+    def get_state(self):
+        """ Return the complete state of the player, as plain data. """
+        return [self.anim_key, self.anim_index, self.flipped, self.pos, self.attacks, self.immune, self.immune_frame,
+                self.can_kill]
+
+    def set_state(self, state):
+        """ Restore a state returned by get_state(). """
+        (self.anim_key, self.anim_index, self.flipped, self.pos, self.attacks, self.immune, self.immune_frame,
+         self.can_kill) = state
+
+
+class Match:
+    def __init__(self, conns, team_name, leaderboard, seed=None, recorder=None, name=None, telemetry=None):
+        """ Prepare a match between two connected clients.
+
+        Parameters:
+            conns (list of transports or stream sockets): Connections with the two clients, already accepted.
+            team_name (string): The name of the team, shown to both clients and recorded on the leaderboard.
+            leaderboard (function): Called with the team name and the final score once the match ends. Must return
+                the top teams, the rank of the team and the time window of the leaderboard, as expected by
+                encode_db_data().
+            seed (int): Seed for the random events of the match. A random one is picked if not given.
+            recorder (jazz_replay.ReplayWriter): Records the match for later playback. Leave empty to not record.
+            name (string): Name of the match in the metrics (see jazz_metrics), e.g. the room code. Leave empty to use
+                the team name.
+            telemetry (jazz_telemetry.MatchTelemetry): Reports the gameplay events of the match. Leave empty to not
+                report them.
+        """
+
+        self.team_name = team_name
+        self.name = name if name is not None else team_name
+        self.leaderboard = leaderboard
+        self.seed = seed if seed is not None else Random().getrandbits(32)
+        self.rng = Random(self.seed)
+        if self.rng.random() < 0.5:
+            roles = ("s", "z")
+        else:
+            roles = ("z", "s")
+        self.players = [Player(jazz_transport.wrap(conns[0]), roles[0]),
+                        Player(jazz_transport.wrap(conns[1]), roles[1])]
+        self.level_index = 0
+        self.score = 0                  # For all levels. Shared for the team.
+        self.tick = 0                   # Frames simulated in the current level.
+        self.total_ticks = 0            # Frames simulated in all levels.
+        self.broadcaster = Broadcaster()
+        self.recorder = recorder
+        self.telemetry = telemetry
+        self.reset_level()
+
+    def reset_level(self):
+        """ Prepare the gameplay state for the current level. """
+        self.hp = jo.FULL_HP
+        self.enemies_killed = 0
+        self.slimes = []
+        self.swords = []
+        self.slimes_to_spawn = jo.levels[self.level_index].enemies_num
+        self.tick = 0
+        for player in self.players:
+            player.reset()
+
+    def get_state(self):
+        """ Return the complete gameplay state of the match, as plain data that can be encoded as JSON. """
+        return {
+            "level_index": self.level_index,
+            "score": self.score,
+            "tick": self.tick,
+            "total_ticks": self.total_ticks,
+            "hp": self.hp,
+            "enemies_killed": self.enemies_killed,
+            "slimes": self.slimes,
+            "swords": self.swords,
+            "slimes_to_spawn": self.slimes_to_spawn,
+            "rng": self.rng.getstate(),
+            "players": [player.get_state() for player in self.players]
+        }
+
+    def set_state(self, state):
+        """ Restore a state returned by get_state(), possibly after a JSON round trip. """
+        self.level_index = state["level_index"]
+        self.score = state["score"]
+        self.tick = state["tick"]
+        self.total_ticks = state["total_ticks"]
+        self.hp = state["hp"]
+        self.enemies_killed = state["enemies_killed"]
+        self.slimes = [list(slime) for slime in state["slimes"]]
+        self.swords = list(state["swords"])
+        self.slimes_to_spawn = state["slimes_to_spawn"]
+        version, internal_state, gauss_next = state["rng"]
+        self.rng.setstate((version, tuple(internal_state), gauss_next))
+        for player, player_state in zip(self.players, state["players"]):
+            player.set_state(list(player_state))
+
+    def calculate_score(self):
+        """ Add the score of the current level to the total score of the team and return the level score. """
+        level_score = self.enemies_killed * jo.SLIME_POINTS + self.hp * jo.HP_POINTS
+        self.score += level_score
+        return level_score
+
+    def step(self):
+        """ Simulate one frame of gameplay, using the latest state reported by the clients. Return whether the level
+        or the game has ended. """
+        start = time.perf_counter()
+        self.tick += 1
+        self.total_ticks += 1
+        # Take a chance at spawning enemies and swords.
+        if self.slimes_to_spawn > 0 and self.rng.random() < 0.25 * delta_time:
+            jo.spawn_slime(self.slimes, self.level_index, self.rng.random)
+            self.slimes_to_spawn -= 1
+            if self.telemetry is not None:
+                self.telemetry.spawn(self.level_index, self.tick, self.slimes[-1][0])
+        if len(self.swords) < jo.MAX_SWORDS and self.rng.random() < 0.07 * delta_time:
+            jo.spawn_sword(self.swords, self.rng.random)
+        # Update the slimes regarding NPC movement and animation.
+        jo.move_slimes(self.slimes, [player.pos for player in self.players], enemy_vel)
+        self.handle_collisions()
+        jazz_metrics.TICK_SECONDS.observe(time.perf_counter() - start)
+        jazz_metrics.MATCH_SLIMES.set(len(self.slimes), match=self.name)
+        return self.hp <= 0 or self.enemies_killed >= jo.levels[self.level_index].enemies_num
+
+    def handle_collisions(self):
+        """ Check both players for collisions with the swords and the enemies of the current frame. """
+        slime_rects = jo.slime_rects(self.slimes)
+        sword_rects = jo.sword_rects(self.swords, self.level_index)
+        for player in self.players:
+            rect = jo.teammate_rect(player.anim_key, player.anim_index, player.role, player.pos, player.flipped)
+            if player.attack_started:
+                player.attack_started = False
+                if self.telemetry is not None:
+                    self.telemetry.attack(self.level_index, self.tick, player.role, player.pos, player.attacks)
+            # Check if a sword was picked. The client counts the extra attack on its own.
+            for sword_rect in sword_rects:
+                if rect.colliderect(sword_rect):
+                    sword = self.swords.pop(sword_rects.index(sword_rect))
+                    sword_rects.remove(sword_rect)      # In case both players touch the same sword at the same frame.
+                    if self.telemetry is not None:
+                        self.telemetry.sword(self.level_index, self.tick, player.role,
+                                             jo.levels[self.level_index].sword_spawns[sword])
+                    break
+            # Check if there is conflict with an enemy.
+            for slime_rect in slime_rects:
+                if rect.colliderect(slime_rect):
+                    if player.anim_key == "attack" and player.can_kill:                 # Kill an enemy.
+                        player.can_kill = False
+                        self.enemies_killed += 1
+                        slime = self.slimes.pop(slime_rects.index(slime_rect))
+                        slime_rects.remove(slime_rect)  # In case both players kill the same enemy at the same frame.
+                        if self.telemetry is not None:
+                            self.telemetry.kill(self.level_index, self.tick, player.role, slime[0])
+                    elif not player.anim_key == "attack" and not player.immune:         # Take damage.
+                        player.immune = True
+                        player.immune_frame = 0
+                        self.hp -= 1
+                        if self.telemetry is not None:
+                            self.telemetry.damage(self.level_index, self.tick, player.role, player.pos, self.hp)
+                    break
+            # Track immunity duration.
+            if player.immune:
+                player.immune_frame += 1
+                if player.immune_frame >= immune_frames:
+                    player.immune = False
+
+    def encode_frame(self, index, stop):
+        """ Encode the frame data for the player with the given index, presenting the teammate as the host. """
+        mate = self.players[1 - index]
+        return jo.encode_frame_data(mate.anim_key, mate.anim_index, mate.flipped, mate.pos, mate.attacks, self.hp,
+                                    self.slimes, self.swords, stop)
+
+    def send_all(self, data):
+        """ Send the same message to both clients. """
+        for player in self.players:
+            player.conn.send(data)
+
+    def encode_snapshot(self, stop):
+        """ Encode the whole game state of the current frame for spectators. """
+        players = [(player.role, player.anim_key, player.anim_index, player.flipped, player.pos, player.attacks)
+                   for player in self.players]
+        return jo.encode_spectator_data(self.team_name, self.level_index, self.score, players, self.hp, self.slimes,
+                                        self.swords, stop)
+
+    def exchange_frame(self, stop):
+        """ Send the current frame to both clients and wait for their replies. """
+        for index, player in enumerate(self.players):
+            frame_data = self.encode_frame(index, stop)
+            player.conn.send(frame_data)
+            jazz_metrics.BYTES_SENT.inc(len(frame_data))
+        for player in self.players:
+            frame_data = player.conn.receive(2048)
+            jazz_metrics.BYTES_RECEIVED.inc(len(frame_data))
+            if len(frame_data) == 0:
+                raise ConnectionResetError("Client closed the connection.")
+            try:
+                player.update(frame_data)
+            except decoder.JSONDecodeError:
+                print("Failed to decode frame update information from client.")
+            except (ValueError, KeyError, TypeError):      # Not a client of the game, e.g. not UTF-8 or keys missing.
+                raise ConnectionResetError("Client sent invalid frame data.")
+
+    def play_level(self):
+        """ Run the gameplay of the current level, until it is cleared or the team runs out of health. """
+        stop = False
+        while not stop:
+            if self.recorder is not None and self.recorder.wants_keyframe(self.tick):
+                self.recorder.keyframe(self.total_ticks, self.get_state())
+            stop = self.step()
+            if self.broadcaster.has_spectators():
+                self.broadcaster.publish(self.encode_snapshot(stop))    # Encoded once for all spectators.
+            self.exchange_frame(stop)
+            if self.recorder is not None:
+                self.recorder.inputs(self.players)
+        if self.telemetry is not None:
+            self.telemetry.end(self.level_index, self.tick, max(self.hp, 0))
+
+    def run(self):
+        """ Host the whole match, from the team name to the leaderboard. Return the final score or None if a client
+        disconnected before the end. """
+        if self.recorder is not None:
+            self.recorder.header(self.seed, self.team_name, [player.role for player in self.players])
+        jazz_metrics.ACTIVE_MATCHES.inc()
+        jazz_metrics.MATCH_PLAYERS.set(len(self.players), match=self.name)
+        try:
+            self.send_all(self.team_name.encode())
+            time.sleep(jazz_handshake.MESSAGE_GAP)
+            for player in self.players:
+                player.conn.send(player.role.encode())
+            time.sleep(jazz_handshake.MESSAGE_GAP)
+            while True:
+                self.send_all(jo.encode_start_data())
+                time.sleep(jo.COUNTDOWN_SEC)
+                self.play_level()
+                if self.hp <= 0 or self.level_index == len(jo.levels) - 1:
+                    break
+                # Level cleared.
+                self.send_all(str(self.calculate_score()).encode())
+                time.sleep(INTERMISSION_SEC)
+                self.level_index += 1
+                self.reset_level()
+                for player in self.players:
+                    player.attacks = jo.INIT_ATTACKS - 1
+            self.calculate_score()
+            if self.recorder is not None:
+                self.recorder.end(self.score)
+            self.send_all(str(self.score).encode())
+            time.sleep(jazz_handshake.MESSAGE_GAP)
+            top_teams, team_rank, window = self.leaderboard(self.team_name, self.score)
+            self.send_all(jo.encode_db_data(top_teams, team_rank, window))
+            return self.score
+        except socket.error:
+            print("Lost connection to a client of team '" + self.team_name + "'.")
+            return None
+        finally:
+            jazz_metrics.ACTIVE_MATCHES.inc(-1)
+            jazz_metrics.MATCH_PLAYERS.remove(match=self.name)
+            jazz_metrics.MATCH_SLIMES.remove(match=self.name)
+            self.broadcaster.close()
+            if self.recorder is not None:
+                self.recorder.close()
+            for player in self.players:
+                try:
+                    player.conn.close()
+                except socket.error:
+                    print("Error closing connection.")
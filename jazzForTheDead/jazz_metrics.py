@@ -0,0 +1,278 @@
+""" Metrics endpoint for the "Jazz for the dead!" servers.
+
+Counters, gauges and histograms are kept in a registry per process and served as plain text in the Prometheus
+exposition format, at http://127.0.0.1:<port>/metrics. The listener never blocks: jazz_server.py polls it once per
+frame and the dedicated server polls it on a thread of its own, so a slow or stuck scraper cannot stall a game loop.
+The worker processes of the dedicated server send snapshots of their registries to the main process, which serves them
+with a "worker" label.
+
+Metrics:
+    jazz_active_matches                 Matches currently in gameplay or between levels.
+    jazz_tick_seconds                   Time spent simulating a gameplay frame, without waiting for the clients.
+    jazz_match_slimes{match}            Enemies on the map, per match.
+    jazz_match_players{match}           Players connected, per match.
+    jazz_bytes_received_total           Frame data received from the clients.
+    jazz_bytes_sent_total               Frame data sent to the clients.
+    jazz_leaderboard_query_seconds      Time spent submitting a score and reading the leaderboard.
+    jazz_db_busy_retries_total          Queries retried because another connection held the database locked.
+    jazz_send_queue_depth               Messages waiting to be sent to the client (see jazz_sendqueue).
+    jazz_snapshots_coalesced_total      Frame snapshots replaced by a newer one before being sent.
+    jazz_send_queue_full_total          Reliable messages that found the send queue full and waited for it.
+"""
+
+import selectors
+import socket
+import threading
+
+TIME_BUCKETS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1]     # Upper bounds, in seconds.
+METRICS_HOST = "127.0.0.1"          # Only local scrapers.
+MAX_REQUEST = 4096                  # Connections sending longer requests are dropped.
+
+
+class Metric:
+    def __init__(self, kind, name, help_text, buckets=None):
+        """ Prepare a metric with no samples.
+
+        Parameters:
+            kind (string): Either 'counter', 'gauge' or 'histogram'.
+            name (string): Name of the metric, as scraped.
+            help_text (string): Single line description of the metric.
+            buckets (list of floats): Upper bounds of the buckets of a histogram.
+        """
+
+        self.kind = kind
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.values = {}            # Values (or bucket counts, sum and count for histograms), by sorted label pairs.
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """ Add to a counter or gauge. """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """ Set the value of a gauge. """
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def observe(self, value, **labels):
+        """ Count a value in a histogram. """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0]
+            counts = self.values[key][0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.values[key][1] += value
+            self.values[key][2] += 1
+
+    def remove(self, **labels):
+        """ Drop the samples with the given labels, e.g. of a match that ended. """
+        with self.lock:
+            self.values.pop(tuple(sorted(labels.items())), None)
+
+    def snapshot(self):
+        """ Return the metric as plain data that can be sent to another process. """
+        with self.lock:
+            if self.kind == "histogram":
+                values = {key: [list(value[0]), value[1], value[2]] for key, value in self.values.items()}
+            else:
+                values = dict(self.values)
+        return self.kind, self.name, self.help_text, self.buckets, values
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}           # By name, in order of creation.
+        self.lock = threading.Lock()
+
+    def get(self, kind, name, help_text, buckets=None):
+        """ Return the metric with the given name, created on first use. """
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Metric(kind, name, help_text, buckets)
+            return self.metrics[name]
+
+    def snapshot(self):
+        """ Return all metrics as plain data that can be sent to another process. """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return [metric.snapshot() for metric in metrics]
+
+
+def format_labels(pairs):
+    """ Return label pairs in the exposition format, e.g. '{match="ABCD",worker="0"}', or nothing if there are none. """
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                          for key, value in pairs) + "}"
+
+
+def render(sources):
+    """ Return the metrics of several registries as text in the Prometheus exposition format.
+
+    Parameters:
+        sources (list of tuples): Snapshots of registries, each with the label pairs (tuple) to add to all of its
+            samples, e.g. (("worker", 0),).
+
+    Returns:
+        (string): The text to serve at /metrics.
+    """
+
+    families = {}               # Metrics of all sources, by name.
+    for snapshot, extra in sources:
+        for kind, name, help_text, buckets, values in snapshot:
+            family = families.setdefault(name, (kind, help_text, buckets, []))
+            for key, value in values.items():
+                family[3].append((key + tuple(extra), value))
+    lines = []
+    for name, (kind, help_text, buckets, samples) in families.items():
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " " + kind)
+        for key, value in samples:
+            if kind != "histogram":
+                lines.append(name + format_labels(key) + " " + str(value))
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(name + "_bucket" + format_labels(key + (("le", bound),)) + " " + str(cumulative))
+            lines.append(name + "_bucket" + format_labels(key + (("le", "+Inf"),)) + " " + str(count))
+            lines.append(name + "_sum" + format_labels(key) + " " + str(total))
+            lines.append(name + "_count" + format_labels(key) + " " + str(count))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    def __init__(self, port, sources=None):
+        """ Listen for scrapers on a local port, without blocking.
+
+        Parameters:
+            port (int): Port to serve /metrics on.
+            sources (function): Returns the sources to render, as expected by render(). Leave empty to serve the
+                registry of this process.
+        """
+
+        self.sources = sources or (lambda: [(REGISTRY.snapshot(), ())])
+        self.selector = selectors.DefaultSelector()
+        self.requests = {}          # Partial requests, by connection.
+        self.replies = {}           # Rest of the replies not yet sent, by connection.
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((METRICS_HOST, port))
+        self.listener.listen(socket.SOMAXCONN)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+    def poll(self, timeout=0):
+        """ Serve every scraper that is ready, waiting up to timeout seconds (forever if None) for one to be. """
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.listener:
+                self.accept()
+            elif key.fileobj in self.replies:
+                self.write(key.fileobj)
+            elif key.fileobj in self.requests:
+                self.read(key.fileobj)
+
+    def serve_forever(self):
+        """ Serve scrapers until the process ends. Blocking, meant for a thread of its own. """
+        while True:
+            self.poll(None)
+
+    def accept(self):
+        """ Accept all pending connections. """
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error:
+                print("Failed to accept a metrics connection.")
+                return
+            conn.setblocking(False)
+            self.requests[conn] = b""
+            self.selector.register(conn, selectors.EVENT_READ)
+
+    def read(self, conn):
+        """ Receive a request and reply once its headers are complete. """
+        try:
+            data = conn.recv(1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b""
+        request = self.requests[conn] + data
+        if len(data) == 0 or len(request) > MAX_REQUEST:
+            self.close(conn)
+            return
+        self.requests[conn] = request
+        if b"\r\n\r\n" not in request and b"\n\n" not in request:
+            return
+        if request.startswith(b"GET /metrics ") or request.startswith(b"GET / "):
+            body = render(self.sources()).encode()
+            status = "200 OK"
+        else:
+            body = b"Not found.\n"
+            status = "404 Not Found"
+        header = ("HTTP/1.0 " + status + "\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " +
+                  str(len(body)) + "\r\nConnection: close\r\n\r\n")
+        del self.requests[conn]
+        self.replies[conn] = memoryview(header.encode() + body)
+        self.selector.modify(conn, selectors.EVENT_WRITE)
+        self.write(conn)
+
+    def write(self, conn):
+        """ Send as much of a reply as possible without blocking, and close the connection once all of it is sent. """
+        try:
+            sent = conn.send(self.replies[conn])
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            self.close(conn)
+            return
+        self.replies[conn] = self.replies[conn][sent:]
+        if len(self.replies[conn]) == 0:
+            self.close(conn)
+
+    def close(self, conn):
+        """ Stop serving a scraper and close the connection. """
+        self.selector.unregister(conn)
+        self.requests.pop(conn, None)
+        self.replies.pop(conn, None)
+        try:
+            conn.close()
+        except socket.error:
+            print("Error closing connection.")
+
+
+REGISTRY = Registry()
+ACTIVE_MATCHES = REGISTRY.get("gauge", "jazz_active_matches", "Matches currently in gameplay or between levels.")
+TICK_SECONDS = REGISTRY.get("histogram", "jazz_tick_seconds",
+                            "Time spent simulating a gameplay frame, without waiting for the clients.", TIME_BUCKETS)
+MATCH_SLIMES = REGISTRY.get("gauge", "jazz_match_slimes", "Enemies on the map, per match.")
+MATCH_PLAYERS = REGISTRY.get("gauge", "jazz_match_players", "Players connected, per match.")
+BYTES_RECEIVED = REGISTRY.get("counter", "jazz_bytes_received_total", "Frame data received from the clients.")
+BYTES_SENT = REGISTRY.get("counter", "jazz_bytes_sent_total", "Frame data sent to the clients.")
+LEADERBOARD_SECONDS = REGISTRY.get("histogram", "jazz_leaderboard_query_seconds",
+                                   "Time spent submitting a score and reading the leaderboard.", TIME_BUCKETS)
+DB_BUSY_RETRIES = REGISTRY.get("counter", "jazz_db_busy_retries_total",
+                               "Queries retried because another connection held the database locked.")
+SEND_QUEUE_DEPTH = REGISTRY.get("gauge", "jazz_send_queue_depth", "Messages waiting to be sent to the client.")
+SNAPSHOTS_COALESCED = REGISTRY.get("counter", "jazz_snapshots_coalesced_total",
+                                   "Frame snapshots replaced by a newer one before being sent.")
+SEND_QUEUE_FULL = REGISTRY.get("counter", "jazz_send_queue_full_total",
+                               "Reliable messages that found the send queue full and waited for it.")
+# Scraped as zero before the first match.
+ACTIVE_MATCHES.set(0)
+BYTES_RECEIVED.inc(0)
+BYTES_SENT.inc(0)
+SEND_QUEUE_DEPTH.set(0)
+SNAPSHOTS_COALESCED.inc(0)
+SEND_QUEUE_FULL.inc(0)
@@ -0,0 +1,374 @@
+""" Network link emulator for the "Jazz for the dead!" game.
+
+A TCP or UDP proxy to put between the client and the server, or between bots and a dedicated server, that makes the
+loopback interface or a LAN behave like a worse link. Each direction of every connection is a link of its own, with:
+    latency     Time (in ms) every message takes, one way.
+    jitter      Random change (in ms) of the latency, up to this much in either direction.
+    bandwidth   Cap (in kbit/s) of the link, 0 for none. Messages wait for the ones before them to go through.
+    loss        Fraction of the messages lost. UDP drops them. TCP never loses data, so a lost message is sent again
+                RETRANSMIT_MS later instead, holding up the ones behind it, as a retransmission would.
+    reorder     Fraction of the messages held back REORDER_MS, so that the ones sent after them arrive first. Only over
+                UDP: TCP always delivers in order.
+A message is whatever a single receive of the proxy returns: a datagram over UDP, usually a whole game message over
+TCP. The time every message takes through the proxy is written to a CSV log, and a summary of the delays is printed
+per condition.
+
+Conditions are given on the command line, or swept from a JSON file with a list of conditions, e.g.
+[{"name": "lan"}, {"name": "wifi", "latency": 5, "jitter": 3, "loss": 0.01}, {"name": "dsl", "latency": 40}].
+Each condition holds for "duration" seconds (--duration by default), or while --command runs, e.g. a load generator
+(see jazz_loadgen), started once per condition. Scripts may also run a LinkEmulator themselves and change its
+conditions as they go.
+
+The proxy listens on the port of the game, so the client needs no change, and the server must listen on another one.
+A client on the same host as the server would send its gameplay frames through shared memory instead of the proxy,
+so disable it on the client (see jazz_sharedmem).
+
+Usage:
+    JAZZ_PORT=2001 python jazz_server.py
+    python jazz_netem.py --latency 40 --jitter 10 --loss 0.01 --log timing.csv
+    JAZZ_SHARED_MEMORY=0 python jazz_client.py
+or, to sweep conditions against a dedicated server:
+    python jazz_dedicated.py --port 2001
+    python jazz_netem.py --sweep conditions.json --command "python jazz_loadgen.py --port 2000 --pairs 10"
+"""
+
+import os
+
+# jazz_operations loads fonts. Must be set before pygame is initialized.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import jazz_operations as jo
+import jazz_transport
+from jazz_netstats import Histogram, TIME_BUCKETS
+import argparse
+import csv
+import heapq
+import json
+import selectors
+import socket
+import subprocess
+import threading
+import time
+from random import Random
+
+RETRANSMIT_MS = 200         # Delay of a message lost over TCP, like a minimal retransmission timeout.
+REORDER_MS = 50             # Delay of a reordered message over UDP.
+MAX_MESSAGE = 65536         # Largest message received at once.
+SELECT_TIMEOUT = 0.1        # Longest wait (in seconds) of the proxy loop, to notice when it is stopped.
+DIRECTIONS = ["up", "down"]         # From the client to the server, and back.
+
+
+class Conditions:
+    def __init__(self, name="", latency=0, jitter=0, bandwidth=0, loss=0, reorder=0, duration=None):
+        """ Describe an emulated link.
+
+        Parameters:
+            name (string): Name of the conditions in the summary and the log.
+            latency (float): Time (in ms) every message takes, one way.
+            jitter (float): Random change (in ms) of the latency, up to this much in either direction.
+            bandwidth (float): Cap (in kbit/s) of each direction of the link, 0 for none.
+            loss (float): Fraction of the messages lost.
+            reorder (float): Fraction of the messages held back, over UDP.
+            duration (float): Time (in seconds) the conditions hold during a sweep. None for the default.
+        """
+
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.reorder = reorder
+        self.duration = duration
+
+    def describe(self):
+        """ Return the conditions as text. """
+        bandwidth = str(self.bandwidth) + "kbit/s" if self.bandwidth > 0 else "none"
+        return (self.name + (" " if len(self.name) > 0 else "") + "latency=" + str(self.latency) + "ms jitter=" +
+                str(self.jitter) + "ms bandwidth=" + bandwidth + " loss=" + str(self.loss) + " reorder=" +
+                str(self.reorder))
+
+
+class Link:
+    def __init__(self, direction, ordered):
+        """ Prepare an idle direction of a connection. Ordered links, i.e. over TCP, never deliver a message before
+        the one sent before it, and never lose one. """
+        self.direction = direction
+        self.ordered = ordered
+        self.free_at = 0            # Time (as returned by time.perf_counter()) the link is done sending.
+        self.last_due = 0           # Time the latest message is delivered.
+
+    def schedule(self, size, now, conditions, rng):
+        """ Return the time (as returned by time.perf_counter()) a message of the given size that reached the proxy
+        now is delivered, or None if it is lost, and what happened to it. """
+        start = max(now, self.free_at)
+        self.free_at = start + (size * 8 / (conditions.bandwidth * 1000) if conditions.bandwidth > 0 else 0)
+        due = self.free_at + max(conditions.latency + rng.uniform(-conditions.jitter, conditions.jitter), 0) / 1000
+        fate = "delivered"
+        if rng.random() < conditions.loss:
+            if not self.ordered:
+                return None, "lost"
+            due += RETRANSMIT_MS / 1000
+            fate = "retransmitted"
+        elif not self.ordered and rng.random() < conditions.reorder:
+            due += REORDER_MS / 1000
+            fate = "reordered"
+        if self.ordered:
+            due = max(due, self.last_due)
+        self.last_due = max(due, self.last_due)
+        return due, fate
+
+    def close(self, now):
+        """ Return the time the closing of the connection is delivered, after every message sent before it. """
+        return max(now, self.last_due)
+
+
+class LinkStats:
+    def __init__(self):
+        """ Prepare empty statistics of a direction. """
+        self.delays = Histogram(TIME_BUCKETS)       # Time (in ms) from receiving a message to delivering it.
+        self.bytes = 0
+        self.fates = {"delivered": 0, "lost": 0, "retransmitted": 0, "reordered": 0}
+
+    def summary(self):
+        """ Return the statistics as text. """
+        return ("messages=" + str(sum(self.fates.values())) + " bytes=" + str(self.bytes) + " " +
+                " ".join(fate + "=" + str(count) for fate, count in self.fates.items() if fate != "delivered") +
+                " delay ms: " + self.delays.summary())
+
+
+class LinkEmulator:
+    def __init__(self, server, port=jo.PORT, kind=jazz_transport.TRANSPORT, conditions=None, log_path=None,
+                 seed=None):
+        """ Prepare a proxy to a server, under the given conditions.
+
+        Parameters:
+            server (tuple): Host (string) and port (int) of the server.
+            port (int): Port to listen to for clients, on all interfaces.
+            kind (string): Either 'tcp' or 'udp', as the game (see jazz_transport).
+            conditions (Conditions): Conditions of the link. Leave empty for a perfect link.
+            log_path (string): Path of the CSV file to log every message to. Leave empty to log nothing.
+            seed (int): Seed of the random losses, jitter and reordering, to repeat a run. Leave empty for a random
+                one.
+        """
+
+        self.server = server
+        self.kind = kind
+        self.conditions = conditions if conditions is not None else Conditions()
+        self.rng = Random(seed)
+        self.listener = jazz_transport.listen("0.0.0.0", port, kind)
+        self.listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.peers = {}             # Over TCP, the other socket of every connection, by socket.
+        self.links = {}             # Link towards every socket, or client address over UDP.
+        self.upstreams = {}         # Over UDP, the socket connected to the server, by client address.
+        self.pending = []           # Heap of the messages on their way.
+        self.received = 0           # Messages received so far, to keep the heap in order of arrival on a tie.
+        self.stats = {direction: LinkStats() for direction in DIRECTIONS}
+        self.stopped = threading.Event()
+        self.thread = None
+        self.log_file = open(log_path, "w", newline="") if log_path is not None else None
+        self.log = csv.writer(self.log_file) if self.log_file is not None else None
+        if self.log is not None:
+            self.log.writerow(["time", "conditions", "direction", "size", "delay_ms", "fate"])
+
+    def set_conditions(self, conditions):
+        """ Change the conditions of the link, for the messages received from now on. """
+        self.conditions = conditions
+
+    def reset_stats(self):
+        """ Start over with empty statistics, e.g. for the next conditions of a sweep. """
+        self.stats = {direction: LinkStats() for direction in DIRECTIONS}
+
+    def summary(self):
+        """ Return the conditions and the statistics of both directions as text. """
+        return (self.conditions.describe() + "\n" +
+                "\n".join("    " + direction.ljust(6) + self.stats[direction].summary() for direction in DIRECTIONS))
+
+    def start(self):
+        """ Run the proxy on a thread of its own. """
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the proxy and close every connection. Messages still on their way are lost. """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+        if self.log_file is not None:
+            self.log_file.close()
+
+    def serve(self):
+        """ Forward messages until stopped. Blocking. """
+        while not self.stopped.is_set():
+            timeout = SELECT_TIMEOUT
+            if len(self.pending) > 0:
+                timeout = min(max(self.pending[0][0] - time.perf_counter(), 0), SELECT_TIMEOUT)
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is self.listener:
+                    self.accept()
+                else:
+                    self.receive(key.fileobj, key.data)
+            now = time.perf_counter()
+            while len(self.pending) > 0 and self.pending[0][0] <= now:
+                self.deliver(*heapq.heappop(self.pending)[2:])
+
+    def accept(self):
+        """ Take a new client, or a message of a UDP client. """
+        if self.kind == "udp":
+            try:
+                data, addr = self.listener.recvfrom(MAX_MESSAGE)
+            except (BlockingIOError, InterruptedError):
+                return
+            if addr not in self.upstreams:
+                upstream = jazz_transport.new_socket("udp")
+                upstream.connect(self.server)
+                self.upstreams[addr] = upstream
+                self.links[upstream] = Link("up", ordered=False)
+                self.links[addr] = Link("down", ordered=False)
+                self.selector.register(upstream, selectors.EVENT_READ, addr)
+            self.forward(data, self.upstreams[addr], None)
+            return
+        try:
+            conn, addr = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        try:
+            upstream = socket.create_connection(self.server)
+        except socket.error:
+            print("Failed to connect to the server at " + self.server[0] + ":" + str(self.server[1]) + ".")
+            conn.close()
+            return
+        for sock, peer, direction in ((conn, upstream, "down"), (upstream, conn, "up")):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.peers[sock] = peer
+            self.links[sock] = Link(direction, ordered=True)
+            self.selector.register(sock, selectors.EVENT_READ)
+
+    def receive(self, sock, addr):
+        """ Take a message from a socket and send it on its way. Over UDP, addr is the client of an upstream
+        socket. """
+        try:
+            data = sock.recv(MAX_MESSAGE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b""
+        if self.kind == "udp":
+            self.forward(data, self.listener, addr)
+        elif len(data) == 0:                # Closed: close the other side too, once the data before it arrived.
+            self.selector.unregister(sock)
+            self.forward(None, self.peers[sock], None)
+        else:
+            self.forward(data, self.peers[sock], None)
+
+    def forward(self, data, sock, addr):
+        """ Schedule a message (None to close the connection) for delivery to a socket, or to a client address of the
+        UDP listener. """
+        link = self.links[addr if addr is not None else sock]
+        now = time.perf_counter()
+        if data is None or len(data) == 0:          # Closing is never lost, and never overtakes the data.
+            due, fate = link.close(now), "delivered"
+        else:
+            due, fate = link.schedule(len(data), now, self.conditions, self.rng)
+        if due is None:
+            self.record(link.direction, len(data), None, fate)
+            return
+        self.received += 1
+        heapq.heappush(self.pending, (due, self.received, data, sock, addr, link.direction, now, fate))
+
+    def deliver(self, data, sock, addr, direction, arrival, fate):
+        """ Hand a message over to its destination. """
+        try:
+            if data is None:
+                self.close(sock)
+            elif addr is not None:
+                sock.sendto(data, addr)
+            else:
+                sock.sendall(data)
+        except socket.error:
+            self.close(sock)
+            return
+        self.record(direction, len(data) if data is not None else 0, (time.perf_counter() - arrival) * 1000, fate)
+
+    def close(self, sock):
+        """ Close a TCP connection on both sides. """
+        for end in (sock, self.peers.get(sock)):
+            if end is None or end.fileno() < 0:
+                continue
+            if end in self.selector.get_map():
+                self.selector.unregister(end)
+            self.peers.pop(end, None)
+            self.links.pop(end, None)
+            end.close()
+
+    def record(self, direction, size, delay, fate):
+        """ Count a message in the statistics and the log. The delay (in ms) is None for a lost message. """
+        if size == 0:
+            return
+        stats = self.stats[direction]
+        stats.bytes += size
+        stats.fates[fate] += 1
+        if delay is not None:
+            stats.delays.add(delay)
+        if self.log is not None:
+            self.log.writerow([format(time.time(), ".6f"), self.conditions.name, direction, size,
+                               format(delay, ".3f") if delay is not None else "", fate])
+
+
+def load_sweep(path):
+    """ Return the list of conditions in a JSON sweep file. """
+    with open(path) as file:
+        return [Conditions(**entry) for entry in json.load(file)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Network link emulator for Jazz for the dead!")
+    parser.add_argument("--port", type=int, default=jo.PORT, help="port to listen to for clients")
+    parser.add_argument("--server", default="127.0.0.1:" + str(jo.PORT + 1), help="address of the server, HOST:PORT")
+    parser.add_argument("--transport", choices=sorted(jazz_transport.SOCKET_TYPES), default=jazz_transport.TRANSPORT)
+    parser.add_argument("--latency", type=float, default=0, help="one way latency in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="random change of the latency in ms")
+    parser.add_argument("--bandwidth", type=float, default=0, help="cap of each direction in kbit/s, 0 for none")
+    parser.add_argument("--loss", type=float, default=0, help="fraction of the messages lost")
+    parser.add_argument("--reorder", type=float, default=0, help="fraction of the messages reordered, over UDP")
+    parser.add_argument("--seed", type=int, help="seed of the random conditions, to repeat a run")
+    parser.add_argument("--log", help="CSV file to log the timing of every message to")
+    parser.add_argument("--sweep", help="JSON file with a list of conditions to go through")
+    parser.add_argument("--command", help="command to run once per condition of the sweep")
+    parser.add_argument("--duration", type=float, default=60, help="seconds per condition of a sweep, without command")
+    args = parser.parse_args()
+
+    host, _, port = args.server.rpartition(":")
+    if args.sweep is not None:
+        sweep = load_sweep(args.sweep)
+    else:
+        sweep = [Conditions("", args.latency, args.jitter, args.bandwidth, args.loss, args.reorder)]
+    emulator = LinkEmulator((host, int(port)), args.port, args.transport, sweep[0], args.log, args.seed)
+    emulator.start()
+    print("Forwarding port " + str(args.port) + " to " + args.server + " over " + args.transport + ".")
+    try:
+        if args.sweep is None:
+            print(emulator.conditions.describe())
+            emulator.stopped.wait()             # Until interrupted.
+        for conditions in sweep:
+            emulator.set_conditions(conditions)
+            emulator.reset_stats()
+            if args.command is not None:
+                subprocess.run(args.command, shell=True)
+            else:
+                time.sleep(conditions.duration if conditions.duration is not None else args.duration)
+            print(emulator.summary())
+    except KeyboardInterrupt:
+        if args.sweep is None:
+            print(emulator.summary())
+    finally:
+        emulator.stop()
+
+
+if __name__ == "__main__":
+    main()
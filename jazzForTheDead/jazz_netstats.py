@@ -0,0 +1,188 @@
+""" Network telemetry for the "Jazz for the dead!" game.
+
+Wrap the send and receive calls of the gameplay frames and keep histograms of:
+    sent/received   Size (in bytes) of each frame message.
+    rtt             Round trip (in ms) of a frame: every stamped message carries the time it was sent and echoes the
+                    stamp of the last message received from the peer, so the time until the echo comes back is known.
+                    Includes the time the peer needs to reply.
+    jitter          Change (in ms) of the time between two received frames, from one frame to the next.
+    send            Time (in ms) spent sending a frame. Sends that take longer than STALL_MS count as stalls, which
+                    means the send buffer was full and the link cannot keep up.
+Failed decodes and short reads (empty or cut-off messages) are counted as well. A summary of the histograms is written
+every LOG_INTERVAL seconds to a log file, rotated when it grows over LOG_MAX_BYTES.
+
+Set the JAZZ_NET_LOG environment variable to the path of the log file to collect the telemetry. Without it, nothing is
+stamped or measured and every call returns right away.
+"""
+
+import logging
+import logging.handlers
+import os
+import time
+from bisect import bisect_left
+
+SIZE_BUCKETS = [64, 128, 256, 512, 1024, 1536, 2048, 4096]                  # Upper bounds, in bytes.
+TIME_BUCKETS = [0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 250, 1000]             # Upper bounds, in ms.
+STALL_MS = 1                        # A sendall() that takes longer than this (in ms) is a stall.
+LOG_INTERVAL = 10                   # Time (in seconds) between two summaries in the log.
+LOG_MAX_BYTES = 1024 * 1024         # Size of the log file before it is rotated.
+LOG_BACKUPS = 3                     # Rotated log files kept.
+
+
+class Histogram:
+    def __init__(self, buckets):
+        """ Prepare an empty histogram with the given upper bounds. Values above the last bound share an extra
+        bucket. """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        """ Count a single value. """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """ Return the upper bound of the bucket below which the given fraction of the values falls, or the largest
+        value if it falls in the extra bucket. """
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def summary(self):
+        """ Return the count, mean, median, 99th percentile and maximum as text. """
+        if self.count == 0:
+            return "n=0"
+        return ("n=" + str(self.count) + " mean=" + format(self.total / self.count, ".2f") + " p50<=" +
+                str(self.percentile(0.5)) + " p99<=" + str(self.percentile(0.99)) + " max=" +
+                format(self.max, ".2f"))
+
+
+class NetStats:
+    def __init__(self, name, log_path=None):
+        """ Prepare the telemetry of a connection, enabled if a log path is given.
+
+        Parameters:
+            name (string): Name of the connection in the log, e.g. the script.
+            log_path (string): Path of the log file. None to disable the telemetry.
+        """
+
+        self.name = name
+        self.enabled = log_path is not None
+        self.histograms = {"sent": Histogram(SIZE_BUCKETS), "received": Histogram(SIZE_BUCKETS),
+                           "rtt": Histogram(TIME_BUCKETS), "jitter": Histogram(TIME_BUCKETS),
+                           "send": Histogram(TIME_BUCKETS)}
+        self.stalls = 0
+        self.decode_errors = 0
+        self.short_reads = 0
+        self.peer_stamp = None          # Stamp of the last message received, to echo back.
+        self.last_arrival = None
+        self.last_interval = None
+        self.last_log = time.perf_counter()
+        self.logger = None
+        if self.enabled:
+            self.logger = logging.getLogger("jazz_netstats." + name)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+            try:
+                handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=LOG_MAX_BYTES,
+                                                               backupCount=LOG_BACKUPS)
+                handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+                self.logger.addHandler(handler)
+            except OSError:
+                print("Failed to open network log " + log_path + ".")
+                self.enabled = False
+
+    def stamps(self):
+        """ Return the stamp of a message about to be sent and the stamp of the peer to echo, or None for both if
+        disabled. The peer's stamp is echoed only once. """
+        if not self.enabled:
+            return None, None
+        echo = self.peer_stamp
+        self.peer_stamp = None
+        return round(time.perf_counter() * 1000, 3), echo
+
+    def send(self, transport, data):
+        """ Send a whole message over a transport (see jazz_transport), measuring its size and the time it took. """
+        if not self.enabled:
+            transport.send(data)
+            return
+        start = time.perf_counter()
+        transport.send(data)
+        self.sent(len(data), start)
+
+    def sent(self, size, start):
+        """ Measure a message handed over to the network, e.g. queued, since start (as returned by
+        time.perf_counter()). """
+        if not self.enabled:
+            return
+        elapsed = (time.perf_counter() - start) * 1000
+        self.histograms["sent"].add(size)
+        self.histograms["send"].add(elapsed)
+        if elapsed > STALL_MS:
+            self.stalls += 1
+
+    def recv(self, transport, size):
+        """ Receive a message from a transport, measuring its size and the time since the previous one. """
+        data = transport.receive(size)
+        if not self.enabled:
+            return data
+        now = time.perf_counter()
+        self.histograms["received"].add(len(data))
+        if len(data) == 0 or not data.endswith(b"}"):       # Frame messages are single JSON objects.
+            self.short_reads += 1
+        if self.last_arrival is not None:
+            interval = (now - self.last_arrival) * 1000
+            if self.last_interval is not None:
+                self.histograms["jitter"].add(abs(interval - self.last_interval))
+            self.last_interval = interval
+        self.last_arrival = now
+        return data
+
+    def decoded(self, stamp, echo):
+        """ Keep the stamp of a message decoded successfully and measure the round trip of the echoed one. """
+        if not self.enabled:
+            return
+        self.peer_stamp = stamp
+        if echo is not None:
+            self.histograms["rtt"].add(time.perf_counter() * 1000 - echo)
+        self.log()
+
+    def decode_error(self):
+        """ Count a message that failed to decode. """
+        if not self.enabled:
+            return
+        self.decode_errors += 1
+
+    def pause(self):
+        """ Forget the time of the last message, so that gaps between levels do not count as jitter. """
+        self.last_arrival = None
+        self.last_interval = None
+        self.peer_stamp = None
+
+    def log(self, force=False):
+        """ Write a summary to the log, if LOG_INTERVAL seconds have passed since the last one or if forced. """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if not force and now - self.last_log < LOG_INTERVAL:
+            return
+        self.last_log = now
+        for key, histogram in self.histograms.items():
+            self.logger.info(key + " " + histogram.summary())
+        self.logger.info("stalls=" + str(self.stalls) + " decode_errors=" + str(self.decode_errors) + " short_reads=" +
+                         str(self.short_reads))
+
+
+def from_environment(name):
+    """ Return the telemetry of a connection, set up from the JAZZ_NET_LOG environment variable. """
+    return NetStats(name, os.environ.get("JAZZ_NET_LOG") or None)
@@ -4,16 +4,21 @@ Screen resolution is considered static and is the same for server and client.
 """
 
 import pygame
-from math import floor
+from math import ceil, floor, sqrt
+from random import random
 import json
+import os
+import time
 
 SCREEN_WIDTH = 1920
 SCREEN_HEIGHT = 1080
-PORT = 2000                     # Arbitrary, can be changed if used by another application.
+PORT = int(os.environ.get("JAZZ_PORT", 2000))     # Arbitrary, can be changed if used by another application.
 GRAPHICS_DIR = "graphics/"
 SOUNDS_DIR = "sounds/"
 FONTS_DIR = "fonts/"
 DATABASE_DIR = "database/"
+REPLAYS_DIR = "replays/"
+TELEMETRY_DIR = "telemetry/"
 SLIME_POINTS = 10               # Score for killing an enemy.
 HP_POINTS = 20                  # Score for saving a heart until the end of a level.
 FULL_HP = 5                     # Per team. Resets per level.
@@ -24,6 +29,7 @@ FONT_SIZE_MEDIUM = 24
 FONT_SIZE_LARGE = 48
 MENU_WIN_POS = (451, 378)
 COUNTDOWN_SEC = 3               # Time period (in seconds) before transitioning to gameplay, after pressing "start".
+MAX_START_LAG = 0.5             # Longest time (in seconds) a start signal is trusted to have taken to arrive.
 PLAYER_SCALE = 0.6
 ENEMY_SCALE = 0.4
 VEL_CONST = 280
@@ -42,6 +48,9 @@ BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
 PINK = (170, 68, 115)
 
+# Titles of the leaderboards of the current week and day (see jazz_leaderboard), the all-time one has none.
+LEADERBOARD_TITLES = {"week": "Best of the week", "day": "Best of the day"}
+
 
 class Level:
     def __init__(self, enemies_num, enemy_spawns, sword_spawns):
@@ -90,24 +99,34 @@ def draw_start_menu(team_name, screen, role):
         screen.blit(skeleton_portrait, mate_portrait_pos)
 
 
-def countdown_from(seconds, screen):
-    """ Start a blocking countdown for the given amount of time, with visual and audio feedback.
-
-    Parameters:
-        seconds (int): Number of seconds to count down from.
-        screen (pygame.Surface): The caller's main pygame Surface.
-    """
-
-    countdown = seconds
-    while countdown > 0:
-        countdown_text = dosis_font_large.render(str(countdown), 1, PINK)
+class Countdown:
+    def __init__(self, seconds=COUNTDOWN_SEC, lag=0):
+        """ Start a countdown, with visual and audio feedback, driven by the main loop: draw() must be called every
+        frame, so that events and the network are still handled while counting down.
+
+        Parameters:
+            seconds (int): Number of seconds to count down from.
+            lag (float): Time (in seconds) since the other side started the same countdown, so that both end together.
+        """
+
+        self.deadline = time.perf_counter() + seconds - lag
+        self.shown = None               # Number currently shown, to ding once per number.
+
+    def draw(self, screen):
+        """ Draw the seconds left, rounded up, and ding when the number changes. Return whether the countdown has
+        ended. """
+        remaining = self.deadline - time.perf_counter()
+        if remaining <= 0:
+            return True
+        number = ceil(remaining)
+        if number != self.shown:
+            self.shown = number
+            ding_sound.play()
+        countdown_text = dosis_font_large.render(str(number), 1, PINK)
         countdown_text_rect = countdown_text.get_rect(center=(width_center, 780))
-        pygame.draw.rect(screen, BLACK, (width_center - 50, 780 - 50, 100, 100))    # Erase previous number.
+        pygame.draw.rect(screen, BLACK, (width_center - 50, 780 - 50, 100, 100))
         screen.blit(countdown_text, countdown_text_rect)
-        pygame.display.update()
-        ding_sound.play()
-        pygame.time.delay(1000)
-        countdown -= 1
+        return False
 
 
 def draw_player(role, pos, screen, counts, flags):
@@ -201,7 +220,8 @@ def draw_player(role, pos, screen, counts, flags):
     return dict_key, anim_index, flipped, counts, flags, rect
 
 
-def encode_frame_data(anim_key, anim_index, flipped, pos, attacks, hp=None, slimes=None, swords=None, stop=False):
+def encode_frame_data(anim_key, anim_index, flipped, pos, attacks, hp=None, slimes=None, swords=None, stop=False,
+                      stamp=None, echo=None):
     """ Compose and encode the data for the current frame to send to the teammate, using a custom protocol.
 
     Parameters:
@@ -214,6 +234,8 @@ def encode_frame_data(anim_key, anim_index, flipped, pos, attacks, hp=None, slim
         slimes (list of tuples): Data for each enemy currently in-game. Could be empty.
         swords (list of ints): Indexes of sword spawns of swords currently in-game. Could be empty.
         stop (boolean): Whether the gameplay must stop and the screen mode to change.
+        stamp (float): Time (in ms) the message is sent, for network telemetry (see jazz_netstats). Left out if None.
+        echo (float): Stamp of the last message received from the teammate, sent back. Left out if None.
 
     Returns:
         (bytes): Data ready to be sent through the custom protocol.
@@ -230,6 +252,10 @@ def encode_frame_data(anim_key, anim_index, flipped, pos, attacks, hp=None, slim
         "swords": swords,
         "stop": stop
     }
+    if stamp is not None:
+        var_dict["stamp"] = stamp
+    if echo is not None:
+        var_dict["echo"] = echo
     json_data = json.dumps(var_dict)
     return json_data.encode()
 
@@ -251,6 +277,8 @@ def decode_frame_data(frame_data):
             slimes (list of tuples): Data for each enemy currently in-game. Could be empty.
             swords (list of ints): Indexes of sword spawns of swords currently in-game. Could be empty.
             stop (boolean): Whether the gameplay must stop and the screen mode to change.
+            stamp (float): Time (in ms) the message was sent, or None if not stamped.
+            echo (float): Stamp of the last message sent to the teammate, echoed back, or None if not echoed.
     """
 
     json_data = frame_data.decode()
@@ -264,10 +292,75 @@ def decode_frame_data(frame_data):
     slimes = var_dict["slimes"]
     swords = var_dict["swords"]
     stop = var_dict["stop"]
-    return anim_key, anim_index, flipped, pos, attacks, hp, slimes, swords, stop
+    stamp = var_dict.get("stamp")
+    echo = var_dict.get("echo")
+    return anim_key, anim_index, flipped, pos, attacks, hp, slimes, swords, stop, stamp, echo
+
+
+def encode_spectator_data(team_name, level_index, score, players, hp, slimes, swords, stop):
+    """ Compose and encode a snapshot of the whole game for the current frame, to send to spectators.
+
+    Parameters:
+        team_name (string): The name of the playing team.
+        level_index (int): Index of the current level in the Levels[] list.
+        score (int): Total score of the team from the previous levels.
+        players (list of tuples): Role (string), anim_key (string), anim_index (int), flipped (boolean),
+            pos (tuple of floats) and attacks (int) of each player.
+        hp (int): Health points of the team.
+        slimes (list of tuples): Data for each enemy currently in-game. Could be empty.
+        swords (list of ints): Indexes of sword spawns of swords currently in-game. Could be empty.
+        stop (boolean): Whether the gameplay must stop and the screen mode to change.
+
+    Returns:
+        (bytes): Data ready to be sent through the custom protocol. Snapshots are separated by newlines.
+    """
+
+    var_dict = {
+        "team_name": team_name,
+        "level_index": level_index,
+        "score": score,
+        "players": players,
+        "hp": hp,
+        "slimes": slimes,
+        "swords": swords,
+        "stop": stop
+    }
+    json_data = json.dumps(var_dict) + "\n"
+    return json_data.encode()
+
+
+def decode_spectator_data(spectator_data):
+    """ Decode and parse a single game snapshot received from the server, using a custom protocol.
+
+    Parameters:
+        spectator_data (bytes): Data received through the custom protocol, without the separating newline.
+
+    Returns:
+        tuple of:
+            team_name (string): The name of the playing team.
+            level_index (int): Index of the current level in the Levels[] list.
+            score (int): Total score of the team from the previous levels.
+            players (list of lists): Role, anim_key, anim_index, flipped, pos and attacks of each player.
+            hp (int): Health points of the team.
+            slimes (list of tuples): Data for each enemy currently in-game. Could be empty.
+            swords (list of ints): Indexes of sword spawns of swords currently in-game. Could be empty.
+            stop (boolean): Whether the gameplay must stop and the screen mode to change.
+    """
+
+    json_data = spectator_data.decode()
+    var_dict = json.loads(json_data)
+    team_name = var_dict["team_name"]
+    level_index = var_dict["level_index"]
+    score = var_dict["score"]
+    players = var_dict["players"]
+    hp = var_dict["hp"]
+    slimes = var_dict["slimes"]
+    swords = var_dict["swords"]
+    stop = var_dict["stop"]
+    return team_name, level_index, score, players, hp, slimes, swords, stop
 
 
-def draw_teammate(anim_key, anim_index, role, pos, flipped, screen):
+def draw_teammate(anim_key, anim_index, role, pos, flipped, screen, is_immune=False):
     """ Render the specified frame of the specified animation.
 
     Parameters:
@@ -277,6 +370,7 @@ def draw_teammate(anim_key, anim_index, role, pos, flipped, screen):
         pos (tuple of floats): The position of the frame on the screen.
         flipped (boolean): Whether the frame is intended to be flipped horizontally.
         screen (pygame.Surface): Surface where the sprite will be rendered.
+        is_immune (boolean): Whether to render the frame semi-transparent, for damage immunity.
 
     Returns:
         rect (pygame.Rect): The rectangle of the rendered spite. Useful for collision handling.
@@ -291,6 +385,8 @@ def draw_teammate(anim_key, anim_index, role, pos, flipped, screen):
                                                        frame.get_height() * PLAYER_SCALE))
     if flipped:
         transformed_frame = pygame.transform.flip(transformed_frame, True, False)
+    if is_immune:
+        transformed_frame.fill((255, 255, 255, IMMUNE_ALPHA), special_flags=pygame.BLEND_RGBA_MULT)
     # Compensate for the horizontal offset of the attacking animation.
     if anim_key == "attack" and not flipped:
         new_pos = (pos[0] - 60, pos[1])
@@ -343,15 +439,182 @@ def draw_swords(swords, level_index, screen):
     return rects
 
 
-def draw_leaderboard(top_teams, team_stats, victorious, screen):
+def teammate_rect(anim_key, anim_index, role, pos, flipped):
+    """ Calculate the rectangle of the specified frame of the specified animation, without rendering it.
+
+    Parameters:
+        anim_key (string): Dictionary key for the list of the animation used by the teammate.
+        anim_index (int): Frame index for the animation list used by the teammate.
+        role (string): Role of the teammate. Either "s" or "z".
+        pos (tuple of floats): The position of the frame on the screen.
+        flipped (boolean): Whether the frame is intended to be flipped horizontally.
+
+    Returns:
+        rect (pygame.Rect): The rectangle that draw_teammate() would return for the same frame.
+    """
+
+    if role == "s":
+        frame = skeleton_anim[anim_key][anim_index]
+    else:
+        frame = zombie_anim[anim_key][anim_index]
+    rect = pygame.Rect(0, 0, frame.get_width() * PLAYER_SCALE, frame.get_height() * PLAYER_SCALE)
+    # Compensate for the horizontal offset of the attacking animation.
+    if anim_key == "attack" and not flipped:
+        rect.topleft = (pos[0] - 60, pos[1])
+    else:
+        rect.topleft = pos
+    return rect
+
+
+def slime_rects(slimes):
+    """ Calculate the rectangles of all enemies, without rendering them.
+
+    Parameters:
+        slimes (list of tuples): Data for each enemy currently in-game. Could be empty.
+
+    Returns:
+        rects (list of pygame.Rect): The rectangles that draw_slimes() would return for the same enemies.
+    """
+
+    rects = []
+    for slime in slimes:
+        frame = slime_walk[floor(slime[1])]
+        rect = pygame.Rect(0, 0, frame.get_width() * ENEMY_SCALE, frame.get_height() * ENEMY_SCALE)
+        rect.topleft = slime[0]
+        rects.append(rect)
+    return rects
+
+
+def sword_rects(swords, level_index):
+    """ Calculate the rectangles of all active swords, without rendering them.
+
+    Parameters:
+        swords (list of ints): Indexes of sword spawns of swords currently in-game. Could be empty.
+        level_index (int): Index of the current level in the Levels[] list. Used to get the positions of sword spawns.
+
+    Returns:
+        rects (list of pygame.Rect): The rectangles that draw_swords() would return for the same swords.
+    """
+
+    return [sword_big.get_rect(topleft=levels[level_index].sword_spawns[sword]) for sword in swords]
+
+
+def get_distance(point1, point2):
+    """ Calculate and return the distance between two given points. """
+    return sqrt(((point2[0] - point1[0]) ** 2) + ((point2[1] - point1[1]) ** 2))
+
+
+def spawn_slime(all_slimes, level_index, rand=random):
+    """ Add a new slime on the list of enemies.
+
+    Parameters:
+        all_slimes (list of lists): Data for each enemy currently in-game. Modified in place.
+        level_index (int): Index of the current level in the Levels[] list. Used to get the positions of enemy spawns.
+        rand (function): Source of random floats in [0, 1). Pass a seeded generator for reproducible games.
+    """
+
+    spawn_index = floor(rand() * len(levels[level_index].enemy_spawns))
+    new_slime = [levels[level_index].enemy_spawns[spawn_index], 0, False]
+    all_slimes.append(new_slime)
+
+
+def spawn_sword(all_swords, rand=random):
+    """ Add a new sword on the list of active swords. The list must have room for at least one more sword.
+
+    Parameters:
+        all_swords (list of ints): Indexes of sword spawns of swords currently in-game. Modified in place.
+        rand (function): Source of random floats in [0, 1). Pass a seeded generator for reproducible games.
+    """
+
+    new_index = floor(rand() * MAX_SWORDS)
+    while new_index in all_swords:
+        new_index = floor(rand() * MAX_SWORDS)
+    all_swords.append(new_index)
+
+
+def move_slimes(all_slimes, player_positions, enemy_vel):
+    """ Track the movement and animation of all enemies for the current game frame.
+
+    Parameters:
+        all_slimes (list of lists): Data for each enemy currently in-game. Modified in place.
+        player_positions (list of tuples): Positions of the players. Each enemy chases the closest one and
+            ties are resolved in favour of the first.
+        enemy_vel (float): Maximum distance an enemy travels on each axis in one frame.
+    """
+
+    offset_x = 20
+    offset_y = 90
+    inertia_x = 30
+    for slime in all_slimes:
+        # Update animation frame.
+        slime[1] += ENEMY_ANIM_STEP
+        if slime[1] > slime_num_frames["walk"] - 1:
+            slime[1] = 0
+        # Choose the player that is closer.
+        goal_pos = min(player_positions, key=lambda player_pos: get_distance(slime[0], player_pos))
+        # Calculate the new position.
+        if goal_pos[0] + (offset_x * PLAYER_SCALE) < slime[0][0]:
+            # When the distance is smaller than the step, use a smaller step to avoid passing the player.
+            new_x = slime[0][0] - min(enemy_vel, abs(slime[0][0] - goal_pos[0]))
+            # Introduce inertia in turning the other way.
+            if abs(slime[0][0] - goal_pos[0]) + (offset_x * PLAYER_SCALE) > inertia_x:
+                slime[2] = False
+        else:
+            new_x = slime[0][0] + min(enemy_vel, abs(slime[0][0] - goal_pos[0]))
+            if abs(slime[0][0] - goal_pos[0]) + (offset_x * PLAYER_SCALE) > inertia_x:
+                slime[2] = True
+        if goal_pos[1] + (offset_y * PLAYER_SCALE) < slime[0][1]:
+            new_y = slime[0][1] - min(enemy_vel, abs(slime[0][1] - goal_pos[1]))
+        else:
+            new_y = slime[0][1] + min(enemy_vel, abs(slime[0][1] - goal_pos[1]))
+        slime[0] = (new_x, new_y)
+
+
+def draw_game_view(team_name, level_index, score, players, hp, slimes, swords, screen):
+    """ Render a whole game frame as seen from outside the team, on top of the level background.
+
+    Parameters:
+        team_name (string): The name of the playing team.
+        level_index (int): Index of the current level in the Levels[] list.
+        score (int): Total score of the team from the previous levels.
+        players (list of tuples): Role (string), anim_key (string), anim_index (int), flipped (boolean),
+            pos (tuple of floats) and attacks (int) of each player.
+        hp (int): Health points of the team.
+        slimes (list of tuples): Data for each enemy currently in-game. Could be empty.
+        swords (list of ints): Indexes of sword spawns of swords currently in-game. Could be empty.
+        screen (pygame.Surface): Surface where the frame will be rendered.
+    """
+
+    # Render UI elements.
+    for i in range(FULL_HP):
+        if i + 1 <= hp:
+            heart = full_heart
+        else:
+            heart = broken_heart
+        screen.blit(heart, (((broken_heart.get_width() + 3) * i) + 676, 18))
+    team_text = dosis_font_large.render(team_name + " - " + str(score), 1, BLACK)
+    screen.blit(team_text, (40, 38))
+    # Render sprites, the player further down the screen goes on top.
+    for role, anim_key, anim_index, flipped, pos, attacks in sorted(players, key=lambda player: player[4][1]):
+        draw_teammate(anim_key, anim_index, role, pos, flipped, screen)
+    draw_slimes(slimes, screen)
+    draw_swords(swords, level_index, screen)
+    # Render low health effect, when appropriate.
+    if hp == 1:
+        screen.blit(low_hp_fx, (0, 0))
+
+
+def draw_leaderboard(top_teams, team_stats, victorious, screen, window="all"):
     """ Draw the ranks, names and scores of the top teams and the playing team.
 
     Parameters:
         top_teams (list of tuples): Names (strings) and scores (ints) of the best teams, sorted by rank.
             The list should contain between one and three teams.
-        team_stats (tuple): Rank (int), name (string) and score (int) of the playing team.
+        team_stats (tuple): Rank (int), name (string) and score (int) of the playing team. The rank can be None if
+            unknown.
         victorious (boolean): Whether the game ended with a victory.
         screen (pygame.Surface): Surface where the text will be rendered.
+        window (string): Time window of the leaderboard, titled unless it is all-time.
     """
     x_coords = [530, 760, 1300]
     # Render window title.
@@ -362,6 +625,10 @@ def draw_leaderboard(top_teams, team_stats, victorious, screen):
     board_text = dosis_font_large.render(end_title, 1, WHITE)
     board_text_rect = board_text.get_rect(center=(width_center, 450))
     screen.blit(board_text, board_text_rect)
+    if window in LEADERBOARD_TITLES:
+        board_text = dosis_font.render(LEADERBOARD_TITLES[window], 1, PINK)
+        board_text_rect = board_text.get_rect(center=(width_center, 492))
+        screen.blit(board_text, board_text_rect)
     # Render table titles.
     board_text = dosis_font.render("Rank", 1, WHITE)
     board_text_rect = board_text.get_rect(topleft=(x_coords[0], 520))
@@ -388,7 +655,10 @@ def draw_leaderboard(top_teams, team_stats, victorious, screen):
         offset_y += 60
         rank += 1
     # Render playing team.
-    board_text = dosis_font.render("#" + str(team_stats[0]), 1, WHITE)
+    if team_stats[0] is None:
+        board_text = dosis_font.render("-", 1, WHITE)
+    else:
+        board_text = dosis_font.render("#" + str(team_stats[0]), 1, WHITE)
     board_text_rect = board_text.get_rect(topleft=(x_coords[0], 830))
     screen.blit(board_text, board_text_rect)
     board_text = dosis_font.render(team_stats[1], 1, WHITE)
@@ -399,12 +669,53 @@ def draw_leaderboard(top_teams, team_stats, victorious, screen):
     screen.blit(board_text, board_text_rect)
 
 
-def encode_db_data(top_teams, team_rank):
+def encode_start_data(lockstep_seed=None):
+    """ Compose and encode the signal to start a level, stamped with the time it was sent, using a custom protocol.
+
+    Parameters:
+        lockstep_seed (int): Seed of the simulation in lockstep mode (see jazz_lockstep), None otherwise.
+
+    Returns:
+        (bytes): Data ready to be sent through the custom protocol.
+    """
+
+    if lockstep_seed is None:
+        return ("start " + repr(time.time())).encode()
+    return ("lockstep " + str(lockstep_seed) + " " + repr(time.time())).encode()
+
+
+def decode_start_data(start_data):
+    """ Decode and parse the signal to start a level, received from the server, using a custom protocol.
+
+    Parameters:
+        start_data (bytes): Data received through the custom protocol.
+
+    Returns:
+        None if the data is not a start signal, otherwise a tuple of:
+            lockstep_seed (int): Seed of the simulation in lockstep mode, None otherwise.
+            lag (float): Time (in seconds) the signal took to arrive, as far as the clocks of both sides agree. Between
+                zero and MAX_START_LAG, zero for servers that do not stamp it.
+    """
+
+    words = start_data.decode().split()
+    if len(words) == 0 or words[0] not in ("start", "lockstep"):
+        return None
+    lockstep_seed = None
+    if words[0] == "lockstep":
+        lockstep_seed = int(words.pop(1))
+    lag = 0
+    if len(words) > 1:
+        lag = min(max(time.time() - float(words[1]), 0), MAX_START_LAG)
+    return lockstep_seed, lag
+
+
+def encode_db_data(top_teams, team_rank, window="all"):
     """ Compose and encode the database data to send to the client, using a custom protocol.
 
     Parameters:
         top_teams (list of tuples): Names (strings) and scores (ints) of the best teams, sorted by rank.
-        team_rank (int): Rank of the playing team.
+        team_rank (int): Rank of the playing team, None if unknown.
+        window (string): Time window of the leaderboard (see jazz_leaderboard.WINDOWS).
 
     Returns:
         (bytes): Data ready to be sent through the custom protocol.
@@ -412,7 +723,8 @@ def encode_db_data(top_teams, team_rank):
 
     var_dict = {
         "top_teams": top_teams,
-        "team_rank": team_rank
+        "team_rank": team_rank,
+        "window": window
     }
     json_data = json.dumps(var_dict)
     return json_data.encode()
@@ -428,13 +740,15 @@ def decode_db_data(db_data):
         tuple of:
             top_teams (list of tuples): Names (strings) and scores (ints) of the best teams, sorted by rank.
             team_rank (int): Rank of the playing team.
+            window (string): Time window of the leaderboard. All-time for servers that do not send it.
     """
 
     json_data = db_data.decode()
     var_dict = json.loads(json_data)
     top_teams = var_dict["top_teams"]
     team_rank = var_dict["team_rank"]
-    return top_teams, team_rank
+    window = var_dict.get("window", "all")
+    return top_teams, team_rank, window
 
 
 # Initialize and load assets.
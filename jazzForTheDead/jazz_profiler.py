@@ -0,0 +1,123 @@
+""" On-demand profiling of the "Jazz for the dead!" game loop.
+
+Capture a fixed window of the running game, without restarting it under a profiler. A background thread samples the
+stack of the game loop every SAMPLE_INTERVAL seconds, which costs the game next to nothing. Where the interpreter cannot
+read the stacks of other threads, cProfile is used instead: it slows the game down and only knows the caller of each
+function, so the stacks it writes are two functions deep, counted in microseconds instead of samples and tagged with the
+state of the game at the end of the capture.
+
+The result is written to PROFILES_DIR in the collapsed stack format, one line per stack with the number of samples,
+ready for flamegraph.pl or speedscope. Every stack starts with frames that tag it with the menu_screen, the level index
+and the number of slimes at the time of the sample, so the screens and the crowded moments can be told apart.
+
+Press F4 in game to capture CAPTURE_SECONDS seconds. Set the JAZZ_PROFILE environment variable to a number of seconds to
+capture from the start.
+"""
+
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import pygame
+
+SAMPLE_INTERVAL = 0.005             # Time (in seconds) between two samples.
+CAPTURE_SECONDS = 10
+PROFILES_DIR = "profiles/"
+TRIGGER_KEY = pygame.K_F4
+
+
+def frame_name(code):
+    """ Return the name of a function in the collapsed stacks, e.g. 'move_slimes (jazz_operations.py:507)'. """
+    return code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno) + ")"
+
+
+class Profiler:
+    def __init__(self, name):
+        """ Prepare a profiler for the game loop running on the current thread.
+
+        Parameters:
+            name (string): Name of the script, the start of the name of the files written.
+        """
+
+        self.name = name
+        self.thread_id = threading.get_ident()
+        self.sampling = hasattr(sys, "_current_frames")
+        self.stacks = {}            # Number of samples, by collapsed stack.
+        self.tags = "menu_screen=0;level=0;slimes=0"
+        self.deadline = None        # End of the running capture, None if not capturing.
+        self.sampler = None
+        self.cprofile = None
+
+    def start(self, seconds=CAPTURE_SECONDS):
+        """ Start capturing for the given number of seconds, unless already capturing. """
+        if self.deadline is not None:
+            return
+        self.stacks = {}
+        self.deadline = time.perf_counter() + seconds
+        if self.sampling:
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+        else:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        print("Profiling for " + str(seconds) + " seconds.")
+
+    def update(self, menu_screen, level_index, slimes_num):
+        """ Tag the next samples with the state of the game and end the capture once its time is up. Call once per
+        frame, from the game loop. """
+        if self.deadline is None:
+            return
+        self.tags = "menu_screen=" + str(menu_screen) + ";level=" + str(level_index) + ";slimes=" + str(slimes_num)
+        if time.perf_counter() >= self.deadline:
+            self.stop()
+
+    def sample(self):
+        """ Record the stack of the game loop every SAMPLE_INTERVAL seconds, until the capture ends. Runs on a thread of
+        its own. """
+        while self.deadline is not None:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:           # The game loop ended.
+                return
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            stack = self.tags + ";" + ";".join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            time.sleep(SAMPLE_INTERVAL)
+
+    def stop(self):
+        """ End the capture and write the collapsed stacks. Must be called from the game loop. """
+        if self.deadline is None:
+            return
+        self.deadline = None
+        if self.sampling:
+            self.sampler.join()
+        else:
+            self.cprofile.disable()
+            # Count the time spent in each function, per caller, in microseconds.
+            for function, (cc, nc, tt, ct, callers) in pstats.Stats(self.cprofile).stats.items():
+                for caller, caller_times in callers.items():
+                    stack = self.tags + ";" + pstats.func_std_string(caller) + ";" + pstats.func_std_string(function)
+                    self.stacks[stack] = self.stacks.get(stack, 0) + int(caller_times[2] * 1e6)
+        path = os.path.join(PROFILES_DIR, self.name + "-" + time.strftime("%Y%m%d-%H%M%S") + ".collapsed")
+        try:
+            os.makedirs(PROFILES_DIR, exist_ok=True)
+            with open(path, "w") as file:
+                for stack, count in sorted(self.stacks.items()):
+                    if count > 0:
+                        file.write(stack.replace(" ", "_") + " " + str(count) + "\n")
+            print("Saved profile to " + path + ".")
+        except OSError:
+            print("Failed to save profile to " + path + ".")
+
+
+def from_environment(name):
+    """ Return a profiler for the game loop, already capturing if the JAZZ_PROFILE environment variable is set. """
+    profiler = Profiler(name)
+    seconds = os.environ.get("JAZZ_PROFILE")
+    if seconds:
+        profiler.start(float(seconds))
+    return profiler
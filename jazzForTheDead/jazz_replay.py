@@ -0,0 +1,228 @@
+""" Match replays for the "Jazz for the dead!" dedicated server.
+
+Replays are compact, append-only binary files made of:
+    header      Magic bytes, format version, seed of the match, team name and the roles of the two players.
+    keyframe    'K', global tick, length and the complete match state as JSON. Written at the start of every level and
+                every KEYFRAME_TICKS frames.
+    inputs      'I' and the state reported by both clients for one frame. Written after every frame.
+    end         'E' and the final score. Missing if a client disconnected before the end.
+The random events of a match only depend on its seed, so simulating the recorded inputs reproduces the match exactly.
+Any tick is reached quickly by restoring the closest keyframe before it and simulating the rest headless.
+
+Usage:
+    python jazz_replay.py play <file> [--start TICK]    Watch a replay at normal speed.
+    python jazz_replay.py verify <file> [--db PATH]     Simulate a replay at maximum speed and check its final score.
+"""
+
+import os
+import sys
+
+# Verifying is headless, so it must also work on servers without a screen or speakers. Must be set before pygame is
+# initialized.
+if len(sys.argv) > 1 and sys.argv[1] == "verify":
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import jazz_operations as jo
+from jazz_match import Match, FPS_CAP, ANIM_KEYS
+import argparse
+import json
+import sqlite3
+import struct
+import time
+from bisect import bisect_right
+import pygame
+
+MAGIC = b"JFTD"
+VERSION = 1
+KEYFRAME_TICKS = 600                                # Ten seconds of gameplay.
+HEADER_FORMAT = struct.Struct("<4sBIB")             # Magic, version, seed and length of the team name.
+KEYFRAME_FORMAT = struct.Struct("<II")              # Global tick and length of the state.
+INPUTS_FORMAT = struct.Struct("<" + "BB?ddB" * 2)   # Animation key, index, flipped, x, y and attacks of each player.
+END_FORMAT = struct.Struct("<i")                    # Final score.
+
+
+class ReplayWriter:
+    def __init__(self, path):
+        """ Create a new replay file. Writes are buffered, so the file is only complete after close(). """
+        self.file = open(path, "wb", buffering=65536)
+
+    def header(self, seed, team_name, roles):
+        """ Record the information needed to set up the match again. """
+        name = team_name.encode()
+        self.file.write(HEADER_FORMAT.pack(MAGIC, VERSION, seed, len(name)) + name + "".join(roles).encode())
+
+    @staticmethod
+    def wants_keyframe(tick):
+        """ Return whether a keyframe should be recorded before simulating the given tick of a level. """
+        return tick % KEYFRAME_TICKS == 0
+
+    def keyframe(self, total_ticks, state):
+        """ Record the complete match state, as returned by Match.get_state(). """
+        data = json.dumps(state).encode()
+        self.file.write(b"K" + KEYFRAME_FORMAT.pack(total_ticks, len(data)) + data)
+
+    def inputs(self, players):
+        """ Record the state reported by both clients for the latest frame. """
+        values = []
+        for player in players:
+            values += [ANIM_KEYS.index(player.anim_key), player.anim_index, player.flipped, player.pos[0],
+                       player.pos[1], player.attacks]
+        self.file.write(b"I" + INPUTS_FORMAT.pack(*values))
+
+    def end(self, final_score):
+        """ Record the final score of the match. """
+        self.file.write(b"E" + END_FORMAT.pack(final_score))
+
+    def close(self):
+        self.file.close()
+
+
+class Replay:
+    def __init__(self, path):
+        """ Load a replay file and prepare its match at the first tick. """
+        with open(path, "rb") as file:
+            data = file.read()
+        magic, version, seed, name_length = HEADER_FORMAT.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a replay file of a supported version: " + path)
+        offset = HEADER_FORMAT.size
+        self.team_name = data[offset:offset + name_length].decode()
+        offset += name_length
+        roles = data[offset:offset + 2].decode()
+        offset += 2
+        self.keyframes = {}         # Match states by global tick.
+        self.inputs = []            # States reported by both clients, by global tick.
+        self.final_score = None
+        while offset < len(data):
+            record_type = data[offset:offset + 1]
+            offset += 1
+            if record_type == b"K":
+                total_ticks, length = KEYFRAME_FORMAT.unpack_from(data, offset)
+                offset += KEYFRAME_FORMAT.size
+                self.keyframes[total_ticks] = json.loads(data[offset:offset + length])
+                offset += length
+            elif record_type == b"I":
+                values = INPUTS_FORMAT.unpack_from(data, offset)
+                offset += INPUTS_FORMAT.size
+                self.inputs.append([(ANIM_KEYS[values[i]], values[i + 1], values[i + 2], (values[i + 3], values[i + 4]),
+                                     values[i + 5]) for i in (0, 6)])
+            elif record_type == b"E":
+                self.final_score = END_FORMAT.unpack_from(data, offset)[0]
+                offset += END_FORMAT.size
+            else:
+                raise ValueError("Corrupted replay file: " + path)
+        self.keyframe_ticks = sorted(self.keyframes)
+        self.match = Match([None, None], self.team_name, None, seed)
+        for player, role in zip(self.match.players, roles):
+            player.role = role
+        self.seek(0)
+
+    def seek(self, tick):
+        """ Bring the match to the state right after the given global tick, starting from the closest keyframe. """
+        tick = max(0, min(tick, len(self.inputs)))
+        keyframe_tick = self.keyframe_ticks[bisect_right(self.keyframe_ticks, tick) - 1]
+        self.match.set_state(self.keyframes[keyframe_tick])
+        while self.match.total_ticks < tick:
+            self.advance()
+
+    def advance(self):
+        """ Simulate the next recorded frame. Return 'False' if the replay has ended. """
+        total_ticks = self.match.total_ticks
+        if total_ticks >= len(self.inputs):
+            return False
+        # The state is reset between levels, so start the next level from its first keyframe.
+        keyframe = self.keyframes.get(total_ticks)
+        if keyframe is not None and keyframe["tick"] == 0 and keyframe["level_index"] != self.match.level_index:
+            self.match.set_state(keyframe)
+        self.match.step()
+        for player, inputs in zip(self.match.players, self.inputs[total_ticks]):
+            player.apply(*inputs)
+        return True
+
+    def simulated_final_score(self):
+        """ Simulate the rest of the replay at maximum speed and return the final score it leads to. """
+        while self.advance():
+            pass
+        return self.match.score + self.match.enemies_killed * jo.SLIME_POINTS + self.match.hp * jo.HP_POINTS
+
+
+def verify(path, db_path=None):
+    """ Check that a replay reproduces its recorded final score and, optionally, the best score on the leaderboard. """
+    start = time.perf_counter()
+    replay = Replay(path)
+    final_score = replay.simulated_final_score()
+    duration = time.perf_counter() - start
+    print("Team: " + replay.team_name)
+    print("Simulated " + str(len(replay.inputs)) + " frames in " + str(round(duration, 3)) + " seconds.")
+    print("Recorded final score: " + str(replay.final_score))
+    print("Simulated final score: " + str(final_score))
+    if db_path is not None:
+        connection = sqlite3.connect(db_path)
+        best = connection.execute("SELECT score FROM teams WHERE name = ?;", (replay.team_name,)).fetchall()
+        connection.close()
+        if len(best) > 0:
+            print("Best score on the leaderboard: " + str(best[0][0]))
+        else:
+            print("The team is not on the leaderboard.")
+    return final_score == replay.final_score
+
+
+def play(path, start_tick=0):
+    """ Watch a replay at normal speed. Space pauses, the left and right arrows jump by a keyframe interval. """
+    replay = Replay(path)
+    replay.seek(start_tick)
+    screen = pygame.display.set_mode((jo.SCREEN_WIDTH, jo.SCREEN_HEIGHT), vsync=1)
+    pygame.display.set_caption("Jazz for the dead! - replay")
+    clock = pygame.time.Clock()
+    level_bgs = [pygame.image.load(jo.GRAPHICS_DIR + "level1.png").convert(),
+                 pygame.image.load(jo.GRAPHICS_DIR + "level2.png").convert()]
+    paused = False
+    run = True
+    while run:
+        clock.tick(FPS_CAP)
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                run = False
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
+                    run = False
+                elif event.key == pygame.K_SPACE:
+                    paused = not paused
+                elif event.key == pygame.K_LEFT:
+                    replay.seek(replay.match.total_ticks - KEYFRAME_TICKS)
+                elif event.key == pygame.K_RIGHT:
+                    replay.seek(replay.match.total_ticks + KEYFRAME_TICKS)
+        if not paused:
+            replay.advance()
+        match = replay.match
+        players = [(player.role, player.anim_key, player.anim_index, player.flipped, player.pos, player.attacks)
+                   for player in match.players]
+        screen.blit(level_bgs[match.level_index], (0, 0))
+        jo.draw_game_view(match.team_name, match.level_index, match.score, players, match.hp, match.slimes,
+                          match.swords, screen)
+        tick_text = jo.dosis_font.render("Frame " + str(match.total_ticks) + " / " + str(len(replay.inputs)), 1,
+                                         jo.BLACK)
+        screen.blit(tick_text, (40, jo.SCREEN_HEIGHT - 60))
+        pygame.display.update()
+    pygame.quit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays of Jazz for the dead! matches")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    play_parser = subparsers.add_parser("play", help="watch a replay at normal speed")
+    play_parser.add_argument("file")
+    play_parser.add_argument("--start", type=int, default=0, help="global tick to start from")
+    verify_parser = subparsers.add_parser("verify", help="simulate a replay headless and check its final score")
+    verify_parser.add_argument("file")
+    verify_parser.add_argument("--db", help="highscore database to compare with")
+    args = parser.parse_args()
+    if args.command == "play":
+        play(args.file, args.start)
+    elif not verify(args.file, args.db):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+""" Bounded send queue of the "Jazz for the dead!" server.
+
+Sending every gameplay frame with sendall() blocks the game loop as soon as the client reads slower than the server
+plays, and the frames it could not read yet pile up in the stream, so it renders them late and merged. Instead, the
+server queues its messages and the queue sends them without blocking, as far as the send buffer allows:
+    snapshot    The state of a gameplay frame. Only the latest one matters, so a snapshot still waiting to be sent is
+                replaced by the next one, and at most MAX_IN_FLIGHT snapshots are sent before the client replies to
+                them. Frame messages are not delimited, so a single one in flight also keeps them from merging.
+    reliable    Any other message, e.g. a score. Always sent, in the order queued, and never overtaken by a snapshot.
+A slow client therefore gets fewer updates of the game, instead of stalling it. At most MAX_RELIABLE reliable messages
+wait in the queue: queuing one more blocks until the queue is sent.
+
+Metrics (see jazz_metrics):
+    jazz_send_queue_depth               Messages waiting to be sent to the client.
+    jazz_snapshots_coalesced_total      Snapshots replaced by a newer one before being sent.
+    jazz_send_queue_full_total          Reliable messages that found the queue full and waited for it to be sent.
+"""
+
+import jazz_metrics
+from collections import deque
+
+SNAPSHOT = "snapshot"
+RELIABLE = "reliable"
+MAX_IN_FLIGHT = 1           # Snapshots sent and not replied to yet.
+MAX_RELIABLE = 16           # Reliable messages waiting to be sent.
+
+
+class SendQueue:
+    def __init__(self, transport, max_in_flight=MAX_IN_FLIGHT):
+        """ Prepare an empty queue of the messages to send over a transport (see jazz_transport). """
+        self.transport = transport
+        self.max_in_flight = max_in_flight
+        self.queue = deque()        # Kinds and messages waiting to be sent, oldest first.
+        self.partial = None         # Rest of a message that did not fit in the send buffer. Never dropped.
+        self.in_flight = 0          # Snapshots sent, not replied to yet.
+
+    def snapshot(self, data):
+        """ Queue the state of the current frame, replacing the previous one if it is still waiting, and send what
+        the link allows. Never blocks on the network. """
+        if len(self.queue) > 0 and self.queue[-1][0] == SNAPSHOT:
+            self.queue[-1] = (SNAPSHOT, data)
+            jazz_metrics.SNAPSHOTS_COALESCED.inc()
+        else:
+            self.queue.append((SNAPSHOT, data))
+        self.flush()
+
+    def reliable(self, data):
+        """ Queue a message that must be received, in order, and send what the link allows. Blocks only if the queue
+        is full. """
+        if len(self.queue) >= MAX_RELIABLE:
+            jazz_metrics.SEND_QUEUE_FULL.inc()
+            self.drain()
+        self.queue.append((RELIABLE, data))
+        self.flush()
+
+    def acknowledge(self):
+        """ Count a reply of the client to a snapshot, making room for the next one, and send what the link
+        allows. """
+        self.in_flight = max(self.in_flight - 1, 0)
+        self.flush()
+
+    def replied(self):
+        """ Return whether a reply of the client is waiting to be received, without blocking. """
+        return self.transport.poll()
+
+    def ready(self):
+        """ Return whether the next queued message can be sent. """
+        return len(self.queue) > 0 and (self.queue[0][0] == RELIABLE or self.in_flight < self.max_in_flight)
+
+    def pop(self):
+        """ Take the next queued message to send. """
+        kind, data = self.queue.popleft()
+        if kind == SNAPSHOT:
+            self.in_flight += 1
+            jazz_metrics.BYTES_SENT.inc(len(data))
+        return memoryview(data)
+
+    def flush(self):
+        """ Send as many queued messages as possible without blocking. Socket errors are raised. """
+        while self.partial is not None or self.ready():
+            if self.partial is None:
+                self.partial = self.pop()
+            sent = self.transport.send_some(self.partial)
+            if sent < len(self.partial):
+                self.partial = self.partial[sent:]
+                break
+            self.partial = None
+        jazz_metrics.SEND_QUEUE_DEPTH.set(self.depth())
+
+    def drain(self):
+        """ Send every queued message that can be sent, waiting for the link if needed. Blocking. Snapshots still
+        wait for the replies to the ones in flight. """
+        if self.partial is not None:
+            self.transport.send(self.partial)
+            self.partial = None
+        while self.ready():
+            self.transport.send(self.pop())
+        jazz_metrics.SEND_QUEUE_DEPTH.set(self.depth())
+
+    def depth(self):
+        """ Return the number of messages waiting to be sent, including one partly sent. """
+        return len(self.queue) + (self.partial is not None)
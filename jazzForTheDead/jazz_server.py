@@ -1,18 +1,43 @@
 """ Server script for the "Jazz for the dead!" game.
 
 Wait for a client from the local network to connect and play the game. Update the score on the database.
+Set the JAZZ_LOCKSTEP environment variable to 1 to play in deterministic lockstep mode (see jazz_lockstep).
+Set the JAZZ_METRICS_PORT environment variable to a port to serve metrics on it (see jazz_metrics).
+Set the JAZZ_PROFILE environment variable to a number of seconds to profile from the start (see jazz_profiler).
+Set the JAZZ_LEADERBOARD_WINDOW environment variable to 'week' or 'day' to show the leaderboard of the current week or
+day instead of the all-time one (see jazz_leaderboard).
+Set the JAZZ_TRANSPORT environment variable to 'udp' to play over UDP, with a client that does the same (see
+jazz_transport).
+A client on the same host sends the gameplay frames through shared memory instead of the network, unless the
+JAZZ_SHARED_MEMORY environment variable is set to 0 (see jazz_sharedmem).
+Set the JAZZ_PORT environment variable to listen on another port than 2000, e.g. behind a link emulator on that port
+(see jazz_netem).
 """
 
 import jazz_operations as jo
+import jazz_leaderboard as jl
+import jazz_lockstep as jls
+import jazz_handshake
+import jazz_sendqueue
+import jazz_transport
+import jazz_sharedmem
+import jazz_timing
+import jazz_netstats
+import jazz_metrics
+import jazz_profiler
+import os
 import socket
-import sqlite3
-from random import random
-from math import sqrt, floor
+import time
+from random import random, Random
+from math import sqrt
 from json import decoder
 import pygame
 
 FPS_CAP = 60
 HOST = "0.0.0.0"                                    # Address used to listen to all possible connections on LAN.
+LOCKSTEP = os.environ.get("JAZZ_LOCKSTEP") == "1"
+METRICS_PORT = os.environ.get("JAZZ_METRICS_PORT")
+LEADERBOARD_WINDOW = os.environ.get("JAZZ_LEADERBOARD_WINDOW", "all")
 
 delta_time = 1 / FPS_CAP                            # Not actual delta time, expects a stable frame rate.
 immune_frames = jo.PLAYER_IMMUNE_DUR * FPS_CAP      # Number of frames that the player is immune to damage after a hit.
@@ -23,11 +48,21 @@ def start_gameplay():
     global start_active
     global menu_screen
     global run
-    global countdown_next_iter
+    global countdown
+    global taking_offers
     start_active = False
+    if taking_offers:
+        handshake.cancel()          # The frames of the game go where they were offered before it starts.
+        taking_offers = False
+    if frames is not None:
+        frames.skip()               # Replies of the client to the previous level.
+    jazz_metrics.ACTIVE_MATCHES.set(1)
+    jazz_metrics.MATCH_PLAYERS.set(2, match=team_name)
     try:
-        conn.sendall("start".encode())
-        countdown_next_iter = True
+        outbox.reliable(jo.encode_start_data(lockstep_seed if LOCKSTEP else None))
+        countdown = jo.Countdown()          # The client counts down from the time stamped on the signal.
+        if menu_screen == 3:
+            pygame.mixer.music.fadeout(1200)
     except socket.error:
         print("Failed to send start signal to client.")
         run = False
@@ -44,114 +79,24 @@ def calculate_score():
     return level_score
 
 
-def spawn_slime(all_slimes):
-    """ Add a new slime on the list of enemies. """
-    spawn_index = floor(random() * len(jo.levels[level_index].enemy_spawns))
-    new_slime = [jo.levels[level_index].enemy_spawns[spawn_index], 0, False]
-    all_slimes.append(new_slime)
-
-
-def spawn_sword(all_swords):
-    """ Add a new sword on the list of active swords. """
-    new_index = floor(random() * jo.MAX_SWORDS)
-    while new_index in all_swords:
-        new_index = floor(random() * jo.MAX_SWORDS)
-    jo.ding_sound.play()
-    all_swords.append(new_index)
-
-
-def get_distance(point1, point2):
-    """ Calculate and return the distance between two given points. """
-    return sqrt(((point2[0] - point1[0]) ** 2) + ((point2[1] - point1[1]) ** 2))
-
-
-def move_slimes(all_slimes):
-    """ Track the movement and animation of all enemies for the current game frame. """
-    offset_x = 20
-    offset_y = 90
-    inertia_x = 30
-    for slime in all_slimes:
-        # Update animation frame.
-        slime[1] += jo.ENEMY_ANIM_STEP
-        if slime[1] > jo.slime_num_frames["walk"] - 1:
-            slime[1] = 0
-        # Choose the player that is closer.
-        server_pos = (server_x, server_y)
-        client_pos = (client_x, client_y)
-        if get_distance(slime[0], server_pos) <= get_distance(slime[0], client_pos):
-            goal_pos = server_pos
-        else:
-            goal_pos = client_pos
-        # Calculate the new position.
-        if goal_pos[0] + (offset_x * jo.PLAYER_SCALE) < slime[0][0]:
-            # When the distance is smaller than the step, use a smaller step to avoid passing the player.
-            new_x = slime[0][0] - min(enemy_vel, abs(slime[0][0] - goal_pos[0]))
-            # Introduce inertia in turning the other way.
-            if abs(slime[0][0] - goal_pos[0]) + (offset_x * jo.PLAYER_SCALE) > inertia_x:
-                slime[2] = False
-        else:
-            new_x = slime[0][0] + min(enemy_vel, abs(slime[0][0] - goal_pos[0]))
-            if abs(slime[0][0] - goal_pos[0]) + (offset_x * jo.PLAYER_SCALE) > inertia_x:
-                slime[2] = True
-        if goal_pos[1] + (offset_y * jo.PLAYER_SCALE) < slime[0][1]:
-            new_y = slime[0][1] - min(enemy_vel, abs(slime[0][1] - goal_pos[1]))
-        else:
-            new_y = slime[0][1] + min(enemy_vel, abs(slime[0][1] - goal_pos[1]))
-        slime[0] = (new_x, new_y)
-
-
-def db_connect(db_path):
-    """ Open a connection with a new database. """
-    try:
-        connection = sqlite3.connect(db_path)
-    except sqlite3.Error as e:
-        print("Creating connection error: " + e.sqlite_errorname)
-        raise SystemExit
-    return connection
-
-
-def execute_write_query(connection, query):
-    """ Send an SQL-style query to a connected database. """
-    cursor = connection.cursor()
-    try:
-        cursor.execute(query)
-        connection.commit()
-    except sqlite3.Error as e:
-        print("Query execution error: " + e.sqlite_errorname)
-
-
-def execute_read_query(connection, query):
-    """ Send an SQL-style query that expects results to a connected database and return the response. """
-    cursor = connection.cursor()
-    try:
-        cursor.execute(query)
-        result = cursor.fetchall()
-    except sqlite3.Error as e:
-        result = None
-        print("Read query execution error: " + e.sqlite_errorname)
-    return result
-
-
 # Set-up network connection.
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-s.bind((HOST, jo.PORT))
-s.listen(1)
-conn = None
+s = jazz_transport.listen(HOST, jo.PORT)
+conn = None             # Transport connected to the client, once connected.
+outbox = None           # Queue of the messages to the client, once connected.
+handshake = jazz_handshake.Handshake()     # Accepts the client without blocking the menu.
+frames = None           # Frames shared with a client on the same host (see jazz_sharedmem), None over the network.
+taking_offers = True    # Whether a client on the same host might still offer shared memory, until the game starts.
 
 # Use this IP on the client to connect. Necessary to connect two machines over LAN.
 private_ip = socket.gethostbyname(socket.gethostname())
 
-# Initialize the highscore database.
-db_conn = db_connect(jo.DATABASE_DIR + "highscore_db.sqlite")
-sql_create_table = """
-    CREATE TABLE IF NOT EXISTS teams (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        score INTEGER NOT NULL
-    );
-"""
-execute_write_query(db_conn, sql_create_table)
+# Load the highscore database, on a thread of its own.
+db_worker = jl.LeaderboardWorker(jo.DATABASE_DIR + "highscore_db.sqlite", LEADERBOARD_WINDOW)
+
+# Serve metrics on a local port, polled once per frame.
+metrics_server = None
+if METRICS_PORT:
+    metrics_server = jazz_metrics.MetricsServer(int(METRICS_PORT))
 
 
 # Pygame and variable initialization.
@@ -159,13 +104,16 @@ pygame.init()
 screen = pygame.display.set_mode((jo.SCREEN_WIDTH, jo.SCREEN_HEIGHT), vsync=1)
 pygame.display.set_caption("Jazz for the dead! - server")
 clock = pygame.time.Clock()
+frame_timer = jazz_timing.from_environment()     # Toggled with F3.
+net_stats = jazz_netstats.from_environment("server")
+profiler = jazz_profiler.from_environment("server")     # Triggered with F4.
 # menu_screen ranges from '1' to '3' for the starting menu, '4' in-between levels and '5' for the leaderboard.
 # Negative values indicate that the current screen is NOT a menu.
 menu_screen = 1
 level_index = 0
-menu_bg = pygame.image.load(jo.GRAPHICS_DIR + "menu_bg.png")
-level1_bg = pygame.image.load(jo.GRAPHICS_DIR + "level1.png")
-level2_bg = pygame.image.load(jo.GRAPHICS_DIR + "level2.png")
+menu_bg = pygame.image.load(jo.GRAPHICS_DIR + "menu_bg.png").convert()
+level1_bg = pygame.image.load(jo.GRAPHICS_DIR + "level1.png").convert()
+level2_bg = pygame.image.load(jo.GRAPHICS_DIR + "level2.png").convert()
 menu_window = pygame.image.load(jo.GRAPHICS_DIR + "ui_window.png").convert_alpha()
 menu_title = pygame.image.load(jo.GRAPHICS_DIR + "game_title.png").convert_alpha()
 share_ip_text = jo.dosis_font.render("You are the host. Share your IP with your teammate:", 1, jo.PINK)
@@ -182,8 +130,8 @@ server_role = ""       # Can either be 's' for skeleton or 'z' for zombie.
 client_role = ""       # Can either be 's' for skeleton or 'z' for zombie.
 start_button = pygame.image.load(jo.GRAPHICS_DIR + "start_button.png")
 start_active = False
-countdown_next_iter = False
-countdown_active = False
+countdown = None        # Countdown to the next level, None when not counting down.
+message_time = 0        # Time (as returned by time.perf_counter()) the latest menu message was sent to the client.
 hp = jo.FULL_HP         # Shared health for the team.
 server_attacks = jo.INIT_ATTACKS
 client_attacks = jo.INIT_ATTACKS
@@ -225,6 +173,10 @@ partial_score = None
 final_score = None
 top_teams = []
 team_rank = None
+db_future = None                            # Top teams and rank, once the database worker answers.
+db_deadline = 0
+lockstep_seed = Random().getrandbits(32)    # Shared with the client in lockstep mode.
+world = None                                # The simulation of lockstep mode.
 
 # Start playing menu music.
 pygame.mixer.music.set_volume(jo.MENU_MUSIC_VOL)
@@ -236,9 +188,16 @@ pygame.mixer.music.play(-1)
 run = True
 while run:
     clock.tick(FPS_CAP)
+    frame_timer.start()
+    if metrics_server is not None:
+        metrics_server.poll()
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
             run = False
+        if event.type == pygame.KEYDOWN and event.key == jazz_timing.TOGGLE_KEY:
+            frame_timer.toggle()
+        if event.type == pygame.KEYDOWN and event.key == jazz_profiler.TRIGGER_KEY:
+            profiler.start()
 
         # Handle user input for the team name.
         if event.type == pygame.KEYDOWN and input_active:
@@ -246,8 +205,8 @@ while run:
                 input_active = False
                 menu_screen += 1
                 try:
-                    conn.sendall(team_name.encode())
-                    start_active = True
+                    outbox.reliable(team_name.encode())
+                    message_time = time.perf_counter()
                 except socket.error:
                     print("Failed to send team name to client.")
                     run = False
@@ -315,6 +274,8 @@ while run:
         walk_count = 0
         walking = False
 
+    frame_timer.mark("input")
+
     # Render the background.
     if menu_screen > 0:
         bg = menu_bg
@@ -323,6 +284,7 @@ while run:
     else:
         bg = level2_bg
     screen.blit(bg, (0, 0))
+    frame_timer.mark("render")
 
     # Render the elements of the current screen.
     if menu_screen > 0:         # Any menu.
@@ -341,45 +303,49 @@ while run:
         input_active = True
     elif menu_screen == 3:      # Start screen.
         if len(server_role) == 0:
-            if random() < 0.5:
+            if LOCKSTEP:
+                role_roll = Random(lockstep_seed).random()     # Reproducible from the seed.
+            else:
+                role_roll = random()
+            if role_roll < 0.5:
                 server_role = "s"  # Server is playing skeleton.
                 client_role = "z"  # Client is playing zombie.
             else:
                 server_role = "z"  # Server is playing zombie.
                 client_role = "s"  # Client is playing skeleton.
+        # The start button appears once the client knows its role, sent apart from the team name.
+        if not start_active and countdown is None and time.perf_counter() - message_time >= jazz_handshake.MESSAGE_GAP:
             try:
-                conn.sendall(client_role.encode())
+                outbox.reliable(client_role.encode())
+                message_time = time.perf_counter()
+                start_active = True
             except socket.error:
                 print("Failed to send client role to client.")
                 run = False
         jo.draw_start_menu(team_name, screen, server_role)
         if start_active:
             screen.blit(start_button, (jo.width_center - start_button.get_width() / 2, 780))
-        if countdown_next_iter:
-            countdown_next_iter = False
-            countdown_active = True
-        elif countdown_active:
-            pygame.mixer.music.fadeout(1200)
-            jo.countdown_from(jo.COUNTDOWN_SEC, screen)
+        if countdown is not None and countdown.draw(screen):
             pygame.mixer.music.set_volume(jo.GAME_MUSIC_VOL)
             pygame.mixer.music.load(jo.SOUNDS_DIR + "level1_music.mp3")
             pygame.mixer.music.play(-1)
-            countdown_active = False
+            countdown = None
             menu_screen = -1
-            movement_active = True
-            attack_active = True
+            if LOCKSTEP:
+                world = jls.World(lockstep_seed, server_role, client_role)
+            movement_active = not LOCKSTEP      # In lockstep mode, the world moves the players.
+            attack_active = not LOCKSTEP
     elif menu_screen == 4:      # Next level screen.
         # Show cursor.
         pygame.mouse.set_visible(True)
         # Calculate and communicate score.
         if partial_score is None:
             start_active = False
-            countdown_next_iter = False
-            countdown_active = False
+            countdown = None
             jo.victory_sound.play()
             partial_score = calculate_score()
             try:
-                conn.sendall(str(partial_score).encode())
+                outbox.reliable(str(partial_score).encode())
                 start_active = True
             except socket.error:
                 print("Failed to send level score to client.")
@@ -391,18 +357,17 @@ while run:
         screen.blit(partial_score_text, partial_score_text_rect)
         if start_active:
             screen.blit(start_button, (jo.width_center - start_button.get_width() / 2, 780))
-        if countdown_next_iter:
-            countdown_next_iter = False
-            countdown_active = True
-        # Begin countdown to the next level.
-        elif countdown_active:
-            jo.countdown_from(jo.COUNTDOWN_SEC, screen)
-            pygame.mixer.music.load(jo.SOUNDS_DIR + "level2_music.mp3")
-            pygame.mixer.music.play(-1)
-            countdown_active = False
+        # Count down to the next level.
+        if countdown is not None and countdown.draw(screen):
+            try:
+                pygame.mixer.music.load(jo.SOUNDS_DIR + "level2_music.mp3")
+                pygame.mixer.music.play(-1)
+            except pygame.error:                # The music file of level 2 is missing.
+                print("Failed to load level 2 music.")
+            countdown = None
             menu_screen = -1
-            movement_active = True
-            attack_active = True
+            movement_active = not LOCKSTEP
+            attack_active = not LOCKSTEP
             # Reset gameplay and prepare the next level.
             hp = jo.FULL_HP
             server_attacks = jo.INIT_ATTACKS - 1
@@ -433,6 +398,8 @@ while run:
             server_immune_frame = 0
             level_index += 1
             slimes_to_spawn = jo.levels[level_index].enemies_num
+            if LOCKSTEP:
+                world.reset_level(level_index)
     elif menu_screen == 5:      # Leaderboard.
         # Show cursor.
         pygame.mouse.set_visible(True)
@@ -440,9 +407,12 @@ while run:
             # Calculate and communicate score.
             calculate_score()
             final_score = score
+            jazz_metrics.ACTIVE_MATCHES.set(0)
+            jazz_metrics.MATCH_PLAYERS.remove(match=team_name)
+            jazz_metrics.MATCH_SLIMES.remove(match=team_name)
             try:
-                conn.sendall(str(final_score).encode())
-                pygame.time.delay(200)      # Prevent merging with the next message.
+                outbox.reliable(str(final_score).encode())
+                message_time = time.perf_counter()
             except socket.error:
                 print("Failed to send total score to client.")
                 run = False
@@ -451,51 +421,61 @@ while run:
                 jo.victory_sound.play()
             else:
                 jo.defeat_sound.play()
-            # Access the database and update it, if appropriate.
-            sql_select_team = """
-                SELECT * FROM teams WHERE name = '""" + team_name + """';
-            """
-            team_entry = execute_read_query(db_conn, sql_select_team)
-            if len(team_entry) == 0:
-                sql_insert_team = """
-                    INSERT INTO teams (name, score)
-                        values
-                        ('""" + team_name + """', """ + str(final_score) + """);
-                """
-                execute_write_query(db_conn, sql_insert_team)
-            elif team_entry[0][2] < final_score:
-                sql_update_team = """
-                    UPDATE teams SET score = """ + str(final_score) + """ WHERE name = '""" + team_name + """';
-                """
-                execute_write_query(db_conn, sql_update_team)
-            sql_select_top = """
-                SELECT name, score FROM teams ORDER BY score DESC LIMIT 3;
-            """
-            top_teams = execute_read_query(db_conn, sql_select_top)
-            sql_calculate_rank = """
-                SELECT COUNT(*) FROM teams WHERE score >= """ + str(final_score) + """;
-            """
-            rank_result = execute_read_query(db_conn, sql_calculate_rank)
-            team_rank = rank_result[0][0]       # Rank for this run's score, not the best score of the team.
+            # Update the database, if appropriate, without waiting for it.
+            # The rank is for this run's score, not the best score of the team.
+            db_future = db_worker.submit_score(team_name, final_score)
+            db_deadline = time.perf_counter() + jl.QUERY_TIMEOUT
+        if (db_future is not None and (db_future.done() or time.perf_counter() > db_deadline) and
+                time.perf_counter() - message_time >= jazz_handshake.MESSAGE_GAP):
+            if db_future.done() and db_future.exception() is None:
+                top_teams, team_rank = db_future.result()
+            else:                                   # Show the latest top teams known, without a rank.
+                print("Failed to get the leaderboard in time.")
+                top_teams, team_rank = db_worker.top_teams, None
+            db_future = None
             # Send data derived from the database to the client.
-            db_data = jo.encode_db_data(top_teams, team_rank)
+            db_data = jo.encode_db_data(top_teams, team_rank, LEADERBOARD_WINDOW)
             try:
-                conn.sendall(db_data)
+                outbox.reliable(db_data)
             except socket.error:
                 print("Failed to send database data to client.")
         # Render UI elements.
-        jo.draw_leaderboard(top_teams, (team_rank, team_name, final_score), victorious, screen)
+        jo.draw_leaderboard(top_teams, (team_rank, team_name, final_score), victorious, screen, LEADERBOARD_WINDOW)
+    elif menu_screen < 0 and LOCKSTEP:      # Actual gameplay, in lockstep mode.
+        # Hide cursor.
+        pygame.mouse.set_visible(False)
+        # Exchange keys with the client and simulate the frame on both sides.
+        server_mask = jls.read_keys(keys)
+        try:
+            outbox.drain()      # Messages still queued, e.g. the start signal on a slow link, go before the keys.
+            client_mask, desynced = jls.exchange_keys(conn, world, server_mask)
+            frame_timer.mark("network")
+            if desynced:
+                print("Lockstep desync detected at frame " + str(world.tick + 1) + ".")
+            stop_gameplay, events = world.step([server_mask, client_mask])
+            jls.play_sounds(events, 0)
+            frame_timer.mark("simulation")
+        except (socket.error, ValueError):
+            print("Failed to exchange keys with client.")
+            run = False
+        jls.draw_world(world, 0, screen)
+        if stop_gameplay:
+            hp = world.hp
+            enemies_killed = world.enemies_killed
     elif menu_screen < 0:       # Actual gameplay.
+        tick_start = time.perf_counter()
         # Hide cursor.
         pygame.mouse.set_visible(False)
         # Take a chance at spawning enemies and swords.
         if slimes_to_spawn > 0 and random() < 0.25 * delta_time:
-            spawn_slime(slimes)
+            jo.spawn_slime(slimes, level_index)
             slimes_to_spawn -= 1
         if len(swords) < jo.MAX_SWORDS and random() < 0.07 * delta_time:
-            spawn_sword(swords)
+            jo.spawn_sword(swords)
+            jo.ding_sound.play()
         # Update the slimes regarding NPC movement and animation.
-        move_slimes(slimes)
+        jo.move_slimes(slimes, [(server_x, server_y), (client_x, client_y)], enemy_vel)
+        frame_timer.mark("simulation")
         # Render UI elements.
         you_portrait_pos = (12, 4)
         mate_portrait_pos = (jo.SCREEN_WIDTH - jo.skeleton_portrait.get_width() - 12, 4)
@@ -535,6 +515,7 @@ while run:
         # Render low health effect, when appropriate.
         if hp == 1:
             screen.blit(jo.low_hp_fx, (0, 0))
+        frame_timer.mark("render")
         # Check if a sword was picked.
         for sword_rect in sword_rects:
             if client_rect.colliderect(sword_rect):
@@ -587,46 +568,106 @@ while run:
         # Check if the level or the game has ended.
         if hp <= 0 or enemies_killed >= jo.levels[level_index].enemies_num:
             stop_gameplay = True
+        jazz_metrics.TICK_SECONDS.observe(time.perf_counter() - tick_start)
+        jazz_metrics.MATCH_SLIMES.set(len(slimes), match=team_name)
+        frame_timer.mark("collisions")
     else:
         print("menu_screen value not recognized.")
+    frame_timer.mark("render")
 
-    # Establish a connection with the client.
+    # Establish a connection with the client, once it connects.
     if conn is None:
-        pygame.display.update()     # The first frame will not be drawn otherwise.
         try:
-            conn, addr = s.accept()
-            # print("Connection established.")
-            menu_screen += 1
+            conn = handshake.accepted(s)
+            if conn is not None:
+                outbox = jazz_sendqueue.SendQueue(conn)
+                # print("Connection established.")
+                menu_screen += 1
         except socket.error:
             listen_text = jo.dosis_font.render("Failed to connect to client.", 1, jo.PINK)
             listen_text_rect = listen_text.get_rect(center=(jo.width_center, 780))
             screen.blit(listen_text, listen_text_rect)
+    # Take the shared memory of a client on the same host, if it offers it before the game starts.
+    elif taking_offers:
+        try:
+            offer = handshake.message(conn, line=True)
+            if offer is not None:
+                if not LOCKSTEP:        # Lockstep mode exchanges keys, not frames.
+                    frames = jazz_sharedmem.take(conn, offer)
+                taking_offers = False
+        except socket.error:
+            print("Failed to receive shared memory offer from client.")
+            taking_offers = False
+    frame_timer.mark("network")
 
+    frame_timer.draw(screen)
+    frame_timer.mark("render")
     pygame.display.update()
+    frame_timer.mark("display")
 
     # Exchange information for the current game frame with the client.
-    if menu_screen < 0 and server_anim_key is not None:     # Actual gameplay.
+    if menu_screen < 0 and server_anim_key is not None and not LOCKSTEP:     # Actual gameplay.
+        stamp, echo = net_stats.stamps()
         frame_data = jo.encode_frame_data(server_anim_key, server_anim_index, server_flipped,
-                                          (server_x, server_y), server_attacks, hp, slimes, swords, stop_gameplay)
+                                          (server_x, server_y), server_attacks, hp, slimes, swords, stop_gameplay,
+                                          stamp, echo)
+        replies = []
         try:
-            conn.sendall(frame_data)
+            send_start = time.perf_counter()
+            if frames is not None:
+                try:
+                    frames.publish(frame_data)      # Never waits for the client, which reads the latest frame.
+                    jazz_metrics.BYTES_SENT.inc(len(frame_data))
+                except ValueError:                  # Too large for shared memory.
+                    print("Failed to share frame update information with client. Using the network instead.")
+                    frames.release()                # The client switches back on its next frame.
+                    frames = None
+            if frames is None:
+                outbox.snapshot(frame_data)         # A slow client gets fewer frames instead of stalling the game.
+            net_stats.sent(len(frame_data), send_start)
         except socket.error:
             print("Failed to send frame update information to client.")
+        # Handle the replies of the client as they arrive. The last frame of a level waits for them all.
         try:
-            frame_data = conn.recv(2048)
-            new_client_anim_key, client_anim_index, client_flipped, (client_x, client_y), client_attacks = (
-                jo.decode_frame_data(frame_data))[0:5]
-            if new_client_anim_key == "attack" and client_anim_key != "attack":     # First frame of attack sequence.
-                client_can_kill = True
-            client_anim_key = new_client_anim_key
+            if frames is not None:
+                reply = frames.latest()             # Replies that were replaced by a newer one are skipped.
+                if reply is not None:
+                    replies.append(reply)
+            while outbox.in_flight > 0 and (stop_gameplay or outbox.replied()):
+                if stop_gameplay:
+                    outbox.drain()
+                reply = net_stats.recv(conn, 2048)
+                if len(reply) == 0:
+                    raise ConnectionResetError("The client closed the connection.")
+                outbox.acknowledge()
+                replies.append(reply)
         except socket.error:                 # Will occur if the client shuts down mid-play.
             print("Failed to receive frame update information from client.")
-        except decoder.JSONDecodeError:      # Will occur with an empty message.
-            print("Failed to decode frame update information from client.")
+        for frame_data in replies:
+            jazz_metrics.BYTES_RECEIVED.inc(len(frame_data))
+            try:
+                frame_vars = jo.decode_frame_data(frame_data)
+            except decoder.JSONDecodeError:
+                print("Failed to decode frame update information from client.")
+                net_stats.decode_error()
+                continue
+            (new_client_anim_key, client_anim_index, client_flipped, (client_x, client_y),
+             client_attacks) = frame_vars[0:5]
+            net_stats.decoded(*frame_vars[9:11])
+            if new_client_anim_key == "attack" and client_anim_key != "attack":     # First frame of attack.
+                client_can_kill = True
+            client_anim_key = new_client_anim_key
+    elif outbox is not None and not (menu_screen < 0 and LOCKSTEP):     # Keys go around it in lockstep gameplay.
+        try:
+            outbox.flush()                  # The rest of the menu messages, if the link was busy.
+        except socket.error:
+            print("Failed to send a message to client.")
+    frame_timer.mark("network")
 
     # Handle transition from gameplay to next level screen or to end game screen.
     if stop_gameplay:
         stop_gameplay = False
+        net_stats.pause()
         movement_active = False
         attack_active = False
         pygame.mixer.music.stop()
@@ -638,11 +679,22 @@ while run:
         else:                           # Victory.
             menu_screen = 5
             victorious = True
+    frame_timer.end()
+    profiler.update(menu_screen, level_index, len(world.slimes) if world is not None else len(slimes))
 
 
 # Clean-up and shut down.
+handshake.close()
+if frames is not None:
+    frames.close()
 try:
-    conn.close()
+    if conn is not None:        # Might quit before the client connects.
+        conn.close()
+    s.close()
 except socket.error:
     print("Error closing connection.")
+db_worker.close()
+frame_timer.save()
+profiler.stop()
+net_stats.log(force=True)
 pygame.quit()
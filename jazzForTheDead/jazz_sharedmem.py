@@ -0,0 +1,177 @@
+""" Shared memory frames of the "Jazz for the dead!" game.
+
+When the server and the client run on the same machine, e.g. a kiosk, every gameplay frame still goes through the
+network stack: a system call to send it, another to receive it, and a copy into and out of the kernel on both sides.
+Instead, a client on the same host as the server offers a segment of shared memory (see multiprocessing.shared_memory)
+and, once the server takes it, both sides publish the state of every frame there, without any system call.
+
+Only the latest frame of the other side matters, so each direction of the segment is a state slot, not a queue:
+    counter     Number of frames published so far (8 bytes). The latest one is in buffer counter % 2.
+    buffer 0    Sequence number (8 bytes), frame number (8 bytes), length (4 bytes) and up to FRAME_SIZE bytes of
+                frame data.
+    buffer 1    The same. The writer fills the buffer that does not hold the latest frame, then bumps the counter.
+Each buffer is a seqlock: the writer makes its sequence number odd before writing and even again after, and a reader
+copies the frame out, then checks that the sequence number was even and did not change meanwhile. The frame number in
+the buffer tells which frame was actually copied, as the writer may have filled the buffer again since the counter
+was read. Double buffering keeps the writer off the buffer being read, so a reader only retries if it is more than a
+whole frame late, and it then simply takes that frame on its next one. Neither side ever waits for the other: a frame
+that was replaced before it was read is skipped, the same as a coalesced snapshot (see jazz_sendqueue).
+
+The client offers the segment right after connecting with a single line, SHM <name>, and the server sets the first
+byte of the segment once it takes it. Everything but the gameplay frames, e.g. the scores, still goes through the
+transport (see jazz_transport). The server takes offers until the game starts, and only from a client on its own host;
+the client checks whether the server took its offer when the start signal arrives, and otherwise keeps sending frames
+through the transport. A server that cannot publish a frame, e.g. one larger than FRAME_SIZE, clears the byte again
+and goes back to the transport, and so does the client on its next frame. Peers on different hosts, servers that
+decline (e.g. in lockstep mode) and systems without shared memory therefore fall back to the network on their own. Set
+the JAZZ_SHARED_MEMORY environment variable to 0 to always use the network.
+"""
+
+import os
+import socket
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+ENABLED = os.environ.get("JAZZ_SHARED_MEMORY", "1") != "0"
+OFFER = "SHM"
+FRAME_SIZE = 65536          # Largest frame (in bytes). Frames are a few hundred bytes of JSON.
+FLAG = struct.Struct("<B")              # Whether the server took the segment.
+COUNTER = struct.Struct("<Q")           # Frames published in a direction.
+BUFFER = struct.Struct("<QQI")          # Sequence number, frame number and length of the frame in a buffer.
+BUFFER_SIZE = BUFFER.size + FRAME_SIZE
+DIRECTION_SIZE = COUNTER.size + 2 * BUFFER_SIZE
+SEGMENT_SIZE = 8 + 2 * DIRECTION_SIZE   # The flag, padded to keep the counters aligned, and both directions.
+TO_SERVER = 0
+TO_CLIENT = 1
+
+
+class StateSlot:
+    def __init__(self, buf, offset):
+        """ Use a direction of a segment, at the given offset of its buffer, to publish or read frames. """
+        self.buf = buf
+        self.offset = offset
+        self.published = COUNTER.unpack_from(buf, offset)[0]    # Frames published through this slot, when writing.
+        self.seen = self.published                              # Latest frame read, when reading.
+
+    def publish(self, data):
+        """ Replace the frame of the slot. Never blocks. Raise ValueError if the frame is larger than FRAME_SIZE. """
+        if len(data) > FRAME_SIZE:
+            raise ValueError("Frame too large for shared memory.")
+        counter = self.published + 1
+        start = self.offset + COUNTER.size + (counter % 2) * BUFFER_SIZE
+        sequence = BUFFER.unpack_from(self.buf, start)[0]
+        BUFFER.pack_into(self.buf, start, sequence + 1, 0, 0)                   # Odd: being written.
+        self.buf[start + BUFFER.size:start + BUFFER.size + len(data)] = data
+        BUFFER.pack_into(self.buf, start, sequence + 2, counter, len(data))     # Even: complete.
+        COUNTER.pack_into(self.buf, self.offset, counter)
+        self.published = counter
+
+    def latest(self):
+        """ Return a copy of the latest frame of the slot, or None if there is no new one. Never blocks. """
+        counter = COUNTER.unpack_from(self.buf, self.offset)[0]
+        if counter == self.seen:
+            return None
+        start = self.offset + COUNTER.size + (counter % 2) * BUFFER_SIZE
+        sequence, number, length = BUFFER.unpack_from(self.buf, start)
+        if sequence % 2 == 1:
+            return None             # Lapped by the writer. The next frame will do.
+        data = bytes(self.buf[start + BUFFER.size:start + BUFFER.size + length])
+        if BUFFER.unpack_from(self.buf, start)[0] != sequence or number <= self.seen:
+            return None             # Overwritten while copying, or a frame read already.
+        self.seen = number          # The frame copied, maybe newer than the counter read.
+        return data
+
+    def skip(self):
+        """ Count every frame published so far as read. """
+        self.seen = COUNTER.unpack_from(self.buf, self.offset)[0]
+
+
+class SharedFrames:
+    def __init__(self, segment, is_server):
+        """ Exchange gameplay frames with the other side through a shared memory segment, as created by offer() or
+        taken by take(). """
+        self.segment = segment
+        self.is_server = is_server
+        outgoing, incoming = (TO_CLIENT, TO_SERVER) if is_server else (TO_SERVER, TO_CLIENT)
+        self.outgoing = StateSlot(segment.buf, 8 + outgoing * DIRECTION_SIZE)
+        self.incoming = StateSlot(segment.buf, 8 + incoming * DIRECTION_SIZE)
+
+    def publish(self, data):
+        """ Replace the frame sent to the other side. Never blocks. """
+        self.outgoing.publish(data)
+
+    def latest(self):
+        """ Return the latest frame of the other side, or None if it did not publish a new one. Never blocks. """
+        return self.incoming.latest()
+
+    def skip(self):
+        """ Ignore the frames the other side published so far, e.g. the last ones of the previous level. """
+        self.incoming.skip()
+
+    def taken(self):
+        """ Return whether the server took the segment, and still uses it. """
+        return FLAG.unpack_from(self.segment.buf, 0)[0] == 1
+
+    def release(self):
+        """ Tell the client that the frames go through the transport again, and detach from the segment. Only for
+        the server. """
+        FLAG.pack_into(self.segment.buf, 0, 0)
+        self.close()
+
+    def close(self):
+        """ Detach from the segment. The client, which created it, also removes it. """
+        self.outgoing = None            # Release the views of the buffer first.
+        self.incoming = None
+        self.segment.close()
+        if not self.is_server:
+            try:
+                self.segment.unlink()
+            except FileNotFoundError:
+                pass                    # Removed already.
+
+
+def same_host(sock):
+    """ Return 'True' if a connected socket leads to a peer on this host, or 'False' otherwise. Both ends of a
+    connection to this host, over the loopback or any other interface, have the same address. """
+    try:
+        return sock.getpeername()[0] == sock.getsockname()[0]
+    except (socket.error, AttributeError):
+        return False                # Not connected, or not a socket.
+
+
+def offer(transport):
+    """ Create a segment and offer it to a server on the same host, through a transport freshly connected to it.
+    Return the frames of the segment, or None if the server is on another host or shared memory is not available. """
+    if not ENABLED or not same_host(getattr(transport, "sock", None)):
+        return None
+    try:
+        segment = shared_memory.SharedMemory(create=True, size=SEGMENT_SIZE)
+    except OSError:
+        print("Failed to create shared memory for the frames.")
+        return None
+    segment.buf[:SEGMENT_SIZE] = bytes(SEGMENT_SIZE)
+    transport.send((OFFER + " " + segment.name + "\n").encode())
+    return SharedFrames(segment, is_server=False)
+
+
+def take(transport, line):
+    """ Take the segment offered by a client, as received in a single line. Return its frames, or None if the client
+    is on another host, the line is not an offer or the segment is not available. """
+    command, _, name = line.decode(errors="replace").strip().partition(" ")
+    if not ENABLED or command != OFFER or not same_host(getattr(transport, "sock", None)):
+        return None
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except (OSError, ValueError):
+        print("Failed to open the shared memory of the client.")
+        return None
+    # The client removes the segment. Otherwise the resource tracker of this process would remove it again on exit. It
+    # only tracks segments on POSIX systems, by their name with a leading slash.
+    if os.name == "posix":
+        resource_tracker.unregister("/" + segment.name, "shared_memory")
+    if segment.size < SEGMENT_SIZE:
+        segment.close()
+        return None
+    frames = SharedFrames(segment, is_server=True)
+    FLAG.pack_into(segment.buf, 0, 1)
+    return frames
@@ -0,0 +1,104 @@
+""" Spectator script for the "Jazz for the dead!" game.
+
+Watch a match in progress on a dedicated server, without taking part in it.
+Usage: python jazz_spectator.py <server IP> <room code>
+"""
+
+import jazz_operations as jo
+import jazz_lobby
+import socket
+import sys
+from json import decoder
+import pygame
+
+FPS_CAP = 60
+
+if len(sys.argv) != 3:
+    print("Usage: python jazz_spectator.py <server IP> <room code>")
+    raise SystemExit
+
+# Initialize connection with the server.
+try:
+    s = socket.create_connection((sys.argv[1], jo.PORT))
+    jazz_lobby.watch(s, sys.argv[2].upper())
+except socket.error:
+    print("Failed to connect to the server.")
+    raise SystemExit
+except jazz_lobby.LobbyError as e:
+    print("The server refused to show the match: " + str(e))
+    raise SystemExit
+s.setblocking(False)
+
+
+# Pygame and variable initialization.
+pygame.init()
+screen = pygame.display.set_mode((jo.SCREEN_WIDTH, jo.SCREEN_HEIGHT), vsync=1)
+pygame.display.set_caption("Jazz for the dead! - spectator")
+clock = pygame.time.Clock()
+menu_bg = pygame.image.load(jo.GRAPHICS_DIR + "menu_bg.png").convert()
+level_bgs = [pygame.image.load(jo.GRAPHICS_DIR + "level1.png").convert(),
+             pygame.image.load(jo.GRAPHICS_DIR + "level2.png").convert()]
+wait_text = jo.dosis_font_large.render("Waiting for the match to start...", 1, jo.WHITE)
+wait_text_rect = wait_text.get_rect(center=(jo.width_center, jo.height_center))
+ended_text = jo.dosis_font_large.render("The match has ended.", 1, jo.WHITE)
+ended_text_rect = ended_text.get_rect(center=(jo.width_center, jo.height_center))
+received = b""          # Data of a snapshot that has not been received completely yet.
+snapshot = None
+connected = True
+
+
+# Pygame loop.
+run = True
+while run:
+    clock.tick(FPS_CAP)
+    for event in pygame.event.get():
+        if event.type == pygame.QUIT:
+            run = False
+
+    # Exit when pressing escape.
+    keys = pygame.key.get_pressed()
+    if keys[pygame.K_ESCAPE]:
+        run = False
+
+    # Receive everything sent since the last frame and keep only the latest complete snapshot.
+    while connected:
+        try:
+            data = s.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            break
+        except socket.error:
+            data = b""
+        if len(data) == 0:              # The match has ended.
+            connected = False
+        received += data
+    if b"\n" in received:
+        snapshots = received.split(b"\n")
+        received = snapshots[-1]
+        try:
+            snapshot = jo.decode_spectator_data(snapshots[-2])
+        except decoder.JSONDecodeError:
+            print("Failed to decode snapshot from server.")
+
+    # Render the current frame.
+    if snapshot is None:
+        screen.blit(menu_bg, (0, 0))
+        if connected:
+            screen.blit(wait_text, wait_text_rect)
+    else:
+        team_name, level_index, score, players, hp, slimes, swords, stop = snapshot
+        screen.blit(level_bgs[level_index], (0, 0))
+        jo.draw_game_view(team_name, level_index, score, players, hp, slimes, swords, screen)
+        if stop and hp > 0 and connected:
+            screen.blit(jo.level_cleared_text, jo.level_cleared_text_rect)
+    if not connected:
+        screen.blit(ended_text, ended_text_rect)
+
+    pygame.display.update()
+
+
+# Clean-up and shut down.
+try:
+    s.close()
+except socket.error:
+    print("Error closing socket.")
+pygame.quit()
@@ -0,0 +1,255 @@
+""" Gameplay telemetry of the "Jazz for the dead!" dedicated server, for balancing the levels.
+
+Matches report their gameplay events to a TelemetryLog, which appends them to a compact binary file. Reporting an event
+only packs it into a buffer: a background thread writes the buffer every FLUSH_INTERVAL seconds, or as soon as it holds
+FLUSH_BYTES, so the game loops never wait for the disk. Every worker of the dedicated server writes a file of its own.
+
+Telemetry files are made of a header (magic bytes and format version) followed by fixed size events: kind, match
+number, level index, tick of the level, role of the player ('s', 'z' or none), position and a value. The kinds are:
+    spawn       An enemy appeared, at its spawn point.
+    sword       A player picked a sword, at the sword spawn point.
+    attack      A player started an attack, at the player's position. The value is the attacks left.
+    kill        A player killed an enemy, at the enemy's position.
+    damage      The team lost a heart, touched at the player's position. The value is the hearts left.
+    end         The level ended, cleared or lost. The value is the hearts left, none if lost.
+
+The report command aggregates any number of files per level (see jazz_operations.levels): how long clearing it takes,
+where the team takes damage, how each enemy spawn point and the swords are used.
+
+Usage:
+    python jazz_dedicated.py --telemetry                          Record the telemetry of every match.
+    python jazz_telemetry.py report telemetry/*.jftt              Print balancing stats per level.
+    python jazz_telemetry.py report telemetry/*.jftt --cell 240   Use a coarser damage heatmap.
+"""
+
+import os
+
+# Reports are made offline, so they must also work on machines without a screen or speakers. Must be set before pygame
+# is initialized.
+if __name__ == "__main__":
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import jazz_operations as jo
+from jazz_match import FPS_CAP
+import argparse
+import struct
+import threading
+import time
+
+MAGIC = b"JFTT"
+VERSION = 1
+HEADER_FORMAT = struct.Struct("<4sB")               # Magic and version.
+EVENT_FORMAT = struct.Struct("<BIBIBhhh")           # Kind, match, level index, tick, role, x, y and value.
+KINDS = ["spawn", "sword", "attack", "kill", "damage", "end"]
+ROLES = {"s": 1, "z": 2}                            # Codes of the roles of the players, 0 for no player.
+FLUSH_INTERVAL = 1          # Time (in seconds) between two writes of the buffered events.
+FLUSH_BYTES = 65536         # Buffered events that trigger a write right away.
+HEATMAP_CELL = 120          # Size (in pixels) of the cells of the damage heatmap.
+HEATMAP_ROWS = 5            # Cells shown per level, the most damaging first.
+
+
+class TelemetryLog:
+    def __init__(self, path):
+        """ Open a telemetry file to append to, creating it if it does not exist, and start writing to it in the
+        background. """
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(HEADER_FORMAT.pack(MAGIC, VERSION))
+        self.buffer = []            # Packed events not yet written.
+        self.buffered = 0           # Size of the buffered events.
+        self.matches = 0            # Matches reported so far, to number the next one.
+        self.closed = False
+        self.condition = threading.Condition()
+        self.writer = threading.Thread(target=self.write_behind, daemon=True)
+        self.writer.start()
+
+    def match(self):
+        """ Return a MatchTelemetry for the events of a new match. """
+        with self.condition:
+            self.matches += 1
+            return MatchTelemetry(self, self.matches)
+
+    def event(self, kind, match, level_index, tick, role, pos, value):
+        """ Buffer an event. Does not wait for the disk. """
+        data = EVENT_FORMAT.pack(KINDS.index(kind), match, level_index, tick, ROLES.get(role, 0), round(pos[0]),
+                                 round(pos[1]), value)
+        with self.condition:
+            self.buffer.append(data)
+            self.buffered += len(data)
+            if self.buffered >= FLUSH_BYTES:
+                self.condition.notify()
+
+    def write_behind(self):
+        """ Write the buffered events in batches, until closed. Runs on a thread of its own. """
+        while True:
+            with self.condition:
+                if not self.closed and self.buffered < FLUSH_BYTES:
+                    self.condition.wait(FLUSH_INTERVAL)
+                batch = self.buffer
+                self.buffer = []
+                self.buffered = 0
+                closed = self.closed
+            if len(batch) > 0:
+                try:
+                    self.file.write(b"".join(batch))
+                    self.file.flush()
+                except OSError:
+                    print("Failed to write telemetry.")
+            if closed:
+                self.file.close()
+                return
+
+    def close(self):
+        """ Write the events still buffered and stop the background writer. Blocking. """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.writer.join()
+
+
+class MatchTelemetry:
+    def __init__(self, log, match):
+        """ Report the events of a single match to a TelemetryLog, tagged with the number of the match. """
+        self.log = log
+        self.match = match
+
+    def spawn(self, level_index, tick, pos):
+        self.log.event("spawn", self.match, level_index, tick, None, pos, 0)
+
+    def sword(self, level_index, tick, role, pos):
+        self.log.event("sword", self.match, level_index, tick, role, pos, 0)
+
+    def attack(self, level_index, tick, role, pos, attacks):
+        self.log.event("attack", self.match, level_index, tick, role, pos, attacks)
+
+    def kill(self, level_index, tick, role, pos):
+        self.log.event("kill", self.match, level_index, tick, role, pos, 0)
+
+    def damage(self, level_index, tick, role, pos, hp):
+        self.log.event("damage", self.match, level_index, tick, role, pos, hp)
+
+    def end(self, level_index, tick, hp):
+        self.log.event("end", self.match, level_index, tick, None, (0, 0), hp)
+
+
+def new_log(telemetry_dir, name):
+    """ Return a telemetry log for the matches of a process, or None if telemetry is not recorded. """
+    if telemetry_dir is None:
+        return None
+    os.makedirs(telemetry_dir, exist_ok=True)
+    return TelemetryLog(os.path.join(telemetry_dir, time.strftime("%Y%m%d-%H%M%S") + "-" + name + ".jftt"))
+
+
+def read_events(path):
+    """ Yield the events of a telemetry file as tuples of kind (string), match, level index, tick, role (string, None
+    for no player), position (tuple) and value. A partial event at the end, from a file still being written, is
+    ignored. """
+    with open(path, "rb") as file:
+        data = file.read()
+    if len(data) < HEADER_FORMAT.size or HEADER_FORMAT.unpack_from(data) != (MAGIC, VERSION):
+        raise ValueError("Not a telemetry file of a supported version: " + path)
+    roles = {code: role for role, code in ROLES.items()}
+    for kind, match, level_index, tick, role, x, y, value in EVENT_FORMAT.iter_unpack(
+            data[HEADER_FORMAT.size:len(data) - (len(data) - HEADER_FORMAT.size) % EVENT_FORMAT.size]):
+        yield KINDS[kind], match, level_index, tick, roles.get(role), (x, y), value
+
+
+def nearest(points, pos):
+    """ Return the index of the point closest to the given position. """
+    return min(range(len(points)), key=lambda index: jo.get_distance(points[index], pos))
+
+
+def aggregate(paths, cell=HEATMAP_CELL):
+    """ Return the balancing stats of every level, from the events of several telemetry files.
+
+    Returns:
+        (list of dicts): By level index. 'ends' are the ticks it took to clear the level, 'defeats' the ticks it took
+            to lose it. 'heatmap' counts damage by cell (column and row), 'spawn_damage' and 'spawn_kills' by nearest
+            enemy spawn point and 'spawns' by spawn point. 'swords', 'attacks' and 'kills' count by role.
+    """
+
+    stats = [{"ends": [], "defeats": [], "heatmap": {}, "spawn_damage": [0] * len(level.enemy_spawns),
+              "spawn_kills": [0] * len(level.enemy_spawns), "spawns": [0] * len(level.enemy_spawns),
+              "swords": {}, "attacks": {}, "kills": {}} for level in jo.levels]
+    for path in paths:
+        for kind, match, level_index, tick, role, pos, value in read_events(path):
+            if level_index >= len(stats):
+                continue
+            level_stats = stats[level_index]
+            spawns = jo.levels[level_index].enemy_spawns
+            if kind == "end":
+                level_stats["ends" if value > 0 else "defeats"].append(tick)
+            elif kind == "damage":
+                key = (pos[0] // cell, pos[1] // cell)
+                level_stats["heatmap"][key] = level_stats["heatmap"].get(key, 0) + 1
+                level_stats["spawn_damage"][nearest(spawns, pos)] += 1
+            elif kind == "spawn":
+                level_stats["spawns"][nearest(spawns, pos)] += 1
+            else:
+                if kind == "kill":
+                    level_stats["spawn_kills"][nearest(spawns, pos)] += 1
+                counts = level_stats[kind + "s"]
+                counts[role] = counts.get(role, 0) + 1
+    return stats
+
+
+def seconds(ticks):
+    """ Return a number of ticks as seconds of gameplay, e.g. '12.3s'. """
+    return format(ticks / FPS_CAP, ".1f") + "s"
+
+
+def report(stats, cell=HEATMAP_CELL):
+    """ Print the balancing stats returned by aggregate(). """
+    for level_index, level_stats in enumerate(stats):
+        level = jo.levels[level_index]
+        plays = len(level_stats["ends"]) + len(level_stats["defeats"])
+        print("Level " + str(level_index + 1) + " (" + str(level.enemies_num) + " enemies): played " + str(plays) +
+              " times, cleared " + str(len(level_stats["ends"])) + ", lost " + str(len(level_stats["defeats"])))
+        if plays == 0:
+            continue
+        ends = sorted(level_stats["ends"])
+        if len(ends) > 0:
+            print("    time to clear:  p50 " + seconds(ends[len(ends) // 2]) + ", p90 " +
+                  seconds(ends[min(len(ends) - 1, int(0.9 * len(ends)))]) + ", best " + seconds(ends[0]) +
+                  ", mean " + seconds(sum(ends) / len(ends)))
+        for name in ("swords", "attacks", "kills"):
+            counts = level_stats[name]
+            print("    " + (name + " per play:").ljust(20) + format(sum(counts.values()) / plays, ".1f") + "  (" +
+                  ", ".join(str(role) + " " + format(count / plays, ".1f") for role, count in sorted(counts.items()))
+                  + ")")
+        attacks = sum(level_stats["attacks"].values())
+        if attacks > 0:
+            print("    kills per attack: " + format(sum(level_stats["kills"].values()) / attacks, ".2f"))
+        print("    enemy spawn points (spawns / kills / damage nearby per play):")
+        for index, spawn in enumerate(level.enemy_spawns):
+            print("        " + str(spawn).ljust(14) + format(level_stats["spawns"][index] / plays, ".1f").rjust(6) +
+                  format(level_stats["spawn_kills"][index] / plays, ".1f").rjust(8) +
+                  format(level_stats["spawn_damage"][index] / plays, ".2f").rjust(8))
+        cells = sorted(level_stats["heatmap"].items(), key=lambda entry: entry[1], reverse=True)[:HEATMAP_ROWS]
+        if len(cells) > 0:
+            print("    damage hot spots (" + str(cell) + " px cells, damage per play):")
+            for (column, row), count in cells:
+                print("        " + ("x " + str(column * cell) + "-" + str((column + 1) * cell) + ", y " +
+                                    str(row * cell) + "-" + str((row + 1) * cell)).ljust(24) +
+                      format(count / plays, ".2f").rjust(6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gameplay telemetry of Jazz for the dead!")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report_parser = subparsers.add_parser("report", help="print balancing stats per level")
+    report_parser.add_argument("files", nargs="+", help="telemetry files (.jftt)")
+    report_parser.add_argument("--cell", type=int, default=HEATMAP_CELL, help="size (in pixels) of the heatmap cells")
+    args = parser.parse_args()
+
+    try:
+        stats = aggregate(args.files, args.cell)
+    except (OSError, ValueError) as e:
+        print("Failed to read telemetry: " + str(e))
+        raise SystemExit(1)
+    report(stats, args.cell)
+
+
+if __name__ == "__main__":
+    main()
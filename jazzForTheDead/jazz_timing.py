@@ -0,0 +1,112 @@
+""" Per-stage frame timing for the "Jazz for the dead!" game.
+
+The main loops of the scripts mark the end of each stage of a frame (input, simulation, rendering, collisions,
+display.update and the network exchange). The time of every stage is kept for the last RING_SIZE frames in a fixed-size
+ring buffer, so memory does not grow however long the game runs. An overlay shows the rolling average and the worst
+time of each stage over the last OVERLAY_WINDOW frames, and the whole buffer can be written to a CSV file on exit.
+
+Press F3 in game to toggle the timing and its overlay. Set the JAZZ_TIMING environment variable to the path of a CSV
+file to time from the start and save the buffer there on exit, using a different path for each script run on the same
+machine. While disabled, every call returns right away.
+"""
+
+import jazz_operations as jo
+import os
+import time
+from array import array
+import pygame
+
+RING_SIZE = 3600                    # Frames kept, one minute at the frame cap.
+STAGES = ["input", "simulation", "render", "collisions", "display", "network"]
+OVERLAY_WINDOW = 120                # Frames the overlay averages over.
+OVERLAY_REFRESH = 30                # Frames between updates of the overlay text, since rendering text is slow.
+OVERLAY_POS = (20, 120)
+TOGGLE_KEY = pygame.K_F3
+
+
+class FrameTimer:
+    def __init__(self, csv_path=None):
+        """ Prepare a timer, enabled from the start if a CSV path is given. """
+        self.csv_path = csv_path
+        self.enabled = csv_path is not None
+        self.times = array("d", bytes(8 * RING_SIZE * (len(STAGES) + 1)))   # Stages and total, by frame.
+        self.frames = 0             # Frames recorded so far, including those already overwritten.
+        self.current = [0.0] * len(STAGES)
+        self.frame_start = 0
+        self.last_mark = 0
+        self.overlay = []           # Rendered lines of text.
+        self.overlay_age = OVERLAY_REFRESH
+
+    def toggle(self):
+        """ Enable or disable the timing and its overlay. """
+        self.enabled = not self.enabled
+        self.frame_start = 0
+
+    def start(self):
+        """ Mark the start of a frame, right after the frame cap wait. """
+        if not self.enabled:
+            return
+        self.frame_start = self.last_mark = time.perf_counter()
+        self.current = [0.0] * len(STAGES)
+
+    def mark(self, stage):
+        """ Count the time since the previous mark towards the given stage. A stage can be marked more than once. """
+        if not self.enabled or self.frame_start == 0:
+            return
+        now = time.perf_counter()
+        self.current[STAGES.index(stage)] += now - self.last_mark
+        self.last_mark = now
+
+    def end(self):
+        """ Mark the end of a frame and store its times in the ring buffer. """
+        if not self.enabled or self.frame_start == 0:
+            return
+        offset = (self.frames % RING_SIZE) * (len(STAGES) + 1)
+        self.times[offset:offset + len(STAGES)] = array("d", self.current)
+        self.times[offset + len(STAGES)] = time.perf_counter() - self.frame_start
+        self.frames += 1
+
+    def rows(self, count=RING_SIZE):
+        """ Return up to count of the latest recorded frames, oldest first, as the frame number and the times (in
+        seconds) of each stage and the total. """
+        width = len(STAGES) + 1
+        first = max(0, self.frames - min(count, RING_SIZE))
+        rows = []
+        for frame in range(first, self.frames):
+            offset = (frame % RING_SIZE) * width
+            rows.append((frame, self.times[offset:offset + width]))
+        return rows
+
+    def draw(self, screen):
+        """ Render the rolling average and the worst time of each stage, over the latest frames. """
+        if not self.enabled:
+            return
+        self.overlay_age += 1
+        if self.overlay_age >= OVERLAY_REFRESH and self.frames > 0:
+            self.overlay_age = 0
+            rows = [times for frame, times in self.rows(OVERLAY_WINDOW)]
+            self.overlay = []
+            for index, stage in enumerate(STAGES + ["total"]):
+                values = [times[index] for times in rows]
+                text = (stage + ": avg " + format(sum(values) / len(values) * 1000, ".2f") + " ms, max " +
+                        format(max(values) * 1000, ".2f") + " ms")
+                self.overlay.append(jo.dosis_font.render(text, 1, jo.WHITE, jo.BLACK))
+        for index, line in enumerate(self.overlay):
+            screen.blit(line, (OVERLAY_POS[0], OVERLAY_POS[1] + index * line.get_height()))
+
+    def save(self):
+        """ Write the buffer to the CSV file, if one was given, with times in milliseconds. """
+        if self.csv_path is None:
+            return
+        try:
+            with open(self.csv_path, "w") as file:
+                file.write(",".join(["frame"] + STAGES + ["total"]) + "\n")
+                for frame, times in self.rows():
+                    file.write(",".join([str(frame)] + [format(value * 1000, ".3f") for value in times]) + "\n")
+        except OSError:
+            print("Failed to save frame timing to " + self.csv_path + ".")
+
+
+def from_environment():
+    """ Return a timer set up from the JAZZ_TIMING environment variable. """
+    return FrameTimer(os.environ.get("JAZZ_TIMING") or None)
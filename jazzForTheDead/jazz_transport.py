@@ -0,0 +1,207 @@
+""" Transports of the "Jazz for the dead!" game.
+
+The server, the client, the match host and the bots exchange their messages through a transport instead of a socket,
+so the same game runs over:
+    tcp         A TCP connection, as in a LAN game. The default.
+    udp         A connected UDP socket. Every message is a datagram of its own, so messages never merge, but lost ones
+                are not sent again: only for links that do not lose packets, e.g. a LAN or the loopback interface.
+    socketpair  The two ends of socket.socketpair(). The same stream as TCP, without the network stack.
+    local       A pair of in-process queues, without any system call. Both sides must run in the same process.
+Set the JAZZ_TRANSPORT environment variable to 'udp' on both the server and the client to play over UDP. The client
+greets the server with a HELLO datagram, so that the server learns its address, and closing a UDP transport sends an
+empty datagram, which the other side receives as a closed connection.
+
+Every transport sends a whole message with send(), or as much of it as fits without blocking with send_some(), receives
+with receive() (empty bytes once the other side closed) and tells whether something is waiting with poll().
+
+transport_pair() connects two transports of any kind within a single process, e.g. to play a whole match without a
+network (see jazz_loopback).
+"""
+
+import os
+import queue
+import select
+import socket
+
+TRANSPORT = os.environ.get("JAZZ_TRANSPORT", "tcp")
+SOCKET_TYPES = {"tcp": socket.SOCK_STREAM, "udp": socket.SOCK_DGRAM}
+HELLO = b"HELLO"            # First datagram of a UDP client.
+MAX_DATAGRAM = 65507        # Largest payload of a UDP datagram.
+DONTWAIT = getattr(socket, "MSG_DONTWAIT", None)    # Not on every system, e.g. Windows.
+
+
+class StreamTransport:
+    def __init__(self, sock):
+        """ Use a connected stream socket, e.g. of TCP or an end of socket.socketpair(), as a transport. Messages are
+        not delimited: a message might be received in parts, or merged with the next one. """
+        self.sock = sock
+
+    def send(self, data):
+        """ Send a whole message. Blocking. """
+        self.sock.sendall(data)
+
+    def send_some(self, data):
+        """ Send as much of a message as possible without blocking. Return the number of bytes sent. A datagram is
+        always sent whole. """
+        timeout = self.sock.gettimeout()
+        try:
+            # A single system call on every frame. Sockets with a timeout wait for room before any send, so they are
+            # unblocked meanwhile instead.
+            if DONTWAIT is not None and not timeout:
+                return self.sock.send(data, DONTWAIT)
+            self.sock.setblocking(False)
+            try:
+                return self.sock.send(data)
+            finally:
+                self.sock.settimeout(timeout)
+        except (BlockingIOError, InterruptedError):
+            return 0
+
+    def receive(self, size=2048):
+        """ Receive up to size bytes. Blocking. Return empty bytes if the other side closed the transport. """
+        return self.sock.recv(size)
+
+    def poll(self, timeout=0):
+        """ Return whether anything is waiting to be received, waiting up to timeout seconds for it. """
+        return len(select.select([self.sock], [], [], timeout)[0]) > 0
+
+    def settimeout(self, timeout):
+        """ Give up receiving after timeout seconds, raising socket.timeout. None to wait forever. """
+        self.sock.settimeout(timeout)
+
+    def close(self):
+        self.sock.close()
+
+
+class DatagramTransport(StreamTransport):
+    def __init__(self, sock):
+        """ Use a connected UDP socket as a transport. Every message is sent as a single datagram and always received
+        whole. """
+        super().__init__(sock)
+
+    def send(self, data):
+        self.sock.send(data)
+
+    def receive(self, size=2048):
+        """ Receive the next datagram, whatever its size. Blocking. """
+        return self.sock.recv(MAX_DATAGRAM)
+
+    def close(self):
+        """ Tell the other side with an empty datagram and close the socket. """
+        try:
+            self.sock.send(b"")
+        except socket.error:
+            pass                    # The other side is gone already.
+        self.sock.close()
+
+
+class LocalTransport:
+    def __init__(self, inbox, outbox):
+        """ Exchange messages through in-process queues. See local_pair(). """
+        self.inbox = inbox
+        self.outbox = outbox
+        self.pending = b""          # Rest of a message received in parts.
+        self.closed = False         # Whether the other side closed the transport.
+        self.timeout = None
+
+    def send(self, data):
+        self.outbox.put(bytes(data))
+
+    def send_some(self, data):
+        self.outbox.put(bytes(data))
+        return len(data)
+
+    def receive(self, size=2048):
+        """ Receive up to size bytes of the next message. Blocking. Return empty bytes if the other side closed the
+        transport. """
+        if len(self.pending) == 0 and not self.closed:
+            try:
+                self.pending = self.inbox.get(timeout=self.timeout)
+            except queue.Empty:
+                raise socket.timeout("timed out")
+            self.closed = len(self.pending) == 0
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        return data
+
+    def poll(self, timeout=0):
+        if len(self.pending) == 0 and not self.closed:
+            try:
+                self.pending = self.inbox.get(timeout=timeout) if timeout != 0 else self.inbox.get_nowait()
+            except queue.Empty:
+                return False
+            self.closed = len(self.pending) == 0
+        return True
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def close(self):
+        self.outbox.put(b"")
+
+
+def local_pair():
+    """ Return two local transports connected to each other. """
+    inbox = queue.Queue()
+    outbox = queue.Queue()
+    return LocalTransport(inbox, outbox), LocalTransport(outbox, inbox)
+
+
+def wrap(conn):
+    """ Return the transport of a connection that might still be a stream socket, e.g. passed by the dedicated
+    server. """
+    return StreamTransport(conn) if isinstance(conn, socket.socket) else conn
+
+
+def new_socket(kind=TRANSPORT):
+    """ Return a new socket for the given transport, 'tcp' or 'udp'. """
+    return socket.socket(socket.AF_INET, SOCKET_TYPES[kind])
+
+
+def listen(host, port, kind=TRANSPORT):
+    """ Return a socket that waits for a client on the given address, to pass to accept(). """
+    sock = new_socket(kind)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    if kind == "tcp":
+        sock.listen(1)
+    return sock
+
+
+def accept(listener):
+    """ Return the transport of the next client of a listening socket, once it is ready to read. Return None if a UDP
+    listener received a stray datagram instead of a HELLO. A UDP listener becomes the transport of its only client. """
+    if listener.type == socket.SOCK_STREAM:
+        conn, addr = listener.accept()
+        conn.setblocking(True)
+        return StreamTransport(conn)
+    data, addr = listener.recvfrom(MAX_DATAGRAM)
+    if data != HELLO:
+        return None
+    listener.connect(addr)
+    return DatagramTransport(listener)
+
+
+def open_connected(sock):
+    """ Return the transport of a socket connected to the server, greeting the server first over UDP. """
+    if sock.type == socket.SOCK_STREAM:
+        return StreamTransport(sock)
+    sock.send(HELLO)
+    return DatagramTransport(sock)
+
+
+def transport_pair(kind):
+    """ Return two transports of the given kind connected to each other, in this process. """
+    if kind == "local":
+        return local_pair()
+    if kind == "socketpair":
+        ends = socket.socketpair()
+        return StreamTransport(ends[0]), StreamTransport(ends[1])
+    listener = listen("127.0.0.1", 0, kind)
+    client = new_socket(kind)
+    client.connect(listener.getsockname())
+    client_end = open_connected(client)
+    server_end = accept(listener)
+    if kind == "tcp":
+        listener.close()
+    return server_end, client_end
@@ -0,0 +1,95 @@
+""" Tests of the highscore database access of the "Jazz for the dead!" game (see jazz_leaderboard).
+
+Usage:
+    python -m unittest test_leaderboard
+"""
+
+import jazz_leaderboard as jl
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+
+def failing_query(connection, *args):
+    """ Stand-in for a read of submit_score() that fails, as SQLite raises it. """
+    return jl.run_read(connection, "SELECT * FROM missing_table;")
+
+
+class SubmitTransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.connection = jl.init_database(os.path.join(self.directory.name, "highscore_db.sqlite"))
+        with self.connection:
+            jl.run_record(self.connection, [("old team", 100, 0.0)])
+
+    def tearDown(self):
+        self.connection.close()
+        self.directory.cleanup()
+
+    def count(self, table):
+        return self.connection.execute("SELECT COUNT(*) FROM " + table + ";").fetchone()[0]
+
+    def test_submit_commits_score_and_reads_it(self):
+        top_teams, team_rank = jl.run_submit(self.connection, "new team", 200)
+        self.assertEqual(top_teams[0], ("new team", 200))
+        self.assertEqual(team_rank, 1)
+        self.assertEqual(self.count("teams"), 2)
+        self.assertEqual(self.count("score_history"), 2)
+
+    def test_failure_after_upsert_rolls_back_whole_submit(self):
+        with mock.patch.object(jl, "run_rank", side_effect=failing_query):
+            with self.assertRaises(sqlite3.OperationalError):
+                jl.run_submit(self.connection, "new team", 200, "day")
+        self.assertFalse(self.connection.in_transaction)
+        self.assertEqual(self.count("teams"), 1)
+        self.assertEqual(self.count("score_history"), 1)
+        self.assertEqual(self.count("period_teams"), 2)     # Day and week of the old team only.
+
+    def test_submit_score_reports_failure_without_recording(self):
+        with mock.patch.object(jl, "run_top", side_effect=failing_query):
+            top_teams, team_rank = jl.submit_score(self.connection, "new team", 200)
+        self.assertEqual((top_teams, team_rank), ([], None))
+        self.assertEqual(self.count("teams"), 1)
+
+
+class WriteBehindTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.leaderboard = jl.Leaderboard(os.path.join(self.directory.name, "highscore_db.sqlite"))
+        self.writes = 0
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def failing_write(self, *args):
+        self.writes += 1
+        connection = sqlite3.connect(":memory:")
+        try:
+            connection.execute("SELECT * FROM missing_table;")
+        finally:
+            connection.close()
+
+    def test_failing_writes_back_off_and_report_lost_scores(self):
+        with mock.patch.object(self.leaderboard.store, "write", side_effect=self.failing_write), \
+                mock.patch("builtins.print") as printed:
+            for score in range(2 * jl.FLUSH_BATCH):
+                self.leaderboard.submit_score("team " + str(score), score)
+            time.sleep(jl.FLUSH_INTERVAL / 2)
+            self.leaderboard.close()
+        self.assertLessEqual(self.writes, 3)        # The first write, maybe one retry, and the last one on close.
+        printed.assert_called_with("Lost " + str(2 * jl.FLUSH_BATCH) + " scores that could not be written to the "
+                                   "database.")
+
+    def test_pending_scores_are_capped(self):
+        with mock.patch.object(jl, "MAX_PENDING", 10), mock.patch("builtins.print"):
+            self.leaderboard.keep_pending([("old team", 1, 0.0)] * 8)
+            self.leaderboard.keep_pending([("new team", 2, 0.0)] * 8)
+        self.assertEqual(len(self.leaderboard.pending), 10)
+        self.leaderboard.close()
+
+
+if __name__ == "__main__":
+    unittest.main()